@@ -1,18 +1,62 @@
 import os
 import streamlit as st
-import pyotp
-import qrcode
-from PIL import Image
 from io import BytesIO
-from auth import register, login_user, get_user_secret, verify_2fa_code
-from file_manager import list_user_files, create_file, read_file, update_file, delete_file
+import db
+import key_manager
+import metrics
+from auth import (register, login_user, verify_user_2fa,
+                  start_session, resolve_session, end_session)
+# The storage modules (file_manager, catalog, pack_store, quota, search_index,
+# archive, jobs) are imported where they are used, so the login page loads
+# without them; storage_resources starts their threads on the first dashboard.
 
 st.set_page_config(page_title="Secure File Manager", layout="centered")
 
+SEARCH_LIMIT = 50  # results shown per search
+
 # Initialize secure directory
 os.makedirs("secure_files", exist_ok=True)
 
+@st.cache_resource
+def shared_resources():
+    """Open the connection pool and load key material once per server process, not per rerun."""
+    key_manager.master_key()
+    return db.get_pool()
+
+shared_resources()
+
+@st.cache_resource
+def storage_resources():
+    """Set up storage and start its background threads once per server process, on first use."""
+    import catalog
+    import jobs
+    import pack_store
+    import quota
+    catalog.initialize()
+    pack_store.start_compactor()  # Reclaims space left by overwritten and deleted packed files
+    quota.start_reconciler()  # Catches usage totals that drifted from what is on disk
+    jobs.start_workers()  # Runs queued maintenance jobs, throttled (see jobs)
+    return True
+
+def session_cache():
+    """Return this browser session's cache of listings and decrypted files."""
+    import ui_cache
+    if "file_cache" not in st.session_state:
+        st.session_state["file_cache"] = ui_cache.SessionCache()
+    return st.session_state["file_cache"]
+
+# Expose /metrics for Prometheus when collection is switched on
+if metrics.ENABLED and os.environ.get("SECURE_FILE_METRICS_PORT"):
+    metrics.serve(int(os.environ["SECURE_FILE_METRICS_PORT"]))
+
+# Archive downloads stream from their own port (default archive.ARCHIVE_PORT), started on the first export
+EXPORT_PORT = os.environ.get("SECURE_FILE_EXPORT_PORT")
+EXPORT_HOST = os.environ.get("SECURE_FILE_EXPORT_HOST", "127.0.0.1")
+EXPORT_URL = os.environ.get("SECURE_FILE_EXPORT_URL")
+
 def generate_qr_code(secret, username):
+    import pyotp
+    import qrcode  # Loaded on first registration, not on every worker start
     totp = pyotp.TOTP(secret)
     uri = totp.provisioning_uri(name=username, issuer_name="SecureFileManager")
     img = qrcode.make(uri)
@@ -31,93 +75,262 @@ def registration_ui():
             st.success("Registered successfully!")
             st.info("Scan this QR code using Google Authenticator or Authy.")
             buf = generate_qr_code(secret, username)
+            from PIL import Image
             st.image(Image.open(buf))
         else:
             st.error("Username already exists!")
 
+def client_id():
+    """The browser's address, which login attempts are rate limited by (see rate_limit)."""
+    context = getattr(st, "context", None)  # Streamlit >= 1.37
+    return getattr(context, "ip_address", None)
+
 def login_ui():
     st.subheader("🔑 Login")
     username = st.text_input("Username", key="login_user")
     password = st.text_input("Password", type="password", key="login_pass")
 
     if st.button("Login"):
-        success, role, secret = login_user(username, password)
+        success, message, _ = login_user(username, password, client_id())
         if success:
-            st.session_state["temp_user"] = username
-            st.session_state["secret"] = secret
+            st.session_state["temp_user"] = username  # The TOTP secret stays server-side
             st.session_state["auth_phase"] = "2fa"
         else:
-            st.error(role)
+            st.error(message)
 
 def two_fa_ui():
     st.subheader("🔒 2FA Verification")
     otp = st.text_input("Enter 2FA Code from Authenticator App")
     if st.button("Verify"):
-        secret = st.session_state.get("secret")
         username = st.session_state.get("temp_user")
-        if verify_2fa_code(secret, otp):
+        success, message = verify_user_2fa(username, otp, client_id())
+        if success:
             st.success(f"✅ Welcome, {username}!")
-            st.session_state["logged_in"] = True
-            st.session_state["username"] = username
+            st.session_state["session_token"] = start_session(username)
             st.session_state.pop("auth_phase", None)
             st.session_state.pop("temp_user", None)
-            st.session_state.pop("secret", None)
         else:
-            st.error("Invalid 2FA code.")
+            st.error(message)
+
+def metrics_panel():
+    st.subheader("📈 Metrics")
+    enabled = st.checkbox("Collect metrics", value=metrics.ENABLED)
+    if enabled and not metrics.ENABLED:
+        metrics.enable()
+    elif not enabled and metrics.ENABLED:
+        metrics.disable()
+    tracing = st.checkbox("Keep span traces", value=metrics.TRACING, disabled=not enabled)
+    if tracing != metrics.TRACING:
+        metrics.enable(tracing=tracing)
+
+    rows = metrics.summary()
+    if rows:
+        st.dataframe(rows, use_container_width=True)
+    else:
+        st.info("No operations recorded yet.")
+    if metrics.TRACING:
+        with st.expander("Recent traces"):
+            st.json(metrics.recent_traces()[:20])
+    st.download_button("Download Prometheus text", metrics.prometheus_text(), file_name="metrics.prom")
+    if st.button("Reset metrics"):
+        metrics.reset()
+        st.rerun()
+
+def usage_panel():
+    import quota
+    st.subheader("📦 Storage Usage")
+    rows = quota.usage_report()  # One query, however many users
+    st.dataframe(rows, use_container_width=True)
+    users = [row["user"] for row in rows]
+    if not users:
+        return
+    with st.form("set_quota"):
+        user = st.selectbox("User", users)
+        max_mb = st.number_input("Max plaintext MB (0 = default)", min_value=0.0, step=10.0)
+        max_files = st.number_input("Max files (0 = default)", min_value=0, step=100)
+        if st.form_submit_button("Set quota"):
+            quota.set_quota(user, int(max_mb * 1024 * 1024) or None, int(max_files) or None)
+            st.success(f"Quota for '{user}' updated.")
+            st.rerun()
 
-def crud_dashboard():
-    username = st.session_state["username"]
+def jobs_panel():
+    import jobs
+    st.subheader("🛠️ Maintenance Jobs")
+    with st.form("submit_job"):
+        kind = st.selectbox("Job", list(jobs.KINDS))
+        users = st.text_input("Users (comma-separated, blank for all)")
+        force = st.checkbox("Re-encrypt files already on the current format")
+        st.caption("Re-encryption covers .enc files only; packed and deduplicated files are skipped.")
+        if st.form_submit_button("Queue job"):
+            names = [u.strip() for u in users.split(",") if u.strip()] or None
+            params = {"force": True} if force and kind == "reencrypt" else {}
+            st.success(f"Queued job {jobs.submit(kind, names, **params)}.")
+
+    col1, col2 = st.columns(2)
+    io_mb = col1.number_input("I/O limit (MB/s)", min_value=0.1, value=jobs.IO_RATE / 1024 / 1024)
+    cpu = col2.slider("CPU limit (share of a core)", 0.05, 1.0, float(jobs.CPU_SHARE))
+    jobs.IO_RATE, jobs.CPU_SHARE = int(io_mb * 1024 * 1024), cpu  # Workers pick these up on their next item
+
+    rows = jobs.list_jobs()
+    if not rows:
+        st.info("No jobs yet.")
+        return
+    st.dataframe([{"id": j["id"], "kind": j["kind"], "state": j["state"],
+                   "progress": f"{j['done']}/{j['total'] if j['total'] is not None else '?'}",
+                   "outcomes": (j["result"] or {}).get("counts"), "error": j["error"]} for j in rows],
+                 use_container_width=True)
+    job_id = st.selectbox("Job", [j["id"] for j in rows], key="job_id")
+    col1, col2, col3, col4 = st.columns(4)
+    if col1.button("Pause"):
+        jobs.pause(job_id)
+        st.rerun()
+    if col2.button("Resume"):
+        jobs.resume(job_id)
+        st.rerun()
+    if col3.button("Cancel"):
+        jobs.cancel(job_id)
+        st.rerun()
+    if col4.button("Refresh"):
+        st.rerun()
+    result = next(j for j in rows if j["id"] == job_id)["result"]
+    if result and result["failed"]:
+        with st.expander("Failed items"):
+            st.json(result["failed"])
+
+def export_ui(username):
+    import archive
+    fmt = st.radio("Archive format", archive.FORMATS, horizontal=True)
+    passphrase = st.text_input("Transport passphrase (optional: re-encrypts files instead of exporting plaintext)",
+                               type="password")
+    if not st.button("Prepare archive"):
+        return
+    port = int(EXPORT_PORT or archive.ARCHIVE_PORT)
+    archive.serve(port, EXPORT_HOST)  # Never built in memory, however large the folder
+    download_id = archive.prepare_download(username, fmt, passphrase or None)  # One use, a few minutes
+    st.link_button("⬇️ Download archive", f"{EXPORT_URL or f'http://localhost:{port}'}/export/{download_id}")
+
+def import_ui(username, cache):
+    import archive
+    uploaded = st.file_uploader("Archive to import", type=["tar", "zip", "tgz", "gz", "bz2", "xz"])
+    passphrase = st.text_input("Transport passphrase (if it was exported with one)", type="password")
+    if uploaded is not None and st.button("Import"):
+        try:
+            records = list(archive.import_stream(username, uploaded, passphrase or None))
+        except ValueError as e:
+            st.error(str(e))
+            return
+        cache.clear()
+        failed = [r for r in records if not r["ok"]]
+        st.success(f"Imported {len(records) - len(failed)} file(s).")
+        for r in failed:
+            st.error(f"{r['name']}: {r['error']}")
+
+def crud_dashboard(session):
+    import quota
+    import search_index
+    from file_manager import create_file, update_file, delete_file
+    storage_resources()
+    username = session.username
+    cache = session_cache()
     st.title(f"📁 Secure File Dashboard ({username})")
 
-    option = st.selectbox("Choose an Operation", ["Create File", "Read File", "Update File", "Delete File", "Logout"])
+    operations = ["Create File", "Read File", "Search Files", "Update File", "Delete File",
+                  "Export Files", "Import Files", "Logout"]
+    if session.role == "admin":
+        operations[-1:-1] = ["Metrics", "Usage", "Jobs"]
+    option = st.selectbox("Choose an Operation", operations)
 
     if option == "Create File":
         file_name = st.text_input("Enter new file name (with .txt extension)")
         content = st.text_area("Enter file content")
         if st.button("Create & Encrypt"):
-            create_file(username, file_name, content)
-            st.success(f"File '{file_name}' created and encrypted.")
+            try:
+                create_file(username, file_name, content)
+            except quota.QuotaExceededError as e:
+                st.error(f"Storage quota exceeded: {e}")
+            else:
+                cache.invalidate(username, file_name)
+                st.success(f"File '{file_name}' created and encrypted.")
 
     elif option == "Read File":
-        files = list_user_files(username)
+        files = cache.list_files(username)
         if files:
             selected = st.selectbox("Select a file", files)
             if st.button("Read"):
-                content = read_file(username, selected)
+                content = cache.read_file(username, selected)
                 st.code(content)
         else:
             st.info("No files available.")
 
+    elif option == "Search Files":
+        query = st.text_input('Search your files (words, prefix*, "exact phrase")')
+        if query:
+            results = search_index.search(username, query, limit=SEARCH_LIMIT)
+            if results:
+                for name, score in results:
+                    st.write(f"📄 {name} ({score} match{'es' if score != 1 else ''})")
+            else:
+                st.info("No matching files.")
+
     elif option == "Update File":
-        files = list_user_files(username)
+        files = cache.list_files(username)
         if files:
             selected = st.selectbox("Select a file", files)
-            content = read_file(username, selected)
+            content = cache.read_file(username, selected)
             new_content = st.text_area("Edit file content", value=content)
             if st.button("Update"):
-                update_file(username, selected, new_content)
-                st.success(f"File '{selected}' updated.")
+                try:
+                    update_file(username, selected, new_content)
+                except quota.QuotaExceededError as e:
+                    st.error(f"Storage quota exceeded: {e}")
+                else:
+                    cache.invalidate(username, selected)
+                    st.success(f"File '{selected}' updated.")
         else:
             st.info("No files to update.")
 
     elif option == "Delete File":
-        files = list_user_files(username)
+        files = cache.list_files(username)
         if files:
             selected = st.selectbox("Select a file", files)
             if st.button("Delete"):
                 delete_file(username, selected)
+                cache.invalidate(username, selected)
                 st.success(f"File '{selected}' deleted.")
         else:
             st.info("No files to delete.")
 
+    elif option == "Export Files":
+        export_ui(username)
+
+    elif option == "Import Files":
+        import_ui(username, cache)
+
+    elif option == "Metrics":
+        metrics_panel()
+
+    elif option == "Usage":
+        usage_panel()
+
+    elif option == "Jobs":
+        jobs_panel()
+
     elif option == "Logout":
+        end_session(st.session_state.get("session_token"))
+        cache.clear()
         st.session_state.clear()
         st.success("Logged out.")
 
 # 🌐 Front Page UI
 st.title("🔐 Secure File Management System")
 
-if "logged_in" not in st.session_state:
+# Resolved from memory on every rerun; see auth.resolve_session
+session = resolve_session(st.session_state.get("session_token"))
+if session is None and "session_token" in st.session_state:
+    st.session_state.clear()
+    st.warning("Your session has ended. Please log in again.")
+
+if session is None:
     choice = st.sidebar.radio("Navigation", ["Login", "Register", "Exit"])
     if choice == "Login":
         if st.session_state.get("auth_phase") == "2fa":
@@ -129,4 +342,4 @@ if "logged_in" not in st.session_state:
     elif choice == "Exit":
         st.warning("Exiting... Close the tab or choose another option.")
 else:
-    crud_dashboard()
+    crud_dashboard(session)
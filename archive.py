@@ -0,0 +1,381 @@
+import collections
+import hashlib
+import hmac
+import io
+import json
+import os
+import queue
+import secrets
+import tarfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+import catalog
+import file_manager
+import security
+
+# Whole-folder export and import. export_stream yields a tar or zip of a
+# user's files while it is being written: each file is decrypted a chunk at a
+# time straight into the archive, nothing touches the disk, and at most
+# PIPE_DEPTH pieces of about PIPE_CHUNK bytes wait for the consumer. With a
+# passphrase, files are re-encrypted for transport instead of exported as
+# plaintext: each becomes <name>.enc, a container (see security) under a key
+# derived from the passphrase, and TRANSPORT_ENTRY comes first with the KDF
+# parameters and a check value. import_stream reads either kind back,
+# storing IMPORT_WORKERS files at a time with at most IMPORT_BUFFER bytes of
+# entries read ahead of them. Entries over MAX_MEMBER_SIZE are
+# refused before they are read, and only archives using TRANSPORT_KDF are
+# accepted, so an uploaded archive cannot make the server allocate at will.
+FORMATS = ("tar", "zip")
+PIPE_CHUNK = 64 * 1024
+PIPE_DEPTH = 16
+TRANSPORT_ENTRY = "SECURE_FILE_TRANSPORT.json"
+TRANSPORT_KDF = {"ln": 15, "r": 8, "p": 1}  # scrypt, as in passwords
+IMPORT_WORKERS = min(8, (os.cpu_count() or 2) * 2)
+MAX_MEMBER_SIZE = 64 * 1024 * 1024  # bytes per archive entry, as stored in the archive
+IMPORT_BUFFER = 128 * 1024 * 1024  # bytes of entries read but not yet stored
+
+# Browsers download archives from a small HTTP server in the app process
+# (see serve), so they stream instead of being built in memory first. A
+# download is prepared by the app and can be fetched once within DOWNLOAD_TTL.
+ARCHIVE_PORT = 9465
+DOWNLOAD_TTL = 300
+CONTENT_TYPES = {"tar": "application/x-tar", "zip": "application/zip"}
+
+_downloads = {}  # id -> (username, format, passphrase, expires)
+_lock = threading.Lock()
+_server = None
+
+
+def _transport_key(passphrase, salt, params):
+    return hashlib.scrypt(passphrase.encode(), salt=salt, n=2 ** params["ln"], r=params["r"], p=params["p"],
+                          maxmem=256 * 2 ** params["ln"] * params["r"], dklen=32)
+
+
+def _check_value(key):
+    return hmac.new(key, b"secure-file transport", hashlib.sha256).hexdigest()
+
+
+def _check_name(name):
+    """Return an archive member's file name, or None if it would escape the user's folder."""
+    if name.startswith("./"):
+        name = name[2:]
+    if not name or name.startswith(".") or "/" in name or "\\" in name:
+        return None
+    return name
+
+
+class _Sink:
+    """Write end of the pipe: batches writes into PIPE_CHUNK pieces for the consumer."""
+
+    def __init__(self, put):
+        self._put = put
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= PIPE_CHUNK:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self._buffer:
+            self._put(bytes(self._buffer))
+            self._buffer.clear()
+
+
+class _Counter:
+    """Non-seekable file object that passes writes on and counts them."""
+
+    def __init__(self, dst):
+        self.dst = dst
+        self.count = 0
+
+    def write(self, data):
+        self.dst.write(data)
+        self.count += len(data)
+        return len(data)
+
+
+def _stream(write):
+    """Run write(sink) on a thread and yield what it writes, holding at most PIPE_DEPTH pieces.
+
+    Closing the generator early (e.g. a dropped download) stops the writer.
+    """
+    pieces = queue.Queue(PIPE_DEPTH)
+    abandoned = threading.Event()
+    end = object()
+
+    def put(item):
+        while not abandoned.is_set():
+            try:
+                pieces.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+        raise BrokenPipeError("The archive is no longer being read.")
+
+    def run():
+        try:
+            sink = _Sink(put)
+            write(sink)
+            sink.flush()
+            put(end)
+        except BrokenPipeError:
+            pass
+        except Exception as e:
+            try:
+                put(e)
+            except BrokenPipeError:
+                pass
+
+    threading.Thread(target=run, name="archive-writer", daemon=True).start()
+    try:
+        while True:
+            item = pieces.get()
+            if item is end:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        abandoned.set()
+
+
+def _write_content(dst, username, row, key):
+    """Write a file's plaintext, or its transport container, to dst; returns the bytes written."""
+    pieces = file_manager.iter_file(username, row["name"])
+    if key is not None:
+        dst = _Counter(dst)
+        size = security.encrypt_stream(security.IterReader(pieces), dst, key=key, compress=False)
+        written = dst.count
+    else:
+        size = 0
+        for piece in pieces:
+            dst.write(piece)
+            size += len(piece)
+        written = size
+    if size != row["size"]:
+        raise ValueError(f"'{row['name']}' changed during the export; export again.")
+    return written
+
+
+def _entry(row, key):
+    """Return (archive name, archive size) for a catalog row."""
+    if key is None:
+        return row["name"], row["size"]
+    return row["name"] + ".enc", security.stream_size(row["size"])
+
+
+def _write_tar(sink, username, key, transport):
+    """Write a ustar/pax archive by hand, so every size is declared before its data."""
+    def header(name, size, mtime):
+        info = tarfile.TarInfo(name)
+        info.size, info.mtime, info.mode = size, int(mtime), 0o600
+        sink.write(info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape"))
+
+    if transport is not None:
+        header(TRANSPORT_ENTRY, len(transport), time.time())
+        sink.write(transport + bytes(-len(transport) % tarfile.BLOCKSIZE))
+    for row in catalog.list_files(username):
+        name, size = _entry(row, key)
+        header(name, size, row["modified_at"])
+        _write_content(sink, username, row, key)
+        sink.write(bytes(-size % tarfile.BLOCKSIZE))
+    sink.write(bytes(2 * tarfile.BLOCKSIZE))  # End-of-archive marker
+
+
+def _write_zip(sink, username, key, transport):
+    """Write a zip; zipfile uses data descriptors since the sink cannot seek."""
+    with zipfile.ZipFile(sink, "w") as zf:
+        if transport is not None:
+            zf.writestr(TRANSPORT_ENTRY, transport)
+        for row in catalog.list_files(username):
+            name, size = _entry(row, key)
+            info = zipfile.ZipInfo(name, time.localtime(row["modified_at"])[:6])
+            info.compress_type = zipfile.ZIP_STORED if key is not None else zipfile.ZIP_DEFLATED
+            info.file_size = size  # Lets zipfile pick zip64 only where needed
+            with zf.open(info, "w") as dst:
+                _write_content(dst, username, row, key)
+
+
+def export_stream(username, fmt="tar", passphrase=None):
+    """Yield a tar or zip of all of a user's files, piece by piece.
+
+    Without a passphrase the archive holds the plaintext; with one, each file
+    is re-encrypted for transport (see import_stream).
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown archive format {fmt!r}; choose one of {', '.join(FORMATS)}.")
+    key = transport = None
+    if passphrase:
+        salt = os.urandom(16)
+        key = _transport_key(passphrase, salt, TRANSPORT_KDF)
+        transport = json.dumps({"version": 1, "kdf": "scrypt", "params": TRANSPORT_KDF,
+                                "salt": salt.hex(), "check": _check_value(key)}).encode()
+    writer = _write_tar if fmt == "tar" else _write_zip
+    return _stream(lambda sink: writer(sink, username, key, transport))
+
+
+class _Prefixed:
+    """Readable stream of prefix followed by the rest of src."""
+
+    def __init__(self, prefix, src):
+        self._prefix = prefix
+        self._src = src
+
+    def read(self, size=-1):
+        if not self._prefix:
+            return self._src.read(size)
+        if size < 0:
+            data, self._prefix = self._prefix + self._src.read(), b""
+            return data
+        data, self._prefix = self._prefix[:size], self._prefix[size:]
+        return data if len(data) == size else data + self._src.read(size - len(data))
+
+
+def _members(src):
+    """Yield (name, data) for each regular file of a tar (plain or compressed) or zip stream.
+
+    data is None for entries over MAX_MEMBER_SIZE, which are skipped unread.
+    """
+    head = src.read(4)
+    if head.startswith(b"PK\x03\x04"):
+        if not getattr(src, "seekable", lambda: False)():
+            raise ValueError("Zip archives can only be imported from a file; stream a tar instead.")
+        src.seek(-len(head), io.SEEK_CUR)
+        with zipfile.ZipFile(src) as zf:
+            for info in zf.infolist():
+                if not info.is_dir():
+                    # zipfile stops at file_size and fails the CRC if the entry holds more
+                    yield info.filename, zf.read(info) if info.file_size <= MAX_MEMBER_SIZE else None
+        return
+    with tarfile.open(fileobj=_Prefixed(head, src), mode="r|*") as tf:
+        for member in tf:
+            if member.isfile():
+                yield member.name, tf.extractfile(member).read() if member.size <= MAX_MEMBER_SIZE else None
+
+
+def _store(username, name, data, key):
+    """Store one archive member as the user's file; returns its result record."""
+    record = {"name": name}
+    try:
+        if key is not None:
+            if not name.endswith(".enc"):
+                raise ValueError("Not encrypted for transport.")
+            name = record["name"] = name[:-len(".enc")]
+            data = b"".join(security.iter_decrypt(io.BytesIO(data), key))
+        content = data.decode("utf-8")
+        if file_manager.stored_path(username, name):
+            file_manager.update_file(username, name, content)
+            record["action"] = "updated"
+        else:
+            file_manager.create_file(username, name, content)
+            record["action"] = "created"
+        record.update(ok=True, bytes=len(data))
+    except UnicodeDecodeError:
+        record.update(ok=False, error="Not UTF-8 text.")
+    except Exception as e:  # One bad entry must not stop the rest
+        record.update(ok=False, error=str(e))
+    return record
+
+
+def import_stream(username, src, passphrase=None, workers=IMPORT_WORKERS):
+    """Store every file of a tar or zip read from src as the user's, yielding a record per entry.
+
+    Entries are read in order and stored on a pool of workers threads, with
+    at most two per worker and IMPORT_BUFFER bytes in all read ahead (plus the
+    entry being read). A transport-encrypted archive needs
+    the passphrase it was exported with; a wrong one is refused up front.
+    """
+    key = None
+    pending = collections.deque()  # (future, entry size)
+    queued = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="archive-import") as pool:
+        for number, (member, data) in enumerate(_members(src)):
+            if number == 0 and member == TRANSPORT_ENTRY:
+                transport = json.loads(data or b"{}")
+                if not passphrase:
+                    raise ValueError("This archive is encrypted for transport; a passphrase is needed.")
+                if transport.get("kdf") != "scrypt" or transport.get("params") != TRANSPORT_KDF:
+                    raise ValueError("This archive uses unsupported transport key parameters.")
+                key = _transport_key(passphrase, bytes.fromhex(transport["salt"]), transport["params"])
+                if not hmac.compare_digest(_check_value(key), transport["check"]):
+                    raise ValueError("Wrong passphrase for this archive.")
+                continue
+            name = _check_name(member)
+            if name is None:
+                yield {"name": member, "ok": False, "error": "Invalid file name."}
+                continue
+            if data is None:
+                yield {"name": member, "ok": False, "error": f"Larger than {MAX_MEMBER_SIZE} bytes."}
+                continue
+            pending.append((pool.submit(_store, username, name, data, key), len(data)))
+            queued += len(data)
+            while pending and (len(pending) >= workers * 2 or queued > IMPORT_BUFFER):
+                future, size = pending.popleft()
+                queued -= size
+                yield future.result()
+        while pending:
+            yield pending.popleft()[0].result()
+
+
+# --- downloads ---
+def prepare_download(username, fmt="tar", passphrase=None):
+    """Register an export for one download from the archive server; returns its id."""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown archive format {fmt!r}; choose one of {', '.join(FORMATS)}.")
+    download_id = secrets.token_urlsafe(24)
+    now = time.time()
+    with _lock:
+        for stale in [d for d, entry in _downloads.items() if entry[3] < now]:
+            del _downloads[stale]
+        _downloads[download_id] = (username, fmt, passphrase, now + DOWNLOAD_TTL)
+    return download_id
+
+
+def _take_download(download_id):
+    with _lock:
+        entry = _downloads.pop(download_id, None)
+    return entry if entry and entry[3] >= time.time() else None
+
+
+def _handler_class():
+    import http.server  # Only loaded when serving
+
+    class ArchiveHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            parts = self.path.split("?")[0].strip("/").split("/")
+            entry = _take_download(parts[1]) if len(parts) == 2 and parts[0] == "export" else None
+            if entry is None:
+                self.send_error(404)
+                return
+            username, fmt, passphrase, _ = entry
+            suffix = ".enc" if passphrase else ""
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPES[fmt])
+            self.send_header("Content-Disposition", f'attachment; filename="{username}{suffix}.{fmt}"')
+            self.end_headers()  # No length: the body ends when the connection closes
+            try:
+                for piece in export_stream(username, fmt, passphrase):
+                    self.wfile.write(piece)
+            except Exception as e:
+                print(f"❌ Export for '{username}' failed: {e}")
+
+        def log_message(self, *args):
+            pass
+
+    return http.server.ThreadingHTTPServer, ArchiveHandler
+
+
+def serve(port=ARCHIVE_PORT, host="127.0.0.1"):
+    """Serve prepared downloads at /export/<id> from a daemon thread, once per process."""
+    global _server
+    with _lock:
+        if _server is None:
+            server_class, handler_class = _handler_class()
+            _server = server_class((host, port), handler_class)
+            threading.Thread(target=_server.serve_forever, name="archive-http", daemon=True).start()
+            print(f"📦 Archive downloads served at http://{host}:{_server.server_port}/export/")
+    return _server
@@ -0,0 +1,86 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+import catalog
+import file_manager
+import security
+
+# Disk I/O and AES both release the GIL (pycryptodome calls into C through
+# ctypes), so a thread pool lets operations on different files overlap.
+MAX_WORKERS = min(32, (os.cpu_count() or 2) * 4)
+MAX_IN_FLIGHT = MAX_WORKERS * 2  # operations admitted before callers have to wait
+
+
+class AsyncFileManager:
+    """asyncio front end for file_manager and security.
+
+    Blocking work runs on a thread pool. Operations on the same file are
+    serialized by a per-file lock, operations on different files run in
+    parallel, and at most max_in_flight operations are admitted at once so
+    a burst of requests queues up instead of piling onto the pool.
+    """
+
+    def __init__(self, max_workers=MAX_WORKERS, max_in_flight=MAX_IN_FLIGHT):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="aio-file")
+        self._admission = asyncio.Semaphore(max_in_flight)
+        self._locks = {}  # (username, name) -> [lock, users]
+
+    async def _run(self, fn, *args):
+        async with self._admission:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, fn, *args)
+
+    async def _run_locked(self, username, file_name, fn, *args):
+        key = (username, catalog.logical_name(file_name))
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await self._run(fn, *args)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]  # Keep the table as small as the set of busy files
+
+    async def create_file(self, username, file_name, content):
+        return await self._run_locked(username, file_name, file_manager.create_file,
+                                      username, file_name, content)
+
+    async def read_file(self, username, file_name):
+        return await self._run_locked(username, file_name, file_manager.read_file, username, file_name)
+
+    async def update_file(self, username, file_name, new_content):
+        return await self._run_locked(username, file_name, file_manager.update_file,
+                                      username, file_name, new_content)
+
+    async def edit_file(self, username, file_name, content, offset=None):
+        return await self._run_locked(username, file_name, file_manager.edit_file,
+                                      username, file_name, content, offset)
+
+    async def delete_file(self, username, file_name):
+        return await self._run_locked(username, file_name, file_manager.delete_file, username, file_name)
+
+    async def list_user_files(self, username):
+        return await self._run(file_manager.list_user_files, username)
+
+    async def read_range(self, username, file_name, offset=0, size=None):
+        """Decrypt a byte range of a user's file, in whichever backend it is stored."""
+        return await self._run_locked(username, file_name, file_manager.read_range,
+                                      username, file_name, offset, size)
+
+    async def encrypt_bytes(self, enc_path, data, owner=None):
+        """Encrypt data into enc_path on the pool."""
+        return await self._run(security.write_encrypted, enc_path, data, None, owner)
+
+    async def decrypt_bytes(self, enc_path):
+        """Decrypt enc_path into memory on the pool."""
+        return await self._run(security.read_encrypted, enc_path)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
@@ -1,56 +1,75 @@
-import sqlite3
+import base64
 import hashlib
-import pyotp
-import qrcode
-
-DB_NAME = "secure_file_manager.db"
+import hmac
+import json
+import secrets
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+import key_manager
+import metrics
+import passwords
+import rate_limit
+import user_store
+from db import DB_NAME
+
+ROLES = ("user", "admin")
+CONSOLE_CLIENT = "console"  # client key for logins typed at this machine
 
 def initialize_db():
-    """Initialize the user database with 2FA support."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''CREATE TABLE IF NOT EXISTS users (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        username TEXT UNIQUE,
-                        password_hash TEXT,
-                        role TEXT DEFAULT 'user',
-                        totp_secret TEXT)''')
-    conn.commit()
-    conn.close()
-
-initialize_db()
+    """Initialize the user database with 2FA support (also done on first use)."""
+    user_store.initialize()
 
+@metrics.instrument("auth.hash_password")
 def hash_password(password):
-    """Generate SHA256 hash for the password."""
-    return hashlib.sha256(password.encode()).hexdigest()
+    """Hash the password with the configured salted KDF (on the worker pool)."""
+    return passwords.hash_password_async(password).result()
+
+@metrics.instrument("auth.check_password")
+def check_password(username, password, stored_hash):
+    """Verify a password on the worker pool, upgrading outdated hashes on success.
+
+    stored_hash None (no such user) is checked against passwords.dummy_hash
+    instead, so it takes as long as a wrong password for a real account.
+    """
+    if stored_hash is None:
+        passwords.verify_password_async(password, passwords.dummy_hash()).result()
+        return False
+    matches, needs_rehash = passwords.verify_password_async(password, stored_hash).result()
+    if matches and needs_rehash:
+        user_store.set_password_hash(username, hash_password(password))
+    return matches
 
 def validate_username(username):
-    """Check if the username meets minimum requirements."""
-    return len(username) >= 3
+    """Check if the username meets minimum requirements (it also names the user's folders and keys)."""
+    if len(username) < 3:
+        return False
+    try:
+        key_manager.check_owner(username)
+    except ValueError:
+        return False
+    return True
 
 def validate_password(password):
     """Ensure password meets security standards."""
     return len(password) >= 6
 
+@metrics.instrument("auth.register")
 def register(username, password, role='user'):
     """Register a user and generate a unique 2FA secret key."""
+    import pyotp
+    import qrcode  # Heavy; only needed when a QR code is shown
     if not validate_username(username):
-        print("❌ Username must be at least 3 characters long.")
+        print("❌ Username must be at least 3 characters long, without '/' or '\\'.")
         return
     if not validate_password(password):
         print("❌ Password must be at least 6 characters long.")
         return
 
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-
     secret = pyotp.random_base32() 
     try:
-        cursor.execute(
-            'INSERT INTO users (username, password_hash, role, totp_secret) VALUES (?, ?, ?, ?)',
-            (username, hash_password(password), role, secret)
-        )
-        conn.commit()
+        user_store.create_user(username, hash_password(password), role, secret)
         print(f'✅ User "{username}" registered successfully!')
 
         totp = pyotp.TOTP(secret)
@@ -62,65 +81,78 @@ def register(username, password, role='user'):
 
     except sqlite3.IntegrityError:
         print(f'❌ Username "{username}" already exists.')
-    finally:
-        conn.close()
 
-def login(username, password):
+def _throttled(username, client):
+    """Return a refusal message if the attempt is over the rate limit, else None."""
+    wait = rate_limit.check_login(username, client)
+    return f"Too many login attempts. Try again in {wait} s." if wait else None
+
+@metrics.instrument("auth.login")
+def login(username, password, client=CONSOLE_CLIENT):
     """Authenticate user with password and 2FA."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('SELECT password_hash, role, totp_secret FROM users WHERE username = ?', (username,))
-    result = cursor.fetchone()
-    conn.close()
+    import pyotp
+    refusal = _throttled(username, client)
+    if refusal:
+        print(f"❌ {refusal}")
+        return None
+    result = user_store.get_credentials(username)
 
-    if result and result[0] == hash_password(password):
+    if check_password(username, password, result[0] if result else None):
         totp_secret = result[2]
         totp = pyotp.TOTP(totp_secret)
         otp = input("🔑 Enter 2FA Code from Authenticator App: ").strip()
 
         if totp.verify(otp):
+            rate_limit.record_success(username, client)
             print(f'✅ Login successful! Role: {result[1]}')
             return result[1]  # Return user role ('admin' or 'user')
         else:
+            rate_limit.record_failure(username, client)
             print('❌ Invalid 2FA code.')
             return None
     else:
+        rate_limit.record_failure(username, client)
         print('❌ Invalid username or password.')
         return None
 
 def get_user_role(username):
-    """Retrieve the role of a user."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('SELECT role FROM users WHERE username = ?', (username,))
-    result = cursor.fetchone()
-    conn.close()
-    return result[0] if result else None
-
+    """Retrieve the role of a user (from the in-process record cache)."""
+    return user_store.get_role(username)
+
+@metrics.instrument("auth.set_user_role")
+def set_user_role(username, role):
+    """Change a user's role (Admin only). Open sessions pick it up on their next rerun."""
+    if role not in ROLES:
+        print(f"❌ Unknown role '{role}'.")
+        return False
+    if not user_store.set_role(username, role):
+        print(f'❌ User "{username}" not found.')
+        return False
+    print(f'✅ "{username}" is now {role}.')
+    return True
+
+@metrics.instrument("auth.list_users")
 def list_users():
-    """List all registered users (Admin only)."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('SELECT username, role FROM users')
-    users = cursor.fetchall()
-    conn.close()
+    """List all registered users and their storage use (Admin only)."""
+    import quota  # Pulls in the storage modules, which login does not need
+    users = quota.usage_report()
 
     print("\n📋 Registered Users:")
     if users:
-        for user, role in users:
-            print(f"  - {user} ({role})")
+        for u in users:
+            limit = f" of {u['max_bytes']}" if u["max_bytes"] is not None else ""
+            print(f"  - {u['user']} ({u['role']}): {u['files']} files, {u['logical_bytes']}{limit} bytes")
     else:
         print("No users found.")
 
+@metrics.instrument("auth.reset_2fa")
 def reset_2fa(username):
     """Reset 2FA secret for a user."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-
+    import pyotp
+    import qrcode
     new_secret = pyotp.random_base32()
-    cursor.execute('UPDATE users SET totp_secret = ? WHERE username = ?', (new_secret, username))
-    conn.commit()
-    conn.close()
+    user_store.set_totp_secret(username, new_secret)
+    end_user_sessions(username)  # A reset 2FA usually means the old one is not trusted
 
     print(f'🔄 2FA reset for "{username}". Scan the new QR code in your Authenticator app.')
 
@@ -155,55 +187,166 @@ if __name__ == "__main__":
 
 # === STREAMLIT-COMPATIBLE FUNCTIONS ===
 
+@metrics.instrument("auth.register_user")
 def register_user(username, password):
     """Register a user for Streamlit and return (success, message, secret or None)"""
+    import pyotp
     if not validate_username(username):
-        return False, "Username must be at least 3 characters long.", None
+        return False, "Username must be at least 3 characters long, without '/' or '\\'.", None
     if not validate_password(password):
         return False, "Password must be at least 6 characters long.", None
 
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
     secret = pyotp.random_base32()
 
     try:
-        cursor.execute(
-            'INSERT INTO users (username, password_hash, role, totp_secret) VALUES (?, ?, ?, ?)',
-            (username, hash_password(password), 'user', secret)
-        )
-        conn.commit()
+        user_store.create_user(username, hash_password(password), 'user', secret)
         return True, "User registered successfully.", secret
     except sqlite3.IntegrityError:
         return False, "Username already exists.", None
-    finally:
-        conn.close()
 
 
-def login_user(username, password):
+@metrics.instrument("auth.login_user")
+def login_user(username, password, client=None):
     """Login function for Streamlit. Returns (success, role or message, secret)"""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('SELECT password_hash, role, totp_secret FROM users WHERE username = ?', (username,))
-    result = cursor.fetchone()
-    conn.close()
+    refusal = _throttled(username, client)
+    if refusal:
+        return False, refusal, None  # Refused before any hashing or database access
+    result = user_store.get_credentials(username)
 
-    if result and result[0] == hash_password(password):
+    if check_password(username, password, result[0] if result else None):
         return True, result[1], result[2]  # (success, role, secret)
     else:
+        rate_limit.record_failure(username, client)
         return False, "Invalid credentials", None
 
 
+@metrics.instrument("auth.verify_2fa_code")
 def verify_2fa_code(secret, otp):
     """Verify the TOTP 2FA code for Streamlit."""
+    import pyotp
     totp = pyotp.TOTP(secret)
     return totp.verify(otp)
 
+@metrics.instrument("auth.verify_user_2fa")
+def verify_user_2fa(username, otp, client=None):
+    """Second login step for Streamlit, rate limited like the first. Returns (success, message)."""
+    refusal = _throttled(username, client)
+    if refusal:
+        return False, refusal
+    secret = user_store.get_totp_secret(username)
+    if secret and verify_2fa_code(secret, otp):
+        rate_limit.record_success(username, client)
+        return True, None
+    rate_limit.record_failure(username, client)
+    return False, "Invalid 2FA code."
+
+@metrics.instrument("auth.get_user_secret")
 def get_user_secret(username):
-    """Retrieve the TOTP secret for a given user."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('SELECT totp_secret FROM users WHERE username = ?', (username,))
-    result = cursor.fetchone()
-    conn.close()
-    return result[0] if result else None
+    """Retrieve the TOTP secret for a given user (from the in-process record cache)."""
+    return user_store.get_totp_secret(username)
+
+# === TOKENS FOR NON-INTERACTIVE CLIENTS ===
+
+TOKEN_TTL = 12 * 3600  # seconds
+CLI_TOKEN = "cli"
+SESSION_TOKEN = "session"
 
+def authenticate(username, password, otp, client=CONSOLE_CLIENT):
+    """Check a password and a 2FA code without prompting. Returns the role or None."""
+    success, role, secret = login_user(username, password, client)
+    if not success:
+        return None
+    if verify_2fa_code(secret, otp):
+        rate_limit.record_success(username, client)
+        return role
+    rate_limit.record_failure(username, client)
+    return None
+
+def _sign(payload):
+    digest = hmac.new(key_manager.token_key(), payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).decode().rstrip("=")
+
+def issue_token(username, ttl=TOKEN_TTL, typ=CLI_TOKEN):
+    """Return a signed token identifying username until it expires.
+
+    typ says what the token is for, so a dashboard session token cannot be
+    used as a CLI token and the other way round.
+    """
+    now = time.time()
+    claims = json.dumps({"u": username, "typ": typ, "iat": round(now, 3), "exp": int(now) + ttl,
+                         "n": secrets.token_urlsafe(8)},  # Two logins in one millisecond still differ
+                        separators=(",", ":"))
+    payload = base64.urlsafe_b64encode(claims.encode()).decode().rstrip("=")
+    return f"{payload}.{_sign(payload)}"
+
+def token_claims(token):
+    """Return a token's claims, or None if it is forged or expired."""
+    payload, _, signature = (token or "").strip().partition(".")
+    if not payload or not hmac.compare_digest(signature, _sign(payload)):
+        return None
+    try:
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+    except ValueError:
+        return None
+    if claims.get("exp", 0) < time.time():
+        return None
+    return claims
+
+def verify_token(token):
+    """Return the username a CLI token was issued to, or None if it is forged, expired or ended."""
+    claims = token_claims(token)
+    if claims is None or claims.get("typ") != CLI_TOKEN:
+        return None
+    username = claims.get("u")
+    sessions_after = user_store.get_sessions_after(username)
+    if sessions_after is None or claims.get("iat", 0) < sessions_after:
+        return None  # No such user, or end_user_sessions ran after it was issued
+    return username
+
+# === SESSIONS FOR THE DASHBOARD ===
+
+# The dashboard keeps only a session token in st.session_state. Resolving it
+# on each rerun checks the signature in memory and takes the role and the
+# user's sessions_after time from user_store's record cache, so a logged-in
+# page view needs no database query. Single logouts are remembered in this
+# process (the Streamlit server) until the token would have expired anyway;
+# end_user_sessions is stored with the user, so it also voids CLI tokens and
+# reaches other processes (within user_store.USER_CACHE_TTL for sessions).
+SESSION_TTL = 8 * 3600  # seconds
+Session = namedtuple("Session", ["username", "role", "expires"])
+
+_ended = {}  # token -> expiry, for sessions logged out early
+_sessions_lock = threading.Lock()
+
+def start_session(username, ttl=SESSION_TTL):
+    """Issue a session token for a user who passed both login steps."""
+    return issue_token(username, ttl, SESSION_TOKEN)
+
+def resolve_session(token):
+    """Return the Session a token stands for, or None if it is invalid, expired or ended."""
+    claims = token_claims(token)
+    if claims is None or claims.get("typ") != SESSION_TOKEN or token in _ended:
+        return None
+    username = claims.get("u")
+    record = user_store.get_record(username)
+    if record is None:
+        return None  # The user no longer exists
+    role, _, sessions_after = record
+    if claims.get("iat", 0) < (sessions_after or 0):
+        return None
+    return Session(username, role, claims["exp"])
+
+def end_session(token):
+    """Log a session out before its token expires."""
+    claims = token_claims(token)
+    if claims is None:
+        return
+    now = time.time()
+    with _sessions_lock:
+        for old in [t for t, exp in _ended.items() if exp < now]:
+            del _ended[old]
+        _ended[token] = claims["exp"]
+
+def end_user_sessions(username):
+    """End every session and CLI token of a user issued up to now."""
+    user_store.end_sessions(username, round(time.time(), 3))
@@ -0,0 +1,98 @@
+"""Streaming archive export and parallel import: throughput and peak memory.
+
+Exports a user's folder of --files files (--file-mb each) as a tar through
+archive.export_stream, discarding the pieces as a download would, and
+compares its peak Python memory with building the same tar in memory from
+read_file. Then imports the archive into a fresh user with 1 and with
+--workers import threads.
+
+Run from the repository root:
+    python benchmarks/bench_archive.py [--files 20] [--file-mb 8] [--workers 4] [--json]
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import tarfile
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def measure(fn):
+    """Return (seconds, peak MB of Python allocations) for fn()."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return round(elapsed, 3), round(peak / 1e6, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--file-mb", type=float, default=8)
+    parser.add_argument("--workers", type=int, default=4, help="import threads for the parallel run")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)  # Keys, database and files stay inside the temp dir
+        import archive
+        import catalog
+        import file_manager
+
+        size = int(args.file_mb * 1024 * 1024)
+        for i in range(args.files):
+            file_manager.create_file("alice", f"file{i}.txt", os.urandom(size // 2).hex())
+        total_mb = args.files * size / 1e6
+
+        def streamed():
+            for _ in archive.export_stream("alice", "tar"):
+                pass
+
+        def buffered():
+            out = io.BytesIO()
+            with tarfile.open(fileobj=out, mode="w") as tf:
+                for name in catalog.list_names("alice"):
+                    data = file_manager.read_file("alice", name).encode()
+                    info = tarfile.TarInfo(name)
+                    info.size = len(data)
+                    tf.addfile(info, io.BytesIO(data))
+            return out.getvalue()
+
+        stream_s, stream_peak = measure(streamed)
+        buffer_s, buffer_peak = measure(buffered)
+        data = b"".join(archive.export_stream("alice", "tar"))
+
+        imports = {}
+        for workers in (1, args.workers):
+            start = time.perf_counter()
+            records = list(archive.import_stream(f"copy{workers}", io.BytesIO(data), workers=workers))
+            imports[workers] = round(time.perf_counter() - start, 3)
+            assert all(r["ok"] for r in records)
+
+    results = {"files": args.files, "total_mb": round(total_mb, 1),
+               "export_streamed": {"seconds": stream_s, "peak_mb": stream_peak,
+                                   "mb_per_s": round(total_mb / stream_s, 1)},
+               "export_buffered": {"seconds": buffer_s, "peak_mb": buffer_peak,
+                                   "mb_per_s": round(total_mb / buffer_s, 1)},
+               "import_seconds": {str(w): s for w, s in imports.items()}}
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{args.files} files, {results['total_mb']} MB")
+    for kind in ("export_streamed", "export_buffered"):
+        r = results[kind]
+        print(f"{kind:>16}: {r['seconds']} s ({r['mb_per_s']} MB/s), peak {r['peak_mb']} MB")
+    for workers, seconds in imports.items():
+        print(f"{'import':>16}: {seconds} s with {workers} worker(s)")
+
+
+if __name__ == "__main__":
+    main()
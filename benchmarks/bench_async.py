@@ -0,0 +1,85 @@
+"""Aggregate throughput of async_file_manager as the number of concurrent tasks grows.
+
+Run from the repository root:
+    python benchmarks/bench_async.py [--files 200] [--size-kb 256] [--json]
+"""
+import argparse
+import asyncio
+import base64
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+async def _round(manager, username, names, content, concurrency):
+    """Write then read every file with `concurrency` tasks; returns MB/s."""
+    queue = asyncio.Queue()
+    for name in names:
+        queue.put_nowait(name)
+
+    async def worker():
+        while not queue.empty():
+            name = queue.get_nowait()
+            await manager.update_file(username, name, content)
+            await manager.read_file(username, name)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return 2 * len(names) * len(content.encode()) / elapsed / 1e6
+
+
+async def run(files, size, levels):
+    import file_manager
+    from async_file_manager import AsyncFileManager
+
+    # Random ASCII, size bytes once encoded; .enc files are stored uncompressed
+    # (see security.encrypt_stream), so every byte goes through the cipher
+    content = base64.b64encode(os.urandom(size))[:size].decode()
+    names = [f"bench{i}.txt" for i in range(files)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        for name in names:
+            file_manager.create_file("bench", name, content)
+
+    results = []
+    async with AsyncFileManager() as manager:
+        for concurrency in levels:
+            with contextlib.redirect_stdout(io.StringIO()):
+                rate = await _round(manager, "bench", names, content, concurrency)
+            results.append({"concurrency": concurrency, "mb_per_s": round(rate, 1)})
+    base = results[0]["mb_per_s"]
+    for r in results:
+        r["speedup"] = round(r["mb_per_s"] / base, 2)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--size-kb", type=int, default=256)
+    parser.add_argument("--levels", default="1,2,4,8,16", help="comma-separated task counts")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)  # Isolated keys, database and secure_files
+        levels = [int(n) for n in args.levels.split(",")]
+        results = asyncio.run(run(args.files, args.size_kb * 1024, levels))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{os.cpu_count()} CPU(s); scaling flattens once every core is busy")
+    print(f"{'tasks':>6}{'MB/s':>10}{'speedup':>9}")
+    for r in results:
+        print(f"{r['concurrency']:>6}{r['mb_per_s']:>10}{r['speedup']:>8}x")
+
+
+if __name__ == "__main__":
+    main()
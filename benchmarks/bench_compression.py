@@ -0,0 +1,132 @@
+"""Bytes saved vs. CPU cost of the compression stage on a mixed corpus.
+
+Run from the repository root:
+    python benchmarks/bench_compression.py [--size-mb 8] [--json]
+"""
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WORDS = ("secure file manager encrypt decrypt user admin report budget meeting "
+         "notes draft final review update backup archive project invoice").split()
+
+
+def _text(size, rng):
+    out = []
+    total = 0
+    while total < size:
+        line = " ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 15))) + ".\n"
+        out.append(line)
+        total += len(line)
+    return "".join(out).encode()[:size]
+
+
+def _json_records(size, rng):
+    out = []
+    total = 0
+    while total < size:
+        record = json.dumps({"id": rng.randint(1, 10 ** 6), "user": rng.choice(WORDS),
+                             "amount": round(rng.random() * 1000, 2), "tags": rng.sample(WORDS, 3)})
+        out.append(record)
+        total += len(record) + 1
+    return "\n".join(out).encode()[:size]
+
+
+def _log_lines(size, rng):
+    out = []
+    total = 0
+    while total < size:
+        line = (f"2024-01-{rng.randint(1, 28):02d}T{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:00 "
+                f"INFO user={rng.choice(WORDS)} op={rng.choice(WORDS)} ms={rng.randint(1, 900)}\n")
+        out.append(line)
+        total += len(line)
+    return "".join(out).encode()[:size]
+
+
+def build_corpus(size):
+    """Mixed corpus: compressible documents plus already-compressed or random data."""
+    rng = random.Random(42)
+    part = size // 6
+    return {
+        "text": _text(part, rng),
+        "json": _json_records(part, rng),
+        "logs": _log_lines(part, rng),
+        "archive": zlib.compress(_text(part * 4, rng), 9)[:part],  # stands in for .zip/.gz
+        "image": os.urandom(part),                                  # stands in for .jpg/.png
+        "random": os.urandom(part),
+    }
+
+
+def run(size, configs):
+    import compression
+    import security
+
+    corpus = build_corpus(size)
+    plain_total = sum(len(d) for d in corpus.values())
+    results = []
+    for name, compress in configs:
+        stored = 0
+        encrypt_s = decrypt_s = 0.0
+        skipped = 0
+        for data in corpus.values():
+            out = io.BytesIO()
+            start = time.perf_counter()
+            security.encrypt_stream(io.BytesIO(data), out, owner="bench", compress=compress)
+            encrypt_s += time.perf_counter() - start
+            stored += len(out.getvalue())
+            out.seek(0)
+            layout = security._read_header(out)[1]
+            skipped += compress is not False and layout.codec == compression.NONE
+            out.seek(0)
+            start = time.perf_counter()
+            for _ in security.iter_decrypt(out):
+                pass
+            decrypt_s += time.perf_counter() - start
+        results.append({
+            "config": name,
+            "plain_bytes": plain_total,
+            "stored_bytes": stored,
+            "saved_pct": round(100 * (1 - stored / plain_total), 1),
+            "encrypt_mb_s": round(plain_total / encrypt_s / 1e6, 1),
+            "decrypt_mb_s": round(plain_total / decrypt_s / 1e6, 1),
+            "cpu_s": round(encrypt_s + decrypt_s, 3),
+            "sniff_skipped": skipped,
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=float, default=8, help="corpus size (default: %(default)s)")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)  # Keep key material and user keys out of the working tree
+        import compression
+
+        configs = [("none", False), ("zlib:1", ("zlib", 1)), ("zlib:6", ("zlib", 6)),
+                   ("zlib:9", ("zlib", 9)), ("lzma:1", ("lzma", 1)), ("lzma:6", ("lzma", 6))]
+        if "zstd" in compression.available_codecs():
+            configs += [("zstd:3", ("zstd", 3)), ("zstd:19", ("zstd", 19))]
+        results = run(int(args.size_mb * 1e6), configs)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'config':<9}{'stored MB':>11}{'saved':>8}{'enc MB/s':>10}{'dec MB/s':>10}{'cpu s':>8}{'skipped':>9}")
+    for r in results:
+        print(f"{r['config']:<9}{r['stored_bytes'] / 1e6:>11.2f}{r['saved_pct']:>7}%"
+              f"{r['encrypt_mb_s']:>10}{r['decrypt_mb_s']:>10}{r['cpu_s']:>8}{r['sniff_skipped']:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Durable writes per second with and without group commit.
+
+Concurrent writers replace small files through durable.atomic_write. With
+group commit they share flushes; without it, every write pays its own fsyncs.
+The plain (not crash-safe) open/write/close rate is shown for reference.
+
+Run from the repository root:
+    python benchmarks/bench_durable.py [--writers 1,8,32] [--writes 400] [--size-kb 4] [--json]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _plain_write(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def run_mode(mode, writers, writes, data):
+    import durable
+
+    if mode == "plain":
+        write = _plain_write
+    else:
+        group = mode == "group"
+        def write(path, payload):
+            durable.write_bytes(path, payload, group_commit=group)
+
+    per_writer = max(1, writes // writers)
+    os.makedirs(os.path.join("secure_files", mode), exist_ok=True)
+
+    def worker(n):
+        for i in range(per_writer):
+            write(os.path.join("secure_files", mode, f"w{n}-{i % 16}"), data)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(writers)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return round(per_writer * writers / elapsed, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--writers", default="1,8,32", help="comma-separated writer thread counts")
+    parser.add_argument("--writes", type=int, default=400, help="writes per mode and writer count")
+    parser.add_argument("--size-kb", type=float, default=4)
+    parser.add_argument("--dir", help="directory on the filesystem to test (default: a temp dir)")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    data = os.urandom(int(args.size_kb * 1024))
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        os.chdir(tmp)  # The journal and test files stay inside the temp dir
+        for writers in (int(n) for n in args.writers.split(",")):
+            row = {"writers": writers}
+            for mode in ("plain", "per_file", "group"):
+                row[f"{mode}_writes_per_s"] = run_mode(mode, writers, args.writes, data)
+            row["group_speedup"] = round(row["group_writes_per_s"] / row["per_file_writes_per_s"], 2)
+            results.append(row)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'writers':>8}{'plain/s':>11}{'fsync each/s':>14}{'group/s':>11}{'speedup':>9}")
+    for r in results:
+        print(f"{r['writers']:>8}{r['plain_writes_per_s']:>11}{r['per_file_writes_per_s']:>14}"
+              f"{r['group_writes_per_s']:>11}{r['group_speedup']:>8}x")
+
+
+if __name__ == "__main__":
+    main()
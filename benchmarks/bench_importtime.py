@@ -0,0 +1,114 @@
+"""Cold-start import time of the entry points, measured with python -X importtime.
+
+Each entry point is imported in a fresh interpreter inside an empty temporary
+directory. Besides the time, the run records any file the import created,
+because importing must not touch the disk. --baseline compares against a
+saved run and exits non-zero when an entry point got slower by more than
+--threshold or started creating files.
+
+Run from the repository root:
+    python benchmarks/bench_importtime.py [--repeat 5] [--out importtime.json]
+    python benchmarks/bench_importtime.py --baseline importtime.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENTRY_POINTS = ("main", "app")
+TOP_MODULES = 10
+
+
+def parse_importtime(stderr):
+    """Return [(module, self_us, cumulative_us, depth)] from -X importtime output."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        rows.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return rows
+
+
+def measure(module):
+    """Import module once in a clean interpreter and directory."""
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, PYTHONPATH=ROOT, PYTHONDONTWRITEBYTECODE="1")
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                              cwd=tmp, env=env, capture_output=True, text=True)
+        created = sorted(os.listdir(tmp))
+    if proc.returncode:
+        error = proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "failed"
+        return {"error": error}
+
+    rows = parse_importtime(proc.stderr)
+    end = max(i for i, r in enumerate(rows) if r[0] == module and r[3] == 0)
+    # Children are reported before their parent: walk back to the previous top-level import
+    children = []
+    for row in reversed(rows[:end]):
+        if row[3] == 0:
+            break
+        if row[3] == 1:
+            children.append(row)
+    total = rows[end][2]
+    slowest = sorted(children, key=lambda r: -r[2])[:TOP_MODULES]
+    return {
+        "total_ms": round(total / 1000, 2),
+        "modules": len(rows),
+        "created_files": created,
+        "slowest": {name: round(c / 1000, 2) for name, _, c, _ in slowest},
+    }
+
+
+def run(entry_points, repeat):
+    results = {}
+    for module in entry_points:
+        runs = [measure(module) for _ in range(repeat)]
+        ok = [r for r in runs if "error" not in r]
+        # The fastest run is the least disturbed by the rest of the machine
+        results[module] = min(ok, key=lambda r: r["total_ms"]) if ok else runs[0]
+    return results
+
+
+def compare(current, baseline, threshold):
+    regressions = []
+    for module, old in baseline.items():
+        new = current.get(module)
+        if not new or "error" in new or "error" in old:
+            continue
+        if new["total_ms"] > old["total_ms"] * (1 + threshold):
+            regressions.append(f"{module}: {old['total_ms']} ms -> {new['total_ms']} ms")
+        if new["created_files"] and not old["created_files"]:
+            regressions.append(f"{module}: import now creates {', '.join(new['created_files'])}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("modules", nargs="*", default=list(ENTRY_POINTS), help="modules to import (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=5, help="imports per module; the fastest counts")
+    parser.add_argument("--out", help="write the results JSON to this file")
+    parser.add_argument("--baseline", help="compare against a saved results file")
+    parser.add_argument("--threshold", type=float, default=0.25, help="relative slowdown flagged as a regression (default: %(default)s)")
+    args = parser.parse_args()
+
+    current = run(args.modules, args.repeat)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(current, f, indent=2)
+    print(json.dumps(current, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(current, json.load(f), args.threshold)
+        for line in regressions:
+            print(f"❌ {line}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""Cost of small edits to large text files: whole-file rewrite vs block updates.
+
+For each file size, a text file is created with file_manager.create_file
+under the default settings, and a small edit is then applied by re-encrypting
+the whole file (what update_file used to do), by file_manager.edit_file
+(overwrite and append, i.e. security.write_at) and by file_manager.update_file
+(new full content, one character changed). The update is also timed at the
+storage layer alone (security.update_blocks), since update_file's total
+includes hashing and re-indexing the whole new content. write_at should cost
+the same at every size; update_blocks still digests the whole new content,
+but encrypts and writes only what changed. Each run checks the file stayed
+patchable.
+
+Run from the repository root:
+    python benchmarks/bench_incremental.py [--sizes 1M,16M,64M] [--edit-bytes 100] [--repeat 5] [--json]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def best_ms(fn, repeat):
+    """Fastest of repeat runs, in milliseconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            fn()
+        times.append(time.perf_counter() - start)
+    return round(min(times) * 1000, 2)
+
+
+def text_of(size):
+    """size characters of compressible ASCII text, like the notes users keep."""
+    lines = []
+    total = 0
+    while total < size:
+        line = f"line {len(lines)}: the quick brown fox jumps over the lazy dog\n"
+        lines.append(line)
+        total += len(line)
+    return "".join(lines)[:size]
+
+
+def patchable(path):
+    """Whether a file can still be updated in place (uncompressed, with a block map)."""
+    import compression
+    import security
+
+    with open(path, "rb") as f:
+        layout = security._read_layout(f)
+    return layout is not None and layout.stream_length is not None and layout.codec == compression.NONE
+
+
+def run_size(size, edit_bytes, repeat):
+    import file_manager
+    import security
+
+    name = f"notes{size}.txt"
+    content = text_of(size)
+    edit = "x" * edit_bytes
+    with contextlib.redirect_stdout(io.StringIO()):
+        file_manager.create_file("bench", name, content)
+    path = file_manager.stored_path("bench", name)
+
+    def rewrite():
+        security.write_encrypted(path, content.encode(), owner="bench")
+
+    def change_one_char():
+        nonlocal content
+        middle = size // 2
+        content = content[:middle] + ("a" if content[middle] != "a" else "b") + content[middle + 1:]
+        return content
+
+    row = {
+        "size": size,
+        "rewrite_ms": best_ms(rewrite, repeat),
+        "write_at_ms": best_ms(lambda: file_manager.edit_file("bench", name, edit, size // 2), repeat),
+        "append_ms": best_ms(lambda: file_manager.edit_file("bench", name, edit), repeat),
+    }
+    content = file_manager.read_file("bench", name)
+    row["update_blocks_ms"] = best_ms(lambda: security.update_blocks(path, change_one_char().encode()), repeat)
+    row["update_file_ms"] = best_ms(lambda: file_manager.update_file("bench", name, change_one_char()), repeat)
+    assert file_manager.read_file("bench", name) == content
+    assert patchable(path), "update_file left the file unpatchable"
+    with contextlib.redirect_stdout(io.StringIO()):
+        file_manager.delete_file("bench", name)
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1M,16M,64M", help="comma-separated file sizes")
+    parser.add_argument("--edit-bytes", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5, help="runs per measurement; the fastest counts")
+    parser.add_argument("--dir", help="directory on the filesystem to test (default: a temp dir)")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        os.chdir(tmp)  # Keys, database, journal and test files stay inside the temp dir
+        for size in (parse_size(s) for s in args.sizes.split(",")):
+            results.append(run_size(size, args.edit_bytes, args.repeat))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'size':>12}{'rewrite ms':>12}{'write_at ms':>13}{'append ms':>11}{'blocks ms':>11}"
+          f"{'update_file ms':>16}")
+    for r in results:
+        print(f"{r['size']:>12}{r['rewrite_ms']:>12}{r['write_at_ms']:>13}"
+              f"{r['append_ms']:>11}{r['update_blocks_ms']:>11}{r['update_file_ms']:>16}")
+
+
+if __name__ == "__main__":
+    main()
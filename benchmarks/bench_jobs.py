@@ -0,0 +1,104 @@
+"""Interactive read latency while a maintenance job re-encrypts a user's files, throttled or not.
+
+A reader thread reads random small files through file_manager at a steady
+pace while a background worker runs a forced reencrypt job over a second
+user's large files. Each phase runs for --seconds: no job, the job with its
+rate limits off, and the job with the default limits and latency guard.
+Also reports how far the job got, to show what the throttling costs it.
+
+Run from the repository root:
+    python benchmarks/bench_jobs.py [--files 40] [--file-mb 4] [--seconds 10] [--json]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+READ_INTERVAL = 0.05  # seconds between interactive reads
+
+
+def percentile(times, q):
+    times = sorted(times)
+    return round(times[min(len(times) - 1, int(q * len(times)))] * 1000, 1)
+
+
+def run_phase(seconds, job_kind, limits):
+    import file_manager
+    import jobs
+    import metrics
+
+    jobs.IO_RATE, jobs.CPU_SHARE = limits
+    stop = threading.Event()
+    job_id = jobs.submit(job_kind, ["bulk"], force=True) if job_kind else None
+    worker = threading.Thread(target=jobs.work, args=("bench", jobs.Throttle(), stop))
+    worker.start()
+
+    rng = random.Random(1)
+    latencies = []
+    metrics.reset()
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        file_manager.read_file("alice", f"note{rng.randrange(50)}.txt")
+        latencies.append(time.perf_counter() - start)
+        time.sleep(READ_INTERVAL)
+
+    done = 0
+    if job_id is not None:
+        jobs.cancel(job_id)
+    stop.set()
+    worker.join()
+    if job_id is not None:
+        done = next(j for j in jobs.list_jobs() if j["id"] == job_id)["done"]
+    return {"reads": len(latencies), "p50_ms": percentile(latencies, 0.5),
+            "p95_ms": percentile(latencies, 0.95), "p99_ms": percentile(latencies, 0.99),
+            "job_files_done": done}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=40, help="large files for the job to re-encrypt")
+    parser.add_argument("--file-mb", type=float, default=4)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)  # Keys, database and files stay inside the temp dir
+        import file_manager
+        import jobs
+        import metrics
+
+        metrics.enable()  # Feeds the latency guard
+        jobs.POLL_INTERVAL = 0.1
+        jobs.CHECKPOINT_INTERVAL = 0.5
+        for i in range(50):
+            file_manager.create_file("alice", f"note{i}.txt", f"note {i} " * 200)
+        body = os.urandom(int(args.file_mb * 1024 * 1024)).hex()[:int(args.file_mb * 1024 * 1024)]
+        for i in range(args.files):
+            file_manager.create_file("bulk", f"big{i}.txt", body)
+
+        limits = (jobs.IO_RATE, jobs.CPU_SHARE)
+        results = {
+            "no_job": run_phase(args.seconds, None, limits),
+            "job_unthrottled": run_phase(args.seconds, "reencrypt", (0, 0)),
+            "job_throttled": run_phase(args.seconds, "reencrypt", limits),
+        }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"reencrypt over {args.files} x {args.file_mb} MB files, {args.seconds} s per phase")
+    print(f"{'phase':>16}{'reads':>7}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'job files':>11}")
+    for phase, r in results.items():
+        print(f"{phase:>16}{r['reads']:>7}{r['p50_ms']:>9}{r['p95_ms']:>9}{r['p99_ms']:>9}{r['job_files_done']:>11}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Legitimate login latency during a credential-stuffing burst, with and without rate limiting.
+
+Attacker threads try wrong passwords against a handful of real accounts
+from a few client addresses while one real user logs in from their own
+address at a steady pace. Each phase runs for --seconds: no attack, an
+attack with rate_limit switched off, and the same attack with it on. The
+real user's p50/p95 login latency should stay near the no-attack baseline
+with limiting on.
+
+Run from the repository root:
+    python benchmarks/bench_login.py [--attackers 16] [--clients 4] [--seconds 10] [--json]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+VICTIMS = 10
+REQUEST_OVERHEAD = 0.001  # seconds an attacker spends per refused request (network, HTTP)
+
+
+def percentile(times, q):
+    times = sorted(times)
+    return round(times[min(len(times) - 1, int(q * len(times)))] * 1000, 1)
+
+
+def run_phase(seconds, attackers, clients, limited):
+    import auth
+    import rate_limit
+
+    rate_limit.ENABLED = limited
+    for scope in rate_limit._limiters.values():
+        scope._buckets.clear()
+    stop = threading.Event()
+    counts = {"hashed": 0, "refused": 0}
+    counts_lock = threading.Lock()
+
+    def attacker(n):
+        client = f"203.0.113.{n % clients}" if clients else None
+        i = 0
+        while not stop.is_set():
+            _, message, _ = auth.login_user(f"victim{i % VICTIMS}", "guess", client)
+            refused = message.startswith("Too many")
+            with counts_lock:
+                counts["refused" if refused else "hashed"] += 1
+            i += 1
+            if refused:
+                time.sleep(REQUEST_OVERHEAD)
+
+    threads = [threading.Thread(target=attacker, args=(n,)) for n in range(attackers)]
+    for t in threads:
+        t.start()
+    latencies = []
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        success, _, _ = auth.login_user("alice", "correct horse", "198.51.100.7")
+        latencies.append(time.perf_counter() - start)
+        assert success
+        auth.rate_limit.record_success("alice", "198.51.100.7")  # As the 2FA step would
+        time.sleep(1)  # A real user, well inside their client's allowance
+    stop.set()
+    for t in threads:
+        t.join()
+    return {"logins": len(latencies), "p50_ms": percentile(latencies, 0.5),
+            "p95_ms": percentile(latencies, 0.95), "mean_ms": round(statistics.mean(latencies) * 1000, 1),
+            "attack_hashed": counts["hashed"], "attack_refused": counts["refused"]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--attackers", type=int, default=16, help="attacker threads")
+    parser.add_argument("--clients", type=int, default=4, help="distinct attacker addresses")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)  # Keys, KDF parameters and database stay inside the temp dir
+        import auth
+        import user_store
+
+        user_store.create_user("alice", auth.hash_password("correct horse"), "user", "SECRET")
+        for i in range(VICTIMS):
+            user_store.create_user(f"victim{i}", auth.hash_password(f"secret {i}"), "user", "SECRET")
+
+        results = {
+            "baseline": run_phase(args.seconds, 0, args.clients, True),
+            "attack_unlimited": run_phase(args.seconds, args.attackers, args.clients, False),
+            "attack_limited": run_phase(args.seconds, args.attackers, args.clients, True),
+        }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{args.attackers} attacker threads from {args.clients} address(es), {args.seconds} s per phase")
+    print(f"{'phase':>18}{'logins':>8}{'p50 ms':>9}{'p95 ms':>9}{'hashed':>9}{'refused':>9}")
+    for phase, r in results.items():
+        print(f"{phase:>18}{r['logins']:>8}{r['p50_ms']:>9}{r['p95_ms']:>9}"
+              f"{r['attack_hashed']:>9}{r['attack_refused']:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Many small files: one .enc per file vs the pack-file backend.
+
+Writes --files files of --size-kb each through file_manager with each
+storage backend, then times reading them all back, overwriting and deleting
+half of them, and (for packs) compacting. Disk usage counts allocated
+blocks, which is where thousands of tiny files cost the most.
+
+Run from the repository root:
+    python benchmarks/bench_pack.py [--files 5000] [--size-kb 1] [--json]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def disk_usage(*roots):
+    total = 0
+    for root in roots:
+        for dirpath, _, names in os.walk(root):
+            for name in names:
+                st = os.stat(os.path.join(dirpath, name))
+                total += getattr(st, "st_blocks", 0) * 512 or st.st_size
+    return total
+
+
+def timed(fn):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        fn()
+    return round(time.perf_counter() - start, 3)
+
+
+def run_backend(backend, count, contents):
+    import file_manager
+    import pack_store
+
+    user = f"bench_{backend}"
+    file_manager.STORAGE_BACKEND = backend
+    names = [f"note{i}.txt" for i in range(count)]
+    row = {"backend": backend}
+
+    def create():
+        for name, content in zip(names, contents):
+            file_manager.create_file(user, name, content)
+
+    def read():
+        for name in names:
+            file_manager.read_file(user, name)
+
+    def churn():
+        for name, content in zip(names[::2], contents[1::2]):
+            file_manager.update_file(user, name, content)
+        for name in names[1::2]:
+            file_manager.delete_file(user, name)
+
+    row["create_s"] = timed(create)
+    pack_store._maps.clear()  # Cold maps for the read pass
+    row["read_s"] = timed(read)
+    row["disk_kb"] = disk_usage(os.path.join("secure_files", user), os.path.join("pack_store", user)) // 1024
+    row["churn_s"] = timed(churn)
+    row["after_churn_kb"] = disk_usage(os.path.join("secure_files", user),
+                                       os.path.join("pack_store", user)) // 1024
+    if backend == "pack":
+        row["compact_s"] = timed(lambda: pack_store.compact(user))
+        row["after_compact_kb"] = disk_usage(os.path.join("pack_store", user)) // 1024
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=5000)
+    parser.add_argument("--size-kb", type=float, default=1)
+    parser.add_argument("--dir", help="directory on the filesystem to test (default: a temp dir)")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    size = int(args.size_kb * 1024)
+    contents = [os.urandom(size // 2).hex() for _ in range(args.files)]
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        os.chdir(tmp)  # Keys, database and stored files stay inside the temp dir
+        results = [run_backend(backend, args.files, contents) for backend in ("files", "pack")]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{args.files} files of {size} bytes")
+    print(f"{'backend':>8}{'create s':>10}{'read s':>9}{'disk KB':>10}{'churn s':>9}{'after KB':>10}"
+          f"{'compact s':>11}{'compacted KB':>14}")
+    for r in results:
+        print(f"{r['backend']:>8}{r['create_s']:>10}{r['read_s']:>9}{r['disk_kb']:>10}{r['churn_s']:>9}"
+              f"{r['after_churn_kb']:>10}{r.get('compact_s', '-'):>11}{r.get('after_compact_kb', '-'):>14}")
+
+
+if __name__ == "__main__":
+    main()
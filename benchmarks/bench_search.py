@@ -0,0 +1,131 @@
+"""Search latency on a large folder, and what indexing adds to each write.
+
+Creates --files synthetic text files for one user through file_manager
+(timing the writes with and without the index), then measures the cold
+load of the index and p50/p95 latency of term, prefix and phrase queries.
+
+Run from the repository root:
+    python benchmarks/bench_search.py [--files 20000] [--words 200] [--queries 200] [--json]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+VOCABULARY = 5000
+
+
+def make_words(rng):
+    """A Zipf-ish vocabulary: a few common words and a long tail."""
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = set()
+    while len(words) < VOCABULARY:
+        words.add("".join(rng.choice(letters) for _ in range(rng.randint(3, 10))))
+    words = sorted(words)
+    weights = [1 / (rank + 1) for rank in range(len(words))]
+    return words, weights
+
+
+def percentile(times, q):
+    times = sorted(times)
+    return round(times[min(len(times) - 1, int(q * len(times)))] * 1000, 3)
+
+
+def create_files(count, words_per_file, words, weights, rng):
+    import file_manager
+    import search_index
+
+    texts = [" ".join(rng.choices(words, weights, k=words_per_file)) for _ in range(count)]
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i, text in enumerate(texts):
+            file_manager.create_file("bench", f"doc{i}.txt", text)
+    elapsed = time.perf_counter() - start
+
+    # The same writes without indexing, for the overhead
+    index_file = search_index.index_file
+    search_index.index_file = lambda *args: None
+    try:
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for i, text in enumerate(texts[:min(count, 500)]):
+                file_manager.create_file("plain", f"doc{i}.txt", text)
+        plain = (time.perf_counter() - start) / min(count, 500)
+    finally:
+        search_index.index_file = index_file
+    return texts, elapsed / count, plain
+
+
+def run_queries(queries, username):
+    import search_index
+
+    times = []
+    hits = 0
+    for query in queries:
+        start = time.perf_counter()
+        hits += len(search_index.search(username, query))
+        times.append(time.perf_counter() - start)
+    return {"p50_ms": percentile(times, 0.5), "p95_ms": percentile(times, 0.95),
+            "avg_hits": round(hits / len(queries), 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=20000)
+    parser.add_argument("--words", type=int, default=200, help="words per file")
+    parser.add_argument("--queries", type=int, default=200, help="queries per kind")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    words, weights = make_words(rng)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)  # Keys, database and index stay inside the temp dir
+        import search_index
+
+        texts, write_s, plain_write_s = create_files(args.files, args.words, words, weights, rng)
+        results = {"files": args.files, "write_ms": round(write_s * 1000, 3),
+                   "write_without_index_ms": round(plain_write_s * 1000, 3)}
+
+        search_index._indexes.clear()  # Cold: replay the segments from disk
+        start = time.perf_counter()
+        search_index.search("bench", words[0])
+        results["cold_load_s"] = round(time.perf_counter() - start, 3)
+        results["segments"] = len(search_index._segment_names("bench"))
+
+        def phrase():
+            tokens = rng.choice(texts).split()
+            i = rng.randrange(len(tokens) - 2)
+            return '"' + " ".join(tokens[i:i + 3]) + '"'
+
+        kinds = {
+            "term": lambda: rng.choice(words),
+            "two_terms": lambda: f"{rng.choice(words[:200])} {rng.choice(words)}",
+            "prefix": lambda: rng.choice(words)[:3] + "*",
+            "phrase": phrase,
+        }
+        for kind, make in kinds.items():
+            results[kind] = run_queries([make() for _ in range(args.queries)], "bench")
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{results['files']} files: write {results['write_ms']} ms "
+          f"({results['write_without_index_ms']} ms without the index), "
+          f"cold load {results['cold_load_s']} s over {results['segments']} segment(s)")
+    print(f"{'query':>10}{'p50 ms':>10}{'p95 ms':>10}{'hits':>8}")
+    for kind in kinds:
+        r = results[kind]
+        print(f"{kind:>10}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['avg_hits']:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Database queries and time per logged-in page view, before and after session tokens.
+
+Each simulated dashboard rerun authorizes the user. Previously that meant
+reading the role (and the TOTP secret) from SQLite; now the rerun resolves a
+signed session token and takes the role from the in-process record cache.
+Queries are counted at the connection pool.
+
+Run from the repository root:
+    python benchmarks/bench_sessions.py [--users 50] [--views 20000] [--json]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class QueryCounter:
+    """Counts connections borrowed from the pool, i.e. queries and transactions."""
+
+    def __init__(self, pool):
+        self.count = 0
+        self._acquire = pool.acquire
+
+        def acquire():
+            self.count += 1
+            return self._acquire()
+
+        pool.acquire = acquire
+
+
+def run(views, make_view):
+    import db
+
+    counter = QueryCounter(db.get_pool())
+    start = time.perf_counter()
+    for _ in range(views):
+        make_view()
+    elapsed = time.perf_counter() - start
+    db.get_pool().acquire = counter._acquire
+    return {"queries_per_view": round(counter.count / views, 4),
+            "us_per_view": round(elapsed / views * 1e6, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--views", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)  # Keys and database stay inside the temp dir
+        import auth
+        import db
+        import user_store
+
+        users = [f"user{i}" for i in range(args.users)]
+        for name in users:
+            user_store.create_user(name, "x", "user", "SECRET")
+        tokens = {name: auth.start_session(name) for name in users}
+
+        def before():
+            name = rng.choice(users)
+            db.query_one(user_store.SELECT_RECORD, (name,))  # role
+            db.query_one(user_store.SELECT_RECORD, (name,))  # secret
+
+        def after():
+            name = rng.choice(users)
+            assert auth.resolve_session(tokens[name]).username == name
+
+        results = {"users": args.users, "views": args.views,
+                   "before": run(args.views, before), "after": run(args.views, after)}
+
+        # A role change is visible on the very next view
+        user_store.set_role(users[0], "admin")
+        results["role_change_seen"] = auth.resolve_session(tokens[users[0]]).role == "admin"
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{results['views']} page views over {results['users']} users")
+    for kind in ("before", "after"):
+        r = results[kind]
+        print(f"{kind:>8}: {r['queries_per_view']} queries/view, {r['us_per_view']} µs/view")
+    print(f"role change visible on next view: {results['role_change_seen']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""Micro-benchmarks for the crypto, storage and auth hot paths.
+
+Every run works in a fresh temporary directory, so keys, the user database
+and secure_files never touch the working tree. Results are written as JSON;
+--baseline compares them against a saved run and exits non-zero on regressions.
+
+Run from the repository root:
+    python benchmarks/bench_suite.py [--quick] [--sizes 1K,1M,1G] [--out run.json]
+    python benchmarks/bench_suite.py --baseline run.json [--threshold 0.15]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SECTIONS = ("crypto", "crud", "auth", "listing")
+DEFAULT_SIZES = "1K,64K,1M,16M,128M"
+QUICK_SIZES = "1K,64K,1M"
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+STREAM_BLOCK = 1024 ** 2
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def _quiet():
+    """Silence the emoji progress prints of the code under test."""
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+def _latency(fn, repeat):
+    """Run fn repeat times and summarize wall-clock latency in milliseconds."""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return {
+        "p50_ms": round(statistics.median(samples), 3),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3),
+        "mean_ms": round(statistics.fmean(samples), 3),
+    }
+
+
+def _write_random(path, size):
+    """Write size random bytes to path without holding them all in memory."""
+    with open(path, "wb") as f:
+        left = size
+        while left:
+            n = min(STREAM_BLOCK, left)
+            f.write(os.urandom(n))
+            left -= n
+
+
+def bench_crypto(sizes, repeat):
+    """Streaming encrypt/decrypt throughput file-to-file, per plaintext size."""
+    import security
+
+    results = {}
+    for size in sizes:
+        _write_random("plain.bin", size)
+        runs = max(1, min(repeat, (64 * 1024 ** 2) // max(size, 1)))
+        enc_s = dec_s = 0.0
+        for _ in range(runs):
+            start = time.perf_counter()
+            with open("plain.bin", "rb") as src, open("plain.bin.enc", "wb") as dst:
+                security.encrypt_stream(src, dst, owner="bench")
+            enc_s += time.perf_counter() - start
+            start = time.perf_counter()
+            with open("plain.bin.enc", "rb") as src, open(os.devnull, "wb") as dst:
+                security.decrypt_stream(src, dst)
+            dec_s += time.perf_counter() - start
+        label = _size_label(size)
+        results[f"crypto.encrypt.{label}.mb_per_s"] = round(size * runs / enc_s / 1e6, 2)
+        results[f"crypto.decrypt.{label}.mb_per_s"] = round(size * runs / dec_s / 1e6, 2)
+        os.remove("plain.bin")
+        os.remove("plain.bin.enc")
+    return results
+
+
+def bench_crud(count, size):
+    """Latency of file_manager create/read/update/delete on files of one size."""
+    import file_manager
+
+    content = os.urandom(size // 2).hex()
+    names = iter(range(10 ** 9))
+    results = {}
+    with _quiet():
+        created = []
+
+        def create():
+            name = f"f{next(names)}.txt"
+            file_manager.create_file("crud", name, content)
+            created.append(name)
+
+        results.update(_prefixed("crud.create", _latency(create, count)))
+        targets = iter(created * 2)  # One pass for reads, one for updates
+        results.update(_prefixed("crud.read", _latency(
+            lambda: file_manager.read_file("crud", next(targets)), count)))
+        results.update(_prefixed("crud.update", _latency(
+            lambda: file_manager.update_file("crud", next(targets), content), count)))
+        victims = iter(created)
+        results.update(_prefixed("crud.delete", _latency(
+            lambda: file_manager.delete_file("crud", next(victims)), count)))
+    return results
+
+
+def bench_auth(count):
+    """Latency of a password login and of verifying a TOTP code."""
+    import pyotp
+    import auth
+
+    ok, _, secret = auth.register_user("benchuser", "bench-password")
+    if not ok:
+        raise RuntimeError("Could not register the benchmark user.")
+    results = _prefixed("auth.login", _latency(
+        lambda: auth.login_user("benchuser", "bench-password"), count))
+    totp = pyotp.TOTP(secret)
+    results.update(_prefixed("auth.verify_2fa", _latency(
+        lambda: auth.verify_2fa_code(secret, totp.now()), count * 10)))
+    return results
+
+
+def bench_listing(folder_sizes, repeat):
+    """Time to list a user's files as the folder grows."""
+    import file_manager
+
+    results = {}
+    with _quiet():
+        existing = 0
+        for target in folder_sizes:
+            for i in range(existing, target):
+                file_manager.create_file("lister", f"doc{i}.txt", "x")
+            existing = target
+            stats = _latency(lambda: file_manager.list_user_files("lister"), repeat)
+            results[f"listing.{target}_files.p50_ms"] = stats["p50_ms"]
+    return results
+
+
+def _prefixed(prefix, stats):
+    return {f"{prefix}.{k}": v for k, v in stats.items()}
+
+
+def _size_label(size):
+    for suffix, unit in sorted(UNITS.items(), key=lambda kv: -kv[1]):
+        if size >= unit and size % unit == 0:
+            return f"{size // unit}{suffix}"
+    return f"{size}B"
+
+
+def run(sections, sizes, quick):
+    repeat = 5 if quick else 20
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        cwd = os.getcwd()
+        os.chdir(tmp)  # Isolated keys, database and secure_files
+        try:
+            if "crypto" in sections:
+                results.update(bench_crypto(sizes, repeat))
+            if "crud" in sections:
+                results.update(bench_crud(repeat * 2, 64 * 1024))
+            if "auth" in sections:
+                results.update(bench_auth(repeat))
+            if "listing" in sections:
+                results.update(bench_listing((10, 100) if quick else (10, 100, 1000), repeat))
+        finally:
+            os.chdir(cwd)
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+
+
+def higher_is_better(metric):
+    return metric.endswith("_per_s")
+
+
+def compare(current, baseline, threshold):
+    """Return (metric, baseline, current, change) rows and the regressed subset."""
+    rows = []
+    regressions = []
+    for metric, old in sorted(baseline["results"].items()):
+        new = current["results"].get(metric)
+        if new is None or not old:
+            continue
+        change = (new - old) / old
+        rows.append((metric, old, new, change))
+        worse = -change if higher_is_better(metric) else change
+        if worse > threshold:
+            regressions.append(metric)
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sections", default=",".join(SECTIONS), help="comma-separated subset of " + ", ".join(SECTIONS))
+    parser.add_argument("--sizes", help=f"crypto sizes (default: {DEFAULT_SIZES}; --quick: {QUICK_SIZES})")
+    parser.add_argument("--quick", action="store_true", help="fewer repetitions and smaller inputs")
+    parser.add_argument("--out", help="write the results JSON to this file")
+    parser.add_argument("--baseline", help="compare against a saved results file")
+    parser.add_argument("--threshold", type=float, default=0.15, help="relative change flagged as a regression (default: %(default)s)")
+    args = parser.parse_args()
+
+    sections = [s.strip() for s in args.sections.split(",") if s.strip()]
+    unknown = set(sections) - set(SECTIONS)
+    if unknown:
+        parser.error(f"unknown section(s): {', '.join(sorted(unknown))}")
+    sizes = [parse_size(s) for s in (args.sizes or (QUICK_SIZES if args.quick else DEFAULT_SIZES)).split(",")]
+
+    current = run(sections, sizes, args.quick)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(current, f, indent=2)
+
+    if not args.baseline:
+        print(json.dumps(current, indent=2))
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    rows, regressions = compare(current, baseline, args.threshold)
+    print(json.dumps({
+        "threshold": args.threshold,
+        "regressions": regressions,
+        "changes": {m: {"baseline": old, "current": new, "change_pct": round(100 * c, 1)}
+                    for m, old, new, c in rows},
+    }, indent=2))
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
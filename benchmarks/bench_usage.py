@@ -0,0 +1,94 @@
+"""Admin usage report for thousands of users: running totals versus summing the catalog.
+
+Fills a catalog with --users users of --files files each (rows only, no file
+contents), then times quota.usage_report, which reads the per-user totals the
+catalog triggers keep, against summing each user's rows the way usage was
+computed before. Also reports what the triggers add to a catalog write, and
+checks that the totals match a full recount.
+
+Run from the repository root:
+    python benchmarks/bench_usage.py [--users 5000] [--files 20] [--json]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SUM_FILES = 'SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(stored_size), 0) FROM files WHERE username = ?'
+DROP_TRIGGERS = ("DROP TRIGGER usage_on_insert", "DROP TRIGGER usage_on_update", "DROP TRIGGER usage_on_delete")
+
+
+def fill(users, files, offset=0):
+    """Insert catalog rows through the normal upsert; returns seconds per row."""
+    import catalog
+    import db
+
+    rows = [(f"user{u}", f"file{offset + i}.txt", f"secure_files/user{u}/file{i}.txt.enc",
+             100 + i, 140 + i, 0.0, 0.0, 4, None, 0)
+            for u in range(users) for i in range(files)]
+    start = time.perf_counter()
+    with db.transaction() as conn:
+        conn.executemany(catalog.UPSERT_FILE, rows)
+    return (time.perf_counter() - start) / len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--files", type=int, default=20, help="catalog rows per user")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)  # Database stays inside the temp dir
+        import catalog
+        import db
+        import quota
+
+        quota.initialize()
+        with db.transaction() as conn:
+            conn.executemany("INSERT INTO users (username, password_hash, role) VALUES (?, 'x', 'user')",
+                             [(f"user{u}",) for u in range(args.users)])
+        with_triggers = fill(args.users, args.files)
+
+        start = time.perf_counter()
+        report = quota.usage_report()
+        report_ms = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        summed = {r["user"]: db.query_one(SUM_FILES, (r["user"],)) for r in report}
+        summed_ms = (time.perf_counter() - start) * 1000
+        matches = all(tuple(summed[r["user"]]) == (r["files"], r["logical_bytes"], r["stored_bytes"])
+                      for r in report)
+
+        start = time.perf_counter()
+        drifted = catalog.recount_usage()
+        recount_ms = (time.perf_counter() - start) * 1000
+
+        with db.transaction() as conn:
+            for sql in DROP_TRIGGERS:
+                conn.execute(sql)
+        without_triggers = fill(args.users, args.files, offset=args.files)
+
+    results = {"users": args.users, "rows": args.users * args.files,
+               "report_ms": round(report_ms, 1), "per_user_sums_ms": round(summed_ms, 1),
+               "recount_ms": round(recount_ms, 1), "totals_match": matches and drifted == 0,
+               "write_us_with_triggers": round(with_triggers * 1e6, 2),
+               "write_us_without_triggers": round(without_triggers * 1e6, 2)}
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{results['users']} users, {results['rows']} catalog rows")
+    print(f"usage report from totals: {results['report_ms']} ms")
+    print(f"summing each user's rows: {results['per_user_sums_ms']} ms")
+    print(f"full recount (reconcile job): {results['recount_ms']} ms, totals match: {results['totals_match']}")
+    print(f"catalog write: {results['write_us_with_triggers']} µs with triggers, "
+          f"{results['write_us_without_triggers']} µs without")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+import argparse
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import catalog
+import dedup_store
+import durable
+import key_manager
+import security
+
+ROOT = "secure_files"
+CHECKPOINT_DIR = ".bulk_checkpoints"
+PROGRESS_INTERVAL = 2.0  # seconds between progress lines
+OPERATIONS = ("encrypt", "decrypt", "reencrypt")
+
+
+def encrypt_one(path, owner):
+    """Encrypt a plaintext file to <path>.enc, replacing it atomically."""
+    with key_manager.user_key_lock(owner), open(path, "rb") as src:
+        size = durable.atomic_write(path + ".enc", lambda dst: security.encrypt_stream(src, dst, owner=owner))
+    os.remove(path)
+    return size
+
+
+def decrypt_one(path, owner):
+    """Decrypt <name>.enc back to <name>, replacing it atomically."""
+    plain_path = path[:-len(".enc")]
+    with open(path, "rb") as src:  # On a bad tag the temp file is discarded, never the plaintext
+        size = durable.atomic_write(plain_path, lambda dst: security.decrypt_stream(src, dst, owner=owner))
+    os.remove(path)
+    return size
+
+
+def reencrypt_one(path, owner):
+    """Re-encrypt an .enc file under a fresh data key in the current format."""
+    size = os.path.getsize(path)
+    security.upgrade_file(path, owner, force=True)
+    return size
+
+
+_HANDLERS = {
+    "encrypt": encrypt_one,
+    "decrypt": decrypt_one,
+    "reencrypt": reencrypt_one,
+}
+
+
+def _run_task(op, path, owner):
+    """Process-pool entry point; returns (path, bytes processed, error message or None)."""
+    try:
+        return path, _HANDLERS[op](path, owner), None
+    except Exception as e:
+        return path, 0, f"{type(e).__name__}: {e}"
+
+
+def collect_tasks(op, usernames, root=ROOT):
+    """List the (path, owner) pairs an operation would touch for the given users."""
+    tasks = []
+    for username in usernames:
+        folder_path = os.path.join(root, username)
+        if not os.path.isdir(folder_path):
+            continue
+        for dirpath, _, names in os.walk(folder_path):
+            for name in sorted(names):
+                if name.endswith(".tmp"):
+                    continue  # Leftovers of an interrupted run
+                if name.endswith(dedup_store.MANIFEST_SUFFIX):
+                    continue  # Already encrypted; its chunks live in the chunk store
+                is_enc = name.endswith(".enc")
+                if is_enc == (op == "encrypt"):
+                    continue
+                tasks.append((os.path.join(dirpath, name), username))
+    return tasks
+
+
+def _checkpoint_path(op, scope):
+    return os.path.join(CHECKPOINT_DIR, f"{op}-{scope}.log")
+
+
+def _load_checkpoint(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path, "r") as f:
+        return {line.rstrip("\n") for line in f}
+
+
+def run(op, usernames=None, workers=None, root=ROOT, scope=None):
+    """Run op over every file of the given users (all users if None) on a process pool.
+
+    At most two tasks per worker are in flight, and each task streams through
+    fixed-size chunks, so memory stays bounded however many files there are.
+    Completed paths are appended to a checkpoint log; rerunning after an
+    interruption skips them. Returns a summary dict.
+    """
+    if op not in _HANDLERS:
+        raise ValueError(f"Unknown operation: {op}")
+    if usernames is None:
+        usernames = sorted(os.listdir(root)) if os.path.isdir(root) else []
+        scope = scope or "all"
+    scope = scope or "-".join(usernames)
+    workers = workers or os.cpu_count() or 2
+
+    for username in usernames:
+        key_manager.ensure_user_key(username)  # Create KEKs once, before workers race for them
+
+    os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+    checkpoint = _checkpoint_path(op, scope)
+    done = _load_checkpoint(checkpoint)
+    tasks = [t for t in collect_tasks(op, usernames, root) if t[0] not in done]
+    total = len(tasks)
+    if done:
+        print(f"↩️ Resuming {op}: {len(done)} file(s) already done, {total} to go.")
+
+    processed = 0
+    processed_bytes = 0
+    errors = []
+    start = last_report = time.perf_counter()
+    pending = set()
+    queue = iter(tasks)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool, open(checkpoint, "a") as log:
+        while True:
+            while len(pending) < workers * 2:
+                task = next(queue, None)
+                if task is None:
+                    break
+                pending.add(pool.submit(_run_task, op, *task))
+            if not pending:
+                break
+
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                path, size, error = future.result()
+                processed += 1
+                if error:
+                    errors.append((path, error))
+                    continue
+                processed_bytes += size
+                log.write(path + "\n")
+            log.flush()
+
+            now = time.perf_counter()
+            if now - last_report >= PROGRESS_INTERVAL:
+                last_report = now
+                rate = processed_bytes / (now - start) / 1e6
+                print(f"⏳ {processed}/{total} files, {processed_bytes / 1e6:.1f} MB, {rate:.1f} MB/s")
+
+    elapsed = time.perf_counter() - start
+    for username in usernames:
+        catalog.reconcile(username, root)  # Pick up the renamed and rewritten files
+    if not errors:
+        os.remove(checkpoint)  # Nothing left to resume
+
+    summary = {
+        "operation": op,
+        "files": processed - len(errors),
+        "failed": len(errors),
+        "bytes": processed_bytes,
+        "seconds": round(elapsed, 3),
+        "mb_per_s": round(processed_bytes / elapsed / 1e6, 2) if elapsed else 0.0,
+        "errors": errors,
+    }
+    print(f"✅ {op}: {summary['files']} file(s), {processed_bytes / 1e6:.1f} MB in "
+          f"{elapsed:.2f}s ({summary['mb_per_s']} MB/s), {len(errors)} failed.")
+    for path, error in errors:
+        print(f"❌ {path}: {error}")
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Encrypt or decrypt whole user folders in parallel.")
+    parser.add_argument("operation", choices=OPERATIONS)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--user", action="append", help="user folder to process (repeatable)")
+    target.add_argument("--all", action="store_true", help="process every user folder")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument("--root", default=ROOT, help="storage root (default: %(default)s)")
+    args = parser.parse_args()
+
+    result = run(args.operation, None if args.all else args.user, args.workers, args.root)
+    raise SystemExit(1 if result["failed"] else 0)
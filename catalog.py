@@ -0,0 +1,317 @@
+import hashlib
+import os
+import sys
+import threading
+import time
+import db
+import dedup_store
+import metrics
+import pack_store
+import security
+
+ROOT = "secure_files"
+
+# One row per stored file. disk_mtime_ns and stored_size are what the file
+# looked like on disk when the row was written, so reconcile can find files
+# changed outside the app with a directory scan instead of reading them.
+# Packed files (see pack_store) have no file of their own: path is their pack,
+# stored_size the record length and disk_mtime_ns the record's version.
+CREATE_FILES = '''CREATE TABLE IF NOT EXISTS files (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    username TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    stored_size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    modified_at REAL NOT NULL,
+                    format_version INTEGER,
+                    content_hash TEXT,
+                    disk_mtime_ns INTEGER NOT NULL,
+                    UNIQUE (username, name))'''
+CREATE_INDEXES = (
+    'CREATE INDEX IF NOT EXISTS files_by_modified ON files (username, modified_at)',
+    'CREATE INDEX IF NOT EXISTS files_by_size ON files (username, size)',
+)
+UPSERT_FILE = '''INSERT INTO files (username, name, path, size, stored_size, created_at, modified_at,
+                                    format_version, content_hash, disk_mtime_ns)
+                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                 ON CONFLICT (username, name) DO UPDATE SET
+                    path = excluded.path, size = excluded.size, stored_size = excluded.stored_size,
+                    modified_at = excluded.modified_at, format_version = excluded.format_version,
+                    content_hash = excluded.content_hash, disk_mtime_ns = excluded.disk_mtime_ns'''
+DELETE_FILE = 'DELETE FROM files WHERE username = ? AND name = ?'
+SELECT_FILE = 'SELECT * FROM files WHERE username = ? AND name = ?'
+SELECT_NAMES = 'SELECT name FROM files WHERE username = ? ORDER BY name'
+UPDATE_LOCATION = '''UPDATE files SET path = ?, stored_size = ?, disk_mtime_ns = ?,
+                                    format_version = COALESCE(?, format_version)
+                     WHERE username = ? AND name = ?'''
+SELECT_DISK_STATE = 'SELECT name, path, stored_size, disk_mtime_ns FROM files WHERE username = ?'
+# Running totals per user, kept by triggers on files so that every write to
+# the catalog updates them in the same transaction. A user's counters are
+# rebuilt from files by recount_usage, e.g. after a crash mid-migration or a
+# hand-edited database; see quota.reconcile_all.
+CREATE_USAGE = '''CREATE TABLE IF NOT EXISTS user_usage (
+                    username TEXT PRIMARY KEY,
+                    files INTEGER NOT NULL DEFAULT 0,
+                    logical_bytes INTEGER NOT NULL DEFAULT 0,
+                    stored_bytes INTEGER NOT NULL DEFAULT 0)'''
+CREATE_USAGE_TRIGGERS = (
+    '''CREATE TRIGGER IF NOT EXISTS usage_on_insert AFTER INSERT ON files BEGIN
+         INSERT INTO user_usage (username, files, logical_bytes, stored_bytes)
+         VALUES (new.username, 1, new.size, new.stored_size)
+         ON CONFLICT (username) DO UPDATE SET
+            files = files + 1, logical_bytes = logical_bytes + excluded.logical_bytes,
+            stored_bytes = stored_bytes + excluded.stored_bytes;
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS usage_on_update AFTER UPDATE OF size, stored_size ON files BEGIN
+         UPDATE user_usage SET logical_bytes = logical_bytes + new.size - old.size,
+                               stored_bytes = stored_bytes + new.stored_size - old.stored_size
+         WHERE username = new.username;
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS usage_on_delete AFTER DELETE ON files BEGIN
+         UPDATE user_usage SET files = files - 1, logical_bytes = logical_bytes - old.size,
+                               stored_bytes = stored_bytes - old.stored_size
+         WHERE username = old.username;
+       END''',
+)
+USAGE_EXISTS = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_usage'"
+# WHERE true keeps SQLite from reading ON CONFLICT as part of the SELECT
+RECOUNT_USAGE = '''INSERT INTO user_usage (username, files, logical_bytes, stored_bytes)
+                   SELECT username, COUNT(*), SUM(size), SUM(stored_size) FROM files WHERE true GROUP BY username
+                   ON CONFLICT (username) DO UPDATE SET
+                      files = excluded.files, logical_bytes = excluded.logical_bytes,
+                      stored_bytes = excluded.stored_bytes
+                   WHERE files != excluded.files OR logical_bytes != excluded.logical_bytes
+                      OR stored_bytes != excluded.stored_bytes'''
+CLEAR_EMPTY_USAGE = '''UPDATE user_usage SET files = 0, logical_bytes = 0, stored_bytes = 0
+                       WHERE (files != 0 OR logical_bytes != 0 OR stored_bytes != 0)
+                         AND username NOT IN (SELECT username FROM files)'''
+SELECT_USAGE = 'SELECT files, logical_bytes, stored_bytes FROM user_usage WHERE username = ?'
+SORT_COLUMNS = ("name", "size", "created_at", "modified_at")
+COLUMNS = ("id", "username", "name", "path", "size", "stored_size", "created_at", "modified_at",
+           "format_version", "content_hash", "disk_mtime_ns")
+
+_initialized = set()
+_reconciled = set()
+_lock = threading.Lock()
+
+
+def initialize():
+    """Create the catalog tables, indexes and usage triggers once per database per process."""
+    path = db.DB_NAME
+    if path in _initialized:
+        return
+    with _lock:
+        if path not in _initialized:
+            with db.transaction() as conn:
+                conn.execute(CREATE_FILES)
+                for sql in CREATE_INDEXES:
+                    conn.execute(sql)
+                counted = conn.execute(USAGE_EXISTS).fetchone()
+                conn.execute(CREATE_USAGE)
+                for sql in CREATE_USAGE_TRIGGERS:
+                    conn.execute(sql)
+                if not counted:
+                    conn.execute(RECOUNT_USAGE)  # Catalogs from before the counters
+            _initialized.add(path)
+
+
+def logical_name(file_name):
+    """Catalog name of a stored file: its name without the .enc or .manifest suffix."""
+    for suffix in (".enc", dedup_store.MANIFEST_SUFFIX):
+        if file_name.endswith(suffix):
+            return file_name[:-len(suffix)]
+    return file_name
+
+
+def _as_dict(row):
+    return dict(zip(COLUMNS, row)) if row else None
+
+
+@metrics.instrument("catalog.record_file")
+def record_file(username, name, path, size, content_hash=None, format_version=None, stored=None):
+    """Insert or update a file's row after it was written to path.
+
+    stored is (stored size, version) for files that do not own path, i.e.
+    packed ones; by default both come from stat'ing path.
+    """
+    initialize()
+    if stored is None:
+        st = os.stat(path)
+        stored = (st.st_size, st.st_mtime_ns)
+    now = time.time()
+    db.execute(UPSERT_FILE, (username, name, path, size, stored[0], now, now,
+                             format_version, content_hash, stored[1]))
+
+
+def record_content(username, name, path, data, format_version=security.FORMAT_VERSION, stored=None):
+    """Record a file written from the in-memory plaintext data."""
+    record_file(username, name, path, len(data), hashlib.sha256(data).hexdigest(), format_version, stored)
+
+
+def relocate(username, name, path, stored_size, disk_mtime_ns, format_version=None):
+    """Point a file's row at where its unchanged content now lives, e.g. after a migration.
+
+    format_version is only changed if given, i.e. the content was re-encrypted.
+    """
+    initialize()
+    db.execute(UPDATE_LOCATION, (path, stored_size, disk_mtime_ns, format_version, username, name))
+
+
+@metrics.instrument("catalog.remove_file")
+def remove_file(username, name):
+    initialize()
+    db.execute(DELETE_FILE, (username, name))
+
+
+def get_file(username, name):
+    """Return a file's catalog row as a dict, or None."""
+    initialize()
+    return _as_dict(db.query_one(SELECT_FILE, (username, name)))
+
+
+def list_files(username, order_by="name", descending=False, limit=None, offset=0):
+    """Return one page of a user's files as dicts, sorted by an indexed column."""
+    if order_by not in SORT_COLUMNS:
+        raise ValueError(f"Cannot sort by {order_by!r}; choose one of {', '.join(SORT_COLUMNS)}.")
+    ensure_reconciled(username)
+    direction = "DESC" if descending else "ASC"
+    sql = (f"SELECT * FROM files WHERE username = ? ORDER BY {order_by} {direction}, name "
+           f"LIMIT ? OFFSET ?")
+    rows = db.query_all(sql, (username, -1 if limit is None else limit, offset))
+    return [_as_dict(row) for row in rows]
+
+
+@metrics.instrument("catalog.list_names")
+def list_names(username):
+    """Return the logical names of all of a user's files, in name order."""
+    ensure_reconciled(username)
+    rows = db.query_all(SELECT_NAMES, (username,))
+    return [row[0] for row in rows]
+
+
+def disk_state(username):
+    """Return {name: (path, stored size, disk mtime_ns)} for a user's files."""
+    ensure_reconciled(username)
+    return {row[0]: tuple(row[1:]) for row in db.query_all(SELECT_DISK_STATE, (username,))}
+
+
+def usage(username):
+    """Return (file count, plaintext bytes, stored bytes) for a user from the running totals."""
+    ensure_reconciled(username)
+    row = db.query_one(SELECT_USAGE, (username,))
+    return tuple(row) if row else (0, 0, 0)
+
+
+def recount_usage():
+    """Rebuild every user's totals from the files table; returns the number of users corrected."""
+    initialize()
+    with db.transaction() as conn:
+        return conn.execute(RECOUNT_USAGE).rowcount + conn.execute(CLEAR_EMPTY_USAGE).rowcount
+
+
+def _describe(path):
+    """Read the size, hash and format of a file found on disk."""
+    if path.endswith(dedup_store.MANIFEST_SUFFIX):
+        username = os.path.basename(os.path.dirname(path))
+        data = dedup_store.get(username, logical_name(os.path.basename(path)))
+        return len(data), hashlib.sha256(data).hexdigest(), security.file_format_version(path)
+    if not path.endswith(".enc"):
+        with open(path, "rb") as f:
+            data = f.read()
+        return len(data), hashlib.sha256(data).hexdigest(), None
+
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        for chunk in security.iter_decrypt(f, owner=os.path.basename(os.path.dirname(path))):
+            digest.update(chunk)
+            size += len(chunk)
+    return size, digest.hexdigest(), security.file_format_version(path)
+
+
+def _describe_packed(username, name):
+    payload = pack_store.read_payload(username, name)
+    data = pack_store.get(username, name)
+    return len(data), hashlib.sha256(data).hexdigest(), pack_store.payload_version(payload)
+
+
+@metrics.instrument("catalog.reconcile")
+def reconcile(username, root=ROOT):
+    """Bring a user's catalog in line with the files actually on disk.
+
+    Only files whose size or mtime differ from their row are read, so a pass
+    over an unchanged folder costs one directory scan and one query.
+    Returns (added or updated, removed).
+    """
+    initialize()
+    folder_path = os.path.join(root, username)
+    known = {row[0]: row[1:] for row in db.query_all(SELECT_DISK_STATE, (username,))}
+    packed = pack_store.entries(username)
+    seen = set()
+    upserts = []
+    moved = []
+
+    if os.path.isdir(folder_path):
+        with os.scandir(folder_path) as entries:
+            for entry in entries:
+                if not entry.is_file() or entry.name.endswith(".tmp"):
+                    continue
+                name = logical_name(entry.name)
+                if name == entry.name and os.path.exists(entry.path + ".enc"):
+                    continue  # Plaintext left next to its .enc; the .enc wins
+                if name in packed and not entry.name.endswith(dedup_store.MANIFEST_SUFFIX):
+                    continue  # Stale copy of a packed file; the pack wins
+                seen.add(name)
+                st = entry.stat()
+                if known.get(name) == (entry.path, st.st_size, st.st_mtime_ns):
+                    continue
+                try:
+                    size, content_hash, version = _describe(entry.path)
+                except ValueError:
+                    print(f"❌ Skipping unreadable file '{entry.path}'.")
+                    continue
+                now = time.time()
+                upserts.append((username, name, entry.path, size, st.st_size, now, now,
+                                version, content_hash, st.st_mtime_ns))
+
+    for name, (path, length, version) in packed.items():
+        if name in seen:
+            continue  # A manifest shadows it
+        seen.add(name)
+        row = known.get(name)
+        if row is not None and row[1:] == (length, version):
+            if row[0] != path:
+                moved.append((path, length, version, None, username, name))  # Compacted, not changed
+            continue
+        try:
+            size, content_hash, format_version = _describe_packed(username, name)
+        except ValueError:
+            print(f"❌ Skipping unreadable packed file '{name}'.")
+            continue
+        now = time.time()
+        upserts.append((username, name, path, size, length, now, now,
+                        format_version, content_hash, version))
+
+    removed = [name for name in known if name not in seen]
+    if upserts or removed or moved:
+        with db.transaction() as conn:
+            conn.executemany(UPSERT_FILE, upserts)
+            conn.executemany(UPDATE_LOCATION, moved)
+            conn.executemany(DELETE_FILE, [(username, name) for name in removed])
+    _reconciled.add((db.DB_NAME, username))
+    return len(upserts), len(removed)
+
+
+def ensure_reconciled(username):
+    """Reconcile a user's catalog the first time it is used in this process."""
+    if (db.DB_NAME, username) not in _reconciled:
+        reconcile(username)
+
+
+if __name__ == "__main__":
+    users = sys.argv[1:] or (sorted(os.listdir(ROOT)) if os.path.isdir(ROOT) else [])
+    for user in users:
+        changed, removed = reconcile(user)
+        print(f"🔄 {user}: {changed} updated, {removed} removed.")
@@ -0,0 +1,121 @@
+import json
+import os
+import threading
+import time
+from Crypto.Cipher import AES, ChaCha20_Poly1305
+
+# AEAD suites a container's chunks can be encrypted with. The id is stored in
+# the header (format version 5), so files written under different suites
+# decrypt side by side. Every suite uses the same 16-byte nonce slot and
+# 16-byte tag in a chunk record; the 96-bit-nonce suites fill the last four
+# bytes of the slot with zeros and reject anything else.
+EAX = 0
+GCM = 1
+CHACHA20_POLY1305 = 2
+SUITES = {
+    EAX: "aes-eax",                         # two passes (CTR + OMAC); all files before version 5
+    GCM: "aes-gcm",                         # one pass; fastest with AES-NI
+    CHACHA20_POLY1305: "chacha20-poly1305", # one pass; fastest without AES-NI
+}
+NONCE_SLOT = 16
+SHORT_NONCE = 12
+
+# New files use the suite named by SECURE_FILE_CIPHER or in CONFIG_FILE if
+# either is set; otherwise the fastest suite on this host, measured once per
+# process on first use.
+CONFIG_ENV = "SECURE_FILE_CIPHER"
+CONFIG_FILE = "cipher_suite.json"
+PROBE_BYTES = 256 * 1024
+PROBE_CHUNK = 64 * 1024
+
+_active = None
+_lock = threading.Lock()
+
+
+def suite_id(name):
+    """Return the id of a suite by name; raises ValueError for unknown ones."""
+    for sid, suite_name in SUITES.items():
+        if suite_name == name:
+            return sid
+    raise ValueError(f"Unknown cipher suite {name!r}; choose one of {', '.join(SUITES.values())}.")
+
+
+def new_cipher(suite, key, slot=None):
+    """Return (cipher, nonce slot) for a chunk; a fresh random nonce unless slot is given.
+
+    The cipher has update / encrypt_and_digest / decrypt_and_verify.
+    """
+    if suite == EAX:
+        slot = os.urandom(NONCE_SLOT) if slot is None else slot
+        return AES.new(key, AES.MODE_EAX, nonce=slot), slot
+    if suite not in SUITES:
+        raise ValueError(f"Unsupported cipher suite: {suite}")
+    if slot is None:
+        slot = os.urandom(SHORT_NONCE) + bytes(NONCE_SLOT - SHORT_NONCE)
+    elif any(slot[SHORT_NONCE:]):
+        raise ValueError("Encrypted chunk has a malformed nonce.")
+    nonce = slot[:SHORT_NONCE]
+    if suite == GCM:
+        return AES.new(key, AES.MODE_GCM, nonce=nonce), slot
+    return ChaCha20_Poly1305.new(key=key, nonce=nonce), slot
+
+
+def probe(size=PROBE_BYTES):
+    """Return {suite name: MB/s} for encrypting size bytes in container-sized chunks."""
+    key = os.urandom(32)
+    data = os.urandom(PROBE_CHUNK)
+    results = {}
+    for sid, name in SUITES.items():
+        new_cipher(sid, key)[0].encrypt_and_digest(data)  # Warm up
+        start = time.perf_counter()
+        for _ in range(max(1, size // PROBE_CHUNK)):
+            cipher = new_cipher(sid, key)[0]
+            cipher.update(b"probe")
+            cipher.encrypt_and_digest(data)
+        results[name] = round(size / (time.perf_counter() - start) / 1e6, 1)
+    return results
+
+
+def active_suite():
+    """Return the suite id for new files: the configured one, else the fastest probed."""
+    global _active
+    with _lock:
+        if _active is None:
+            if os.environ.get(CONFIG_ENV):
+                _active = suite_id(os.environ[CONFIG_ENV])
+            elif os.path.exists(CONFIG_FILE):
+                with open(CONFIG_FILE, "r") as f:
+                    _active = suite_id(json.load(f)["suite"])
+            else:
+                speeds = probe()
+                _active = suite_id(max(speeds, key=speeds.get))
+        return _active
+
+
+def save_config(name):
+    """Pin the suite for new files on this host; existing files keep theirs."""
+    global _active
+    sid = suite_id(name)
+    with open(CONFIG_FILE, "w") as f:
+        json.dump({"suite": name}, f, indent=2)
+    with _lock:
+        _active = sid
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Measure the cipher suites on this host.")
+    parser.add_argument("--size-mb", type=float, default=8, help="bytes encrypted per suite")
+    parser.add_argument("--save", nargs="?", const="fastest", metavar="SUITE",
+                        help=f"write the fastest (or the named) suite to {CONFIG_FILE}")
+    args = parser.parse_args()
+
+    speeds = probe(int(args.size_mb * 1024 * 1024))
+    fastest = max(speeds, key=speeds.get)
+    for name, mb_s in speeds.items():
+        print(f"⏱️ {name:<18} {mb_s:>8} MB/s{'  ← fastest' if name == fastest else ''}")
+    if args.save:
+        chosen = fastest if args.save == "fastest" else args.save
+        save_config(chosen)
+        print(f"✅ New files will use {chosen} ({CONFIG_FILE}).")
@@ -0,0 +1,472 @@
+import argparse
+import contextlib
+import csv
+import getpass
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import zlib
+import archive
+import auth
+import catalog
+import file_manager
+import quota
+import search_index
+
+# Non-interactive command line for scripts and migrations:
+#   python cli.py login --user alice --otp 123456      (password from SECURE_FILE_PASSWORD)
+#   export SECURE_FILE_TOKEN=<token printed above>
+#   python cli.py put notes.txt --file notes.txt
+#   echo "one more line" | python cli.py put notes.txt --append
+#   python cli.py batch ops.jsonl --workers 8
+#   python cli.py search 'invoice "due date" 2024*'
+#   python cli.py export-archive --out backup.tar
+# Every command writes JSON lines to stdout; the emoji progress messages of
+# the underlying modules go to stderr so they never corrupt the output.
+TOKEN_ENV = "SECURE_FILE_TOKEN"
+PASSWORD_ENV = "SECURE_FILE_PASSWORD"
+OTP_ENV = "SECURE_FILE_OTP"
+TRANSPORT_ENV = "SECURE_FILE_TRANSPORT_PASSPHRASE"
+DEFAULT_WORKERS = min(8, (os.cpu_count() or 2) * 2)
+QUEUE_DEPTH = 64  # operations read ahead per worker; bounds memory on huge manifests
+
+_out = sys.stdout
+
+
+class CliError(Exception):
+    pass
+
+
+def emit(record):
+    _out.write(json.dumps(record) + "\n")
+    _out.flush()
+
+
+def check_name(name):
+    """Reject names that would escape the user's folder."""
+    if not name or name.startswith(".") or "/" in name or "\\" in name or os.sep in name:
+        raise CliError(f"Invalid file name: {name!r}")
+    return name
+
+
+def login(args):
+    """Authenticate from flags/environment without prompting, unless on a terminal."""
+    if not args.user:
+        raise CliError("--user is required to log in.")
+    password = os.environ.get(PASSWORD_ENV)
+    if password is None:
+        if not sys.stdin.isatty():
+            raise CliError(f"Set {PASSWORD_ENV} to log in non-interactively.")
+        password = getpass.getpass("Password: ")
+    otp = args.otp or os.environ.get(OTP_ENV)
+    if not otp:
+        raise CliError(f"Pass --otp or set {OTP_ENV}.")
+    role = auth.authenticate(args.user, password, otp)
+    if role is None:
+        raise CliError("Invalid credentials or 2FA code.")
+    return args.user, role
+
+
+def resolve_user(args):
+    """Return (username, role) from a token, falling back to a one-off login."""
+    token = args.token or os.environ.get(TOKEN_ENV)
+    if not token:
+        return login(args)
+    username = auth.verify_token(token)
+    role = auth.get_user_role(username) if username else None
+    if role is None:
+        raise CliError("Invalid or expired token; run 'login' again.")
+    return username, role
+
+
+# --- operations shared by the single commands and batch ---
+
+def op_put(username, op):
+    name = check_name(op.get("name", ""))
+    if "content" in op:
+        content = op["content"]
+    elif "source" in op:
+        with open(op["source"], "r", encoding="utf-8") as f:
+            content = f.read()
+    else:
+        raise CliError("put needs 'content' or 'source'.")
+    append = str(op.get("append", "")).lower() in ("1", "true", "yes")  # CSV cells are strings
+    if append or op.get("offset") is not None:
+        # Patches the existing file, re-encrypting only the blocks it touches
+        if not file_manager.stored_path(username, name):
+            raise CliError(f"File '{name}' not found.")
+        offset = None if append else int(op["offset"])
+        file_manager.edit_file(username, name, content, offset)
+        action = "edited"
+    elif file_manager.stored_path(username, name):
+        file_manager.update_file(username, name, content)
+        action = "updated"
+    else:
+        file_manager.create_file(username, name, content)
+        action = "created"
+    return {"action": action, "bytes": len(content.encode())}
+
+
+def op_get(username, op):
+    name = check_name(op.get("name", ""))
+    content = file_manager.read_file(username, name)
+    if content is None:
+        raise CliError(f"File '{name}' not found.")
+    if "dest" not in op:
+        return {"content": content}
+    os.makedirs(os.path.dirname(op["dest"]) or ".", exist_ok=True)
+    with open(op["dest"], "w", encoding="utf-8") as f:
+        f.write(content)
+    return {"dest": op["dest"], "bytes": len(content.encode())}
+
+
+def op_rm(username, op):
+    name = check_name(op.get("name", ""))
+    if not file_manager.stored_path(username, name):
+        raise CliError(f"File '{name}' not found.")
+    file_manager.delete_file(username, name)
+    return {}
+
+
+OPERATIONS = {"put": op_put, "get": op_get, "rm": op_rm}
+
+
+def execute(username, line, op):
+    """Run one operation, turning any failure into an error record."""
+    start = time.perf_counter()
+    record = {"line": line, "op": op.get("op"), "name": op.get("name")}
+    try:
+        if "invalid" in op:
+            raise CliError(op["invalid"])
+        handler = OPERATIONS.get(op.get("op"))
+        if handler is None:
+            raise CliError(f"Unknown operation {op.get('op')!r}; expected one of {', '.join(OPERATIONS)}.")
+        record.update(handler(username, op))
+        record["ok"] = True
+    except Exception as e:  # One bad row must not stop an unattended migration
+        record["ok"] = False
+        record["error"] = str(e)
+    record["ms"] = round((time.perf_counter() - start) * 1000, 3)
+    return record
+
+
+def run_pipeline(username, ops, workers=DEFAULT_WORKERS):
+    """Run (line, op) pairs on a pool of worker threads, yielding records as they finish.
+
+    Operations are routed by file name, so the ones touching the same file
+    run on the same worker in manifest order. The per-worker queues are
+    bounded, so the manifest is read only as fast as the workers keep up.
+    """
+    inboxes = [queue.Queue(QUEUE_DEPTH) for _ in range(workers)]
+    results = queue.Queue()
+
+    def work(inbox):
+        while True:
+            item = inbox.get()
+            if item is None:
+                results.put(None)
+                return
+            results.put(execute(username, *item))
+
+    def feed():
+        try:
+            for line, op in ops:
+                name = str(op.get("name", ""))
+                inboxes[zlib.crc32(name.encode()) % workers].put((line, op))
+        except Exception as e:  # e.g. the manifest became unreadable mid-way
+            results.put({"line": None, "op": None, "name": None, "ok": False, "error": f"manifest: {e}"})
+        finally:
+            for inbox in inboxes:
+                inbox.put(None)
+
+    for inbox in inboxes:
+        threading.Thread(target=work, args=(inbox,), daemon=True).start()
+    threading.Thread(target=feed, daemon=True).start()
+
+    running = workers
+    while running:
+        record = results.get()
+        if record is None:
+            running -= 1
+        else:
+            yield record
+
+
+def read_manifest(stream, fmt):
+    """Yield (line number, op dict) from a JSONL or CSV manifest."""
+    if fmt == "csv":
+        for number, row in enumerate(csv.DictReader(stream), 2):
+            yield number, {k: v for k, v in row.items() if k and v not in (None, "")}
+        return
+    for number, text in enumerate(stream, 1):
+        text = text.strip()
+        if not text or text.startswith("#"):
+            continue
+        try:
+            op = json.loads(text)
+        except ValueError as e:
+            op = {"invalid": f"Invalid JSON: {e}"}
+        if not isinstance(op, dict):
+            op = {"invalid": "Each line must be a JSON object."}
+        yield number, op
+
+
+def report(records):
+    """Emit every record and a final summary; returns the number of failures."""
+    start = time.perf_counter()
+    ok = failed = 0
+    for record in records:
+        emit(record)
+        if record["ok"]:
+            ok += 1
+        else:
+            failed += 1
+    elapsed = time.perf_counter() - start
+    emit({"summary": {"ok": ok, "failed": failed, "seconds": round(elapsed, 3),
+                      "ops_per_s": round((ok + failed) / elapsed, 1) if elapsed else None}})
+    return failed
+
+
+# --- subcommands ---
+
+def cmd_login(args):
+    username, role = login(args)
+    emit({"user": username, "role": role, "token": auth.issue_token(username, args.ttl),
+          "expires_in": args.ttl})
+    return 0
+
+
+def cmd_put(args):
+    username, _ = resolve_user(args)
+    op = {"op": "put", "name": args.name}
+    if args.file:
+        op["source"] = args.file
+    else:
+        op["content"] = sys.stdin.read()
+    if args.append:
+        op["append"] = True
+    elif args.offset is not None:
+        op["offset"] = args.offset
+    record = execute(username, None, op)
+    emit(record)
+    return 0 if record["ok"] else 1
+
+
+def cmd_get(args):
+    username, _ = resolve_user(args)
+    op = {"op": "get", "name": args.name}
+    if args.out:
+        op["dest"] = args.out
+    record = execute(username, None, op)
+    if record["ok"] and not args.out:
+        _out.write(record["content"])  # Raw content, so `get name > file` works
+        return 0
+    emit(record)
+    return 0 if record["ok"] else 1
+
+
+def cmd_rm(args):
+    username, _ = resolve_user(args)
+    record = execute(username, None, {"op": "rm", "name": args.name})
+    emit(record)
+    return 0 if record["ok"] else 1
+
+
+def cmd_ls(args):
+    username, _ = resolve_user(args)
+    rows = catalog.list_files(username, order_by=args.sort, descending=args.desc,
+                              limit=args.limit, offset=args.offset)
+    for row in rows:
+        emit({"name": row["name"], "size": row["size"], "stored_size": row["stored_size"],
+              "modified_at": row["modified_at"]})
+    return 0
+
+
+def cmd_search(args):
+    username, _ = resolve_user(args)
+    for name, score in search_index.search(username, args.query, limit=args.limit):
+        emit({"name": name, "score": score})
+    return 0
+
+
+def cmd_users(args):
+    _, role = resolve_user(args)
+    if role != "admin":
+        raise CliError("Only admins can list users.")
+    for row in quota.usage_report():
+        emit(row)
+    return 0
+
+
+def cmd_batch(args):
+    username, _ = resolve_user(args)
+    fmt = args.format or ("csv" if args.manifest.endswith(".csv") else "jsonl")
+    if args.manifest == "-":
+        ops = read_manifest(sys.stdin, fmt)
+        return 1 if report(run_pipeline(username, ops, args.workers)) else 0
+    with open(args.manifest, "r", encoding="utf-8", newline="") as f:
+        return 1 if report(run_pipeline(username, read_manifest(f, fmt), args.workers)) else 0
+
+
+def _import_ops(paths):
+    line = 0
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, _, names in os.walk(path):
+                for name in sorted(names):
+                    line += 1
+                    yield line, {"op": "put", "name": name, "source": os.path.join(dirpath, name)}
+        else:
+            line += 1
+            yield line, {"op": "put", "name": os.path.basename(path), "source": path}
+
+
+def cmd_import(args):
+    username, _ = resolve_user(args)
+    return 1 if report(run_pipeline(username, _import_ops(args.paths), args.workers)) else 0
+
+
+def cmd_export(args):
+    username, _ = resolve_user(args)
+    ops = ((i, {"op": "get", "name": name, "dest": os.path.join(args.directory, name)})
+           for i, name in enumerate(catalog.list_names(username), 1))
+    return 1 if report(run_pipeline(username, ops, args.workers)) else 0
+
+
+def transport_passphrase(args):
+    """Passphrase for transport encryption from the environment, or a prompt with --encrypt."""
+    passphrase = os.environ.get(TRANSPORT_ENV)
+    if passphrase or not args.encrypt:
+        return passphrase
+    if not sys.stdin.isatty():
+        raise CliError(f"Set {TRANSPORT_ENV} to use --encrypt non-interactively.")
+    return getpass.getpass("Transport passphrase: ")
+
+
+def cmd_export_archive(args):
+    username, _ = resolve_user(args)
+    fmt = args.format or ("zip" if args.out.endswith(".zip") else "tar")
+    passphrase = transport_passphrase(args) if args.encrypt else None
+    start = time.perf_counter()
+    size = 0
+    if args.out == "-":
+        _out.flush()
+        for piece in archive.export_stream(username, fmt, passphrase):
+            _out.buffer.write(piece)  # Raw archive, so `export-archive > files.tar` works
+        _out.buffer.flush()
+        return 0
+    with open(args.out, "wb") as f:
+        for piece in archive.export_stream(username, fmt, passphrase):
+            f.write(piece)
+            size += len(piece)
+    emit({"archive": args.out, "format": fmt, "encrypted": bool(passphrase), "bytes": size,
+          "seconds": round(time.perf_counter() - start, 3)})
+    return 0
+
+
+def cmd_import_archive(args):
+    username, _ = resolve_user(args)
+    passphrase = transport_passphrase(args)
+    try:
+        if args.archive == "-":
+            return 1 if report(archive.import_stream(username, sys.stdin.buffer, passphrase, args.workers)) else 0
+        with open(args.archive, "rb") as f:
+            return 1 if report(archive.import_stream(username, f, passphrase, args.workers)) else 0
+    except ValueError as e:  # Unreadable archive or wrong passphrase
+        raise CliError(str(e))
+
+
+def build_parser():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--token", help=f"session token from 'login' (default: ${TOKEN_ENV})")
+    common.add_argument("--user", help="log in as this user instead of using a token")
+    common.add_argument("--otp", help=f"current 2FA code (default: ${OTP_ENV})")
+    common.add_argument("--quiet", action="store_true", help="drop progress messages instead of sending them to stderr")
+    pool = argparse.ArgumentParser(add_help=False)
+    pool.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="worker threads (default: %(default)s)")
+
+    parser = argparse.ArgumentParser(description="Secure File Manager command line.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("login", parents=[common], help="authenticate once and print a token")
+    p.add_argument("--ttl", type=int, default=auth.TOKEN_TTL, help="token lifetime in seconds")
+    p.set_defaults(func=cmd_login)
+
+    p = sub.add_parser("put", parents=[common], help="create or replace a file (from --file or stdin)")
+    p.add_argument("name")
+    p.add_argument("--file", help="local file to upload")
+    edit = p.add_mutually_exclusive_group()
+    edit.add_argument("--append", action="store_true", help="append to the existing file")
+    edit.add_argument("--offset", type=int, help="overwrite the existing file from this byte offset")
+    p.set_defaults(func=cmd_put)
+
+    p = sub.add_parser("get", parents=[common], help="print a file, or save it with --out")
+    p.add_argument("name")
+    p.add_argument("--out", help="write the content to this path")
+    p.set_defaults(func=cmd_get)
+
+    p = sub.add_parser("rm", parents=[common], help="delete a file")
+    p.add_argument("name")
+    p.set_defaults(func=cmd_rm)
+
+    p = sub.add_parser("ls", parents=[common], help="list files from the catalog")
+    p.add_argument("--sort", choices=catalog.SORT_COLUMNS, default="name")
+    p.add_argument("--desc", action="store_true")
+    p.add_argument("--limit", type=int)
+    p.add_argument("--offset", type=int, default=0)
+    p.set_defaults(func=cmd_ls)
+
+    p = sub.add_parser("search", parents=[common], help='full-text search: words, prefix*, "a phrase"')
+    p.add_argument("query")
+    p.add_argument("--limit", type=int)
+    p.set_defaults(func=cmd_search)
+
+    p = sub.add_parser("users", parents=[common], help="list users (admin only)")
+    p.set_defaults(func=cmd_users)
+
+    p = sub.add_parser("batch", parents=[common, pool], help="run a JSONL/CSV manifest of put/get/rm operations")
+    p.add_argument("manifest", help="manifest path, or - for stdin")
+    p.add_argument("--format", choices=("jsonl", "csv"), help="default: from the file extension, else jsonl")
+    p.set_defaults(func=cmd_batch)
+
+    p = sub.add_parser("import", parents=[common, pool], help="upload local files or directories")
+    p.add_argument("paths", nargs="+")
+    p.set_defaults(func=cmd_import)
+
+    p = sub.add_parser("export", parents=[common, pool], help="download every file into a directory")
+    p.add_argument("directory")
+    p.set_defaults(func=cmd_export)
+
+    p = sub.add_parser("export-archive", parents=[common], help="stream every file into a tar or zip")
+    p.add_argument("--out", default="-", help="archive path, or - for stdout (default)")
+    p.add_argument("--format", choices=archive.FORMATS, help="default: from --out, else tar")
+    p.add_argument("--encrypt", action="store_true",
+                   help=f"re-encrypt files for transport (passphrase from ${TRANSPORT_ENV} or a prompt)")
+    p.set_defaults(func=cmd_export_archive)
+
+    p = sub.add_parser("import-archive", parents=[common, pool], help="store every file of a tar or zip")
+    p.add_argument("archive", help="archive path, or - for a tar on stdin")
+    p.add_argument("--encrypt", action="store_true", help="prompt for the transport passphrase if not set")
+    p.set_defaults(func=cmd_import_archive)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    sink = open(os.devnull, "w") if args.quiet else sys.stderr
+    try:
+        with contextlib.redirect_stdout(sink):
+            return args.func(args)
+    except CliError as e:
+        emit({"ok": False, "error": str(e)})
+        return 2
+    finally:
+        if args.quiet:
+            sink.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
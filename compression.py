@@ -0,0 +1,115 @@
+import lzma
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # Optional: zstd is only offered when the package is installed
+    zstandard = None
+
+# Codec ids as recorded in the container header (see security).
+NONE = 0
+ZLIB = 1
+LZMA = 2
+ZSTD = 3
+CODECS = {"none": NONE, "zlib": ZLIB, "lzma": LZMA, "zstd": ZSTD}
+CODEC_NAMES = {v: k for k, v in CODECS.items()}
+
+# A quick level-1 zlib pass over the first chunk decides whether compressing
+# is worth it; images, archives and other compressed data rarely shrink.
+SNIFF_LEVEL = 1
+MIN_SIZE = 512        # below this the header overhead beats any saving
+MAX_RATIO = 0.9       # compress only if the sample shrinks to at most this fraction
+OUTPUT_LIMIT = 64 * 1024
+
+
+def available_codecs():
+    """Return the names of the codecs this installation can write."""
+    return [name for name, cid in CODECS.items() if cid != ZSTD or zstandard is not None]
+
+
+def codec_id(name):
+    """Map a codec name to its header id, rejecting codecs that are unavailable."""
+    if name not in CODECS or name not in available_codecs():
+        raise ValueError(f"Unsupported compression codec: {name}")
+    return CODECS[name]
+
+
+def should_compress(sample):
+    """Trial-compress a sample and report whether the data looks compressible."""
+    if len(sample) < MIN_SIZE:
+        return False
+    return len(zlib.compress(sample, SNIFF_LEVEL)) <= len(sample) * MAX_RATIO
+
+
+def _compressor(codec, level):
+    if codec == ZLIB:
+        return zlib.compressobj(level)
+    if codec == LZMA:
+        return lzma.LZMACompressor(preset=level)
+    if codec == ZSTD and zstandard is not None:
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    raise ValueError(f"Unsupported compression codec id: {codec}")
+
+
+def _decompressor(codec):
+    if codec == ZLIB:
+        return zlib.decompressobj()
+    if codec == LZMA:
+        return lzma.LZMADecompressor()
+    raise ValueError(f"Unsupported compression codec id: {codec}")
+
+
+class _ChunkReader:
+    """read()-able view of an iterator of byte chunks, for zstandard's stream API."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+
+    def read(self, size=-1):
+        return next(self._chunks, b"")
+
+
+def iter_compress(chunks, codec, level, stats):
+    """Compress an iterator of byte chunks, counting input bytes in stats["in"]."""
+    compressor = _compressor(codec, level)
+    for chunk in chunks:
+        stats["in"] += len(chunk)
+        out = compressor.compress(chunk)
+        if out:
+            yield out
+    yield compressor.flush()
+
+
+def iter_decompress(chunks, codec):
+    """Decompress an iterator of byte chunks.
+
+    Output is produced in pieces of at most OUTPUT_LIMIT bytes, so a highly
+    compressible chunk cannot blow up memory.
+    """
+    if codec == ZSTD and zstandard is not None:
+        reader = _ChunkReader(chunks)
+        yield from zstandard.ZstdDecompressor().read_to_iter(reader, write_size=OUTPUT_LIMIT)
+        return
+    decompressor = _decompressor(codec)
+    for chunk in chunks:
+        if codec == ZLIB:
+            while chunk:
+                out = decompressor.decompress(chunk, OUTPUT_LIMIT)
+                chunk = decompressor.unconsumed_tail
+                if out:
+                    yield out
+        else:
+            # LZMA keeps unconsumed input itself; needs_input says when it has run dry
+            while not decompressor.eof:
+                out = decompressor.decompress(chunk, OUTPUT_LIMIT)
+                chunk = b""
+                if out:
+                    yield out
+                if decompressor.needs_input:
+                    break
+    if codec == ZLIB:
+        out = decompressor.flush()
+        if out:
+            yield out
+    if not decompressor.eof:
+        raise ValueError("Compressed data is truncated.")
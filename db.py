@@ -0,0 +1,147 @@
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+DB_NAME = "secure_file_manager.db"
+POOL_SIZE = 8
+POOL_TIMEOUT = 30          # seconds to wait for a free connection
+STATEMENT_CACHE_SIZE = 256  # prepared statements kept per connection
+
+# Applied to every new connection. WAL lets readers run alongside a writer,
+# and NORMAL sync is durable across application crashes in WAL mode.
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",
+    "PRAGMA foreign_keys=ON",
+)
+
+
+class ConnectionPool:
+    """A bounded, thread-safe pool of SQLite connections to one database file.
+
+    Streamlit runs each rerun on a fresh thread, so connections are pooled
+    rather than kept per thread; they are created lazily up to max_size.
+    """
+
+    def __init__(self, path, max_size=POOL_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=POOL_TIMEOUT,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE,
+        )
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self):
+        """Return an idle or new connection, waiting up to POOL_TIMEOUT for one to be released."""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.max_size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        try:
+            return self._idle.get(timeout=POOL_TIMEOUT)
+        except queue.Empty:
+            raise sqlite3.OperationalError(
+                f"connection pool exhausted: all {self.max_size} connections to {self.path} "
+                f"stayed busy for {POOL_TIMEOUT} s") from None
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(path=None):
+    """Return the shared pool for path (DB_NAME by default)."""
+    path = path or DB_NAME
+    with _pools_lock:
+        pool = _pools.get(path)
+        if pool is None:
+            pool = _pools[path] = ConnectionPool(path)
+        return pool
+
+
+@contextmanager
+def connection(path=None):
+    """Borrow a pooled connection for the duration of a with-block."""
+    pool = get_pool(path)
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+
+@contextmanager
+def transaction(path=None):
+    """Borrow a pooled connection and commit on success, rolling back on error."""
+    with connection(path) as conn:
+        with conn:
+            yield conn
+
+
+def query_one(sql, params=(), path=None):
+    """Run a read query and return its first row, or None."""
+    with connection(path) as conn:
+        return conn.execute(sql, params).fetchone()
+
+
+def query_all(sql, params=(), path=None):
+    """Run a read query and return all rows."""
+    with connection(path) as conn:
+        return conn.execute(sql, params).fetchall()
+
+
+def execute(sql, params=(), path=None):
+    """Run a single write statement in its own transaction; returns the row count."""
+    with transaction(path) as conn:
+        return conn.execute(sql, params).rowcount
+
+
+def close_all():
+    """Close every idle pooled connection (e.g. at shutdown or between tests)."""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
@@ -0,0 +1,319 @@
+import bisect
+import hashlib
+import hmac
+import json
+import os
+import random
+import sys
+import threading
+import db
+import durable
+import key_manager
+import security
+
+try:
+    import numpy
+except ImportError:  # Optional: chunk boundaries are then found one byte at a time in Python
+    numpy = None
+
+# Optional storage backend: file contents are split into content-defined
+# chunks, each chunk is encrypted and stored once per user under
+#   chunk_store/<username>/<first two hex chars>/<chunk id>.enc
+# and the file itself becomes an encrypted manifest listing its chunks:
+#   secure_files/<username>/<name>.manifest
+# Chunk ids are HMACs of the plaintext under a per-user key, so equal content
+# dedups within a user without the ids revealing anything about it.
+CHUNK_ROOT = "chunk_store"
+MANIFEST_SUFFIX = ".manifest"
+MIN_CHUNK = 2 * 1024
+AVG_CHUNK = 8 * 1024
+MAX_CHUNK = 64 * 1024
+
+CREATE_CHUNKS = '''CREATE TABLE IF NOT EXISTS chunks (
+                    username TEXT NOT NULL,
+                    chunk_id TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    stored_size INTEGER NOT NULL,
+                    refcount INTEGER NOT NULL,
+                    PRIMARY KEY (username, chunk_id))'''
+INSERT_CHUNK = '''INSERT INTO chunks (username, chunk_id, size, stored_size, refcount) VALUES (?, ?, ?, ?, 1)
+                  ON CONFLICT (username, chunk_id) DO UPDATE SET refcount = refcount + 1'''
+INCREF = 'UPDATE chunks SET refcount = refcount + 1 WHERE username = ? AND chunk_id = ?'
+DECREF = 'UPDATE chunks SET refcount = refcount - 1 WHERE username = ? AND chunk_id = ?'
+SELECT_GARBAGE = 'SELECT chunk_id FROM chunks WHERE username = ? AND refcount <= 0'
+DELETE_CHUNK = 'DELETE FROM chunks WHERE username = ? AND chunk_id = ? AND refcount <= 0'
+SELECT_STATS = '''SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(size * refcount), 0),
+                         COALESCE(SUM(stored_size), 0)
+                  FROM chunks WHERE username = ?'''
+
+# Gear rolling hash table (FastCDC). Fixed seed: boundaries must be stable
+# across processes and releases or nothing would ever dedup.
+_rng = random.Random(0x5EC0DE)
+_GEAR = [_rng.getrandbits(64) for _ in range(256)]
+_MASK64 = (1 << 64) - 1
+# Normalized chunking: a stricter mask before the average size and a looser
+# one after it pulls chunk sizes towards AVG_CHUNK. The masks test the high
+# bits, which depend on the whole 64-byte window rather than the last few bytes.
+_BITS = AVG_CHUNK.bit_length() - 1
+_MASK_SMALL = ((1 << (_BITS + 2)) - 1) << (64 - _BITS - 2)
+_MASK_LARGE = ((1 << (_BITS - 2)) - 1) << (64 - _BITS + 2)
+# With numpy, the hash of every 64-byte window is computed for a block of
+# HASH_BLOCK bytes at a time, and only the first 63 bytes scanned after a cut
+# (where the window still reaches back before the scan) are hashed in Python.
+HASH_BLOCK = 1024 * 1024
+_WINDOW = 64
+_GEAR_ARRAY = numpy.array(_GEAR, dtype=numpy.uint64) if numpy is not None else None
+
+_initialized = set()
+_lock = threading.Lock()
+
+
+def initialize():
+    """Create the chunk reference table once per database per process."""
+    if db.DB_NAME in _initialized:
+        return
+    with _lock:
+        if db.DB_NAME not in _initialized:
+            with db.transaction() as conn:
+                conn.execute(CREATE_CHUNKS)
+            _initialized.add(db.DB_NAME)
+
+
+def _window_hashes(block):
+    """Return the gear hash of the window ending at each byte of a uint8 array.
+
+    h[j] = sum(gear[block[j - s]] << s for s < 64), built by doubling the
+    window six times instead of adding 64 shifted copies; uint64 arithmetic
+    wraps like the & _MASK64 in the Python loop.
+    """
+    h = _GEAR_ARRAY[block]
+    step = 1
+    while step < _WINDOW:
+        shifted = numpy.zeros_like(h)
+        shifted[step:] = h[:-step] << numpy.uint64(step)
+        h += shifted
+        step *= 2
+    return h
+
+
+def _cut_points(data):
+    """Return sorted lists of the positions whose window hash passes the small and the large mask."""
+    array = numpy.frombuffer(data, dtype=numpy.uint8)
+    small, large = [], []
+    for block_start in range(0, len(array), HASH_BLOCK):
+        lead = min(block_start, _WINDOW - 1)  # Bytes of the previous block the first windows reach back to
+        h = _window_hashes(array[block_start - lead:block_start + HASH_BLOCK])[lead:]
+        small += (numpy.flatnonzero((h & numpy.uint64(_MASK_SMALL)) == 0) + block_start).tolist()
+        large += (numpy.flatnonzero((h & numpy.uint64(_MASK_LARGE)) == 0) + block_start).tolist()
+    return small, large
+
+
+def _first_at_or_after(positions, lo, hi):
+    k = bisect.bisect_left(positions, lo)
+    return positions[k] if k < len(positions) and positions[k] < hi else None
+
+
+def _vectorized_boundaries(data):
+    """chunk_boundaries using numpy; yields exactly the same chunks."""
+    gear = _GEAR
+    small, large = _cut_points(data)
+    n = len(data)
+    start = 0
+    while start < n:
+        end = min(start + MAX_CHUNK, n)
+        if end - start <= MIN_CHUNK:
+            yield start, end
+            return
+        h = 0
+        i = start + MIN_CHUNK
+        normal = min(start + AVG_CHUNK, end)
+        cut = None
+        # The hash restarts at i, so until 64 bytes are in it, it differs from the window hash
+        for j in range(i, min(i + _WINDOW - 1, end)):
+            h = ((h << 1) + gear[data[j]]) & _MASK64
+            if not h & (_MASK_SMALL if j < normal else _MASK_LARGE):
+                cut = j + 1
+                break
+        else:
+            rest = i + _WINDOW - 1
+            j = _first_at_or_after(small, rest, normal)
+            if j is None:
+                j = _first_at_or_after(large, max(rest, normal), end)
+            if j is not None:
+                cut = j + 1
+        cut = end if cut is None else cut
+        yield start, cut
+        start = cut
+
+
+def chunk_boundaries(data):
+    """Yield (start, end) offsets of the content-defined chunks of data."""
+    if numpy is not None and len(data) > MIN_CHUNK:
+        yield from _vectorized_boundaries(data)
+        return
+    gear = _GEAR
+    n = len(data)
+    start = 0
+    while start < n:
+        end = min(start + MAX_CHUNK, n)
+        if end - start <= MIN_CHUNK:
+            yield start, end
+            return
+        h = 0
+        i = start + MIN_CHUNK
+        normal = min(start + AVG_CHUNK, end)
+        cut = end
+        while i < normal:
+            h = ((h << 1) + gear[data[i]]) & _MASK64
+            if not h & _MASK_SMALL:
+                cut = i + 1
+                break
+            i += 1
+        else:
+            while i < end:
+                h = ((h << 1) + gear[data[i]]) & _MASK64
+                if not h & _MASK_LARGE:
+                    cut = i + 1
+                    break
+                i += 1
+        yield start, cut
+        start = cut
+
+
+def chunk_id(username, chunk):
+    return hmac.new(key_manager.user_hmac_key(username), chunk, hashlib.sha256).hexdigest()
+
+
+def _chunk_path(username, cid):
+    return os.path.join(CHUNK_ROOT, username, cid[:2], cid + ".enc")
+
+
+def manifest_path(username, name):
+    return os.path.join("secure_files", username, name + MANIFEST_SUFFIX)
+
+
+def _store_chunks(username, data):
+    """Take a reference on every chunk of data, writing the ones the user lacks.
+
+    Returns the manifest entries [[id, size], ...]. Chunk files are only put
+    in place or removed (see gc) while holding the database write lock, so a
+    concurrent gc can never delete a chunk that was just referenced.
+    """
+    entries = []
+    written = []
+    view = memoryview(data)
+    for start, end in chunk_boundaries(data):
+        chunk = bytes(view[start:end])
+        cid = chunk_id(username, chunk)
+        entries.append([cid, len(chunk)])
+        with db.transaction() as conn:
+            if conn.execute(INCREF, (username, cid)).rowcount:
+                continue
+
+        path = _chunk_path(username, cid)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = durable.temp_path(path)  # recover() clears it away if this process dies
+        security.write_encrypted(tmp_path, chunk, owner=username, compress=True, atomic=False)
+        stored_size = os.path.getsize(tmp_path)
+        with db.transaction() as conn:
+            conn.execute(INSERT_CHUNK, (username, cid, len(chunk), stored_size))
+            os.replace(tmp_path, path)
+        written.append(path)
+    durable.flush_paths(written)  # New chunks must be on disk before a manifest points at them
+    return entries
+
+
+def _read_manifest(path, username=None):
+    return json.loads(security.read_encrypted(path, owner=username))
+
+
+def put(username, name, data):
+    """Store data as name, writing only chunks the user does not already have.
+
+    Replacing an existing file releases the chunks only it referenced.
+    Returns (bytes of data, bytes of new chunks written).
+    """
+    initialize()
+    before = stats(username)["stored_bytes"]
+    path = manifest_path(username, name)
+    old_entries = _read_manifest(path, username)["chunks"] if os.path.exists(path) else []
+
+    # Take the new references before the manifest becomes visible, and only
+    # drop the old ones after it replaced the previous version.
+    with key_manager.user_key_lock(username):  # New chunks are not written during a key rotation
+        entries = _store_chunks(username, data)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        manifest = json.dumps({"size": len(data), "chunks": entries}).encode()
+        security.write_encrypted(path, manifest, owner=username, compress=True)
+    if old_entries:
+        _release(username, old_entries)
+    return len(data), stats(username)["stored_bytes"] - before
+
+
+def get(username, name):
+    """Reassemble and return a deduplicated file's content."""
+    manifest = _read_manifest(manifest_path(username, name), username)
+    out = bytearray()
+    for cid, size in manifest["chunks"]:
+        chunk = security.read_encrypted(_chunk_path(username, cid), owner=username)
+        if len(chunk) != size or not hmac.compare_digest(chunk_id(username, chunk), cid):
+            raise ValueError(f"Chunk {cid} of '{name}' is corrupt.")
+        out += chunk
+    return bytes(out)
+
+
+def manifest_size(path):
+    """Return the content size recorded in a manifest file."""
+    return _read_manifest(path)["size"]
+
+
+def delete(username, name):
+    """Delete a deduplicated file, garbage-collecting chunks nothing else references."""
+    path = manifest_path(username, name)
+    if not os.path.exists(path):
+        return False
+    entries = _read_manifest(path, username)["chunks"]
+    os.remove(path)
+    _release(username, entries)
+    return True
+
+
+def _release(username, entries):
+    initialize()
+    with db.transaction() as conn:
+        conn.executemany(DECREF, [(username, cid) for cid, _ in entries])
+    gc(username)
+
+
+def gc(username):
+    """Delete every chunk of a user whose reference count dropped to zero."""
+    initialize()
+    removed = 0
+    for (cid,) in db.query_all(SELECT_GARBAGE, (username,)):
+        with db.transaction() as conn:
+            if conn.execute(DELETE_CHUNK, (username, cid)).rowcount:
+                path = _chunk_path(username, cid)
+                if os.path.exists(path):
+                    os.remove(path)  # Still inside the transaction; see _store_chunks
+                removed += 1
+    return removed
+
+
+def stats(username):
+    """Return chunk counts, logical vs. unique bytes and the dedup ratio for a user."""
+    initialize()
+    count, unique_bytes, logical_bytes, stored_bytes = db.query_one(SELECT_STATS, (username,))
+    return {
+        "chunks": count,
+        "logical_bytes": logical_bytes,
+        "unique_bytes": unique_bytes,
+        "stored_bytes": stored_bytes,
+        "dedup_ratio": round(logical_bytes / unique_bytes, 3) if unique_bytes else 1.0,
+    }
+
+
+if __name__ == "__main__":
+    for user in sys.argv[1:]:
+        s = stats(user)
+        print(f"📦 {user}: {s['chunks']} chunk(s), {s['logical_bytes']} logical bytes, "
+              f"{s['unique_bytes']} unique bytes, dedup ratio {s['dedup_ratio']}x")
@@ -0,0 +1,536 @@
+import itertools
+import json
+import os
+import queue
+import struct
+import sys
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows: journals cannot be locked, see _claim
+    fcntl = None
+
+# Crash-safe replacement of files. Every write goes to a temp file next to
+# its target, and the target is only replaced once the temp file is on disk:
+#
+#   1. write <path>.<pid>.<n>.durable.tmp (no fsync yet)
+#   2. flush the temp file to disk
+#   3. append an intent {"i", "tmp", "path", "before"} to this process's journal and flush it
+#   4. rename the temp file over path and flush the directory
+#   5. append {"d": [ids]} to the journal (not flushed; redoing is harmless)
+#
+# After a crash, recover() rolls every intent forward whose temp file still
+# exists (its data was flushed before the intent could be) and deletes
+# orphaned temp files of dead processes, i.e. writes that never got an intent.
+# "before" is the target's (inode, mtime, size) when the intent was made; an
+# intent whose target has been rewritten since by a live process is dropped
+# instead, and the comparison and replay happen under an flock on the target.
+#
+# With group commit, one thread commits every write that queued up while the
+# previous batch was being flushed. A batch then costs one syncfs() per
+# filesystem for the data, one journal fsync and one syncfs() for the
+# renames, instead of three fsync() calls per file.
+#
+# In-place patches (patch_file) use the same journal as a redo log: the
+# edits go to a temp file first, an intent {"i", "tmp", "path", "patch"} is
+# flushed, and only then is the target modified. recover() re-applies a
+# patch whose temp file still exists, which is harmless if it had finished.
+JOURNAL_DIR = ".journal"
+TMP_SUFFIX = ".durable.tmp"
+RECOVERY_ROOTS = ("secure_files", "chunk_store", "search_index", "pack_store")
+GROUP_COMMIT = True
+JOURNAL_LIMIT = 1024 * 1024  # bytes; the journal is truncated past this once idle
+KEEP_SIZE = 2 ** 64 - 1      # size recorded by patch_file(size=None): leave the length alone
+
+_lock = threading.Lock()
+_journal = None
+_committer = None
+_syncfs = False  # not probed yet
+_counter = itertools.count()
+
+
+class Journal:
+    """Append-only intent log owned (and locked) by one process."""
+
+    def __init__(self, directory=JOURNAL_DIR):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"{os.getpid()}.log")
+        self._file = open(self.path, "ab")
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._ids = itertools.count()
+        self._open = set()  # intents not yet marked done
+        self._lock = threading.Lock()
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def intend(self, entries, patch=False):
+        """Record (tmp, path) pairs about to be renamed (or patched in); returns their ids. Not yet durable."""
+        extra = {"patch": True} if patch else {}
+        before = [_state(path) for _, path in entries]
+        with self._lock:
+            ids = [next(self._ids) for _ in entries]
+            self._open.update(ids)
+            lines = [json.dumps({"i": i, "tmp": tmp, "path": path, "before": state, **extra}) + "\n"
+                     for i, (tmp, path), state in zip(ids, entries, before)]
+            self._file.write("".join(lines).encode())
+            self._file.flush()
+            return ids
+
+    def done(self, ids):
+        with self._lock:
+            self._open.difference_update(ids)
+            self._file.write((json.dumps({"d": ids}) + "\n").encode())
+            self._file.flush()
+            if not self._open and self._file.tell() > JOURNAL_LIMIT:
+                self._file.truncate(0)  # Everything written so far is complete
+
+    def sync(self):
+        os.fsync(self._file.fileno())
+
+
+def _get_journal():
+    global _journal
+    with _lock:
+        if _journal is None:
+            recover()
+            _journal = Journal()
+        return _journal
+
+
+def _state(path):
+    """Return [inode, mtime_ns, size] of path, or None if it does not exist."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [st.st_ino, st.st_mtime_ns, st.st_size]
+
+
+def _parent(path):
+    return os.path.dirname(os.path.abspath(path))
+
+
+def _fsync_dir(directory):
+    if os.name == "nt":
+        return  # Directories cannot be opened for fsync on Windows
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _load_syncfs():
+    """Return a function flushing the filesystem holding an fd (Linux syncfs), or None."""
+    if not sys.platform.startswith("linux"):
+        return None
+    import ctypes
+    try:
+        libc_syncfs = ctypes.CDLL(None, use_errno=True).syncfs
+    except (OSError, AttributeError):
+        return None
+    libc_syncfs.argtypes = [ctypes.c_int]
+
+    def syncfs(fd):
+        if libc_syncfs(fd) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+    return syncfs
+
+
+def _get_syncfs():
+    global _syncfs
+    if _syncfs is False:
+        _syncfs = _load_syncfs()
+    return _syncfs
+
+
+def flush_paths(paths):
+    """Make the content and directory entries of paths durable with as few flushes as possible.
+
+    Several files cost one syncfs() per filesystem where available, and an
+    fsync() per file and directory otherwise.
+    """
+    paths = list(paths)
+    syncfs = _get_syncfs()
+    if syncfs is not None and len(paths) > 1:
+        devices = {}
+        for path in paths:
+            devices.setdefault(os.stat(path).st_dev, path)
+        for path in devices.values():
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                syncfs(fd)
+            finally:
+                os.close(fd)
+        return
+    for path in paths:
+        with open(path, "rb") as f:
+            os.fsync(f.fileno())
+    for directory in {_parent(path) for path in paths}:
+        _fsync_dir(directory)
+
+
+def _commit_each(journal, batch):
+    """Commit writes one by one: fsync the data, the journal, then the directory.
+
+    A write that fails gets its error recorded and the rest go ahead.
+    """
+    for write in batch:
+        try:
+            with open(write.tmp, "rb") as f:
+                os.fsync(f.fileno())
+            ids = journal.intend([(write.tmp, write.path)])
+            try:
+                journal.sync()
+                os.replace(write.tmp, write.path)
+                _fsync_dir(_parent(write.path))
+            finally:
+                journal.done(ids)
+        except Exception as e:
+            write.error = e
+
+
+class _Committer:
+    """Background thread that commits queued writes in batches."""
+
+    def __init__(self, journal):
+        self.journal = journal
+        self.queue = queue.Queue()
+        threading.Thread(target=self._run, name="durable-commit", daemon=True).start()
+
+    def _commit(self, batch):
+        if _get_syncfs() is None or len(batch) == 1:
+            _commit_each(self.journal, batch)
+            return
+        flush_paths([w.tmp for w in batch])  # Data first: an intent vouches for its temp file
+        ids = self.journal.intend([(w.tmp, w.path) for w in batch])
+        try:
+            self.journal.sync()
+            replaced = []
+            for write in batch:
+                try:
+                    os.replace(write.tmp, write.path)
+                except OSError as e:
+                    write.error = e  # Only this write failed; the others still commit
+                    continue
+                replaced.append(write)
+            if replaced:
+                flush_paths([w.path for w in replaced])
+        finally:
+            self.journal.done(ids)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._commit(batch)
+            except BaseException as e:
+                for write in batch:
+                    if write.error is None:
+                        write.error = e
+            for write in batch:
+                write.committed.set()
+
+
+class _PendingWrite:
+    __slots__ = ("tmp", "path", "committed", "error")
+
+    def __init__(self, tmp, path):
+        self.tmp = tmp
+        self.path = path
+        self.committed = threading.Event()
+        self.error = None
+
+
+def _get_committer():
+    global _committer
+    journal = _get_journal()
+    with _lock:
+        if _committer is None:
+            _committer = _Committer(journal)
+        return _committer
+
+
+def temp_path(path):
+    """Return a unique temp file name next to path that recover() can attribute to this process."""
+    return f"{path}.{os.getpid()}.{next(_counter)}{TMP_SUFFIX}"
+
+
+def atomic_write(path, write, group_commit=None):
+    """Replace path with what write(f) writes to a binary file, atomically and durably.
+
+    path either keeps its old content or has the complete new content, even
+    across a crash. If write raises, path is left untouched. Returns
+    whatever write returns once the new content is on disk.
+    """
+    if group_commit is None:
+        group_commit = GROUP_COMMIT
+    # Set up (and recover) the journal before creating a temp file recovery could claim
+    committer = _get_committer() if group_commit else None
+    journal = _get_journal()
+    tmp = temp_path(path)
+    try:
+        with open(tmp, "wb") as f:
+            result = write(f)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+    pending = _PendingWrite(tmp, path)
+    if committer is not None:
+        committer.queue.put(pending)
+        pending.committed.wait()
+    else:
+        _commit_each(journal, [pending])
+    if pending.error is not None:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise pending.error
+    return result
+
+
+def write_bytes(path, data, group_commit=None):
+    """Atomically and durably replace path with data."""
+    return atomic_write(path, lambda f: f.write(data), group_commit)
+
+
+def _apply_patch(tmp, path):
+    """Apply the edits recorded in a patch file to path and flush it."""
+    with open(tmp, "rb") as patch, open(path, "r+b") as f:
+        (size,) = struct.unpack(">Q", patch.read(8))
+        while True:
+            head = patch.read(12)
+            if len(head) < 12:
+                break
+            offset, length = struct.unpack(">QI", head)
+            f.seek(offset)
+            f.write(patch.read(length))
+        if size != KEEP_SIZE:
+            f.truncate(size)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def patch_file(path, edits, size):
+    """Write (offset, bytes) edits into path in place and cut it to size, atomically and durably.
+
+    size None keeps the file's length, e.g. for a file others append to.
+
+    The edits are logged to a temp file before path is touched, so after a
+    crash recover() finishes them; path never stays half-patched. Readers
+    running at the same time can see a mix of old and new bytes, though.
+    """
+    journal = _get_journal()
+    tmp = temp_path(path)
+    try:
+        with open(tmp, "wb") as f:
+            f.write(struct.pack(">Q", KEEP_SIZE if size is None else size))
+            for offset, data in edits:
+                f.write(struct.pack(">QI", offset, len(data)))
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+    ids = journal.intend([(tmp, path)], patch=True)
+    journal.sync()
+    # If applying fails, the intent stays open and the next process's recover() retries it
+    _apply_patch(tmp, path)
+    journal.done(ids)
+    os.remove(tmp)
+
+
+def _pid_alive(pid):
+    """Whether a process with this pid is running (pids get reused, so it may be another one)."""
+    if os.name == "nt":
+        import ctypes
+        kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+        handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return ctypes.get_last_error() == 5  # ERROR_ACCESS_DENIED: it exists
+        try:
+            code = ctypes.c_ulong()
+            kernel32.GetExitCodeProcess(handle, ctypes.byref(code))
+            return code.value == 259  # STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _claim(journal_path, pid):
+    """Open and lock a journal whose process is gone; None if it is still alive.
+
+    Without flock (Windows) a journal is only claimed once its pid is gone.
+    """
+    if fcntl is None and _pid_alive(pid):
+        return None
+    try:
+        f = open(journal_path, "r+b")
+    except FileNotFoundError:
+        return None  # Claimed and removed by another process's recover()
+    if fcntl is not None:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return None
+    return f
+
+
+def _pending_intents(f):
+    intents = {}
+    for line in f:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            break  # Torn final line from the crash
+        if "i" in record:
+            intents[record["i"]] = record
+        else:
+            for i in record["d"]:
+                intents.pop(i, None)
+    return list(intents.values())
+
+
+def _orphaned(pid, claimed, journal_dir):
+    """Whether a temp file of pid can be discarded: its journal is claimed, or it has none and pid is gone.
+
+    A process creates its journal before any temp file, so a temp file of a
+    live process always has a journal that cannot be claimed.
+    """
+    if pid in claimed:
+        return True
+    if os.path.exists(os.path.join(journal_dir, f"{pid}.log")):
+        return False
+    return not pid.isdigit() or not _pid_alive(int(pid))
+
+
+def _replay(intent):
+    """Roll an intent of a dead process forward; False if its target was rewritten since.
+
+    A rename goes ahead only if the target is exactly as it was when the
+    intent was made, a patch only if the target is still the same file.
+    Both hold an flock on the target, as security's writers do, so a live
+    process cannot rewrite it in between. Intents from journals written
+    before "before" was recorded are rolled forward as they are.
+    """
+    path = intent["path"]
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        f = None
+    try:
+        if f is not None and fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        if "before" in intent:
+            before, now = intent["before"], _state(path)
+            if intent.get("patch"):
+                if before is None or now is None or now[0] != before[0]:
+                    return False
+            elif now != before:
+                return False
+        if intent.get("patch"):
+            _apply_patch(intent["tmp"], path)
+            os.remove(intent["tmp"])
+        else:
+            os.replace(intent["tmp"], path)
+            _fsync_dir(_parent(path))
+        return True
+    finally:
+        if f is not None:
+            f.close()
+
+
+def recover(roots=RECOVERY_ROOTS, journal_dir=JOURNAL_DIR):
+    """Finish or discard the writes of processes that died mid-write.
+
+    Returns (rolled forward, rolled back). Runs automatically before a
+    process's first durable write. Dead processes' journals stay locked
+    until their temp files are gone, so nothing is claimed twice.
+    """
+    forward = back = 0
+    # Before this process has a journal, one with its pid is a dead predecessor's
+    own = str(os.getpid()) if _journal is not None else None
+    claimed = {}  # pid -> locked journal file
+    finished = False
+    try:
+        if os.path.isdir(journal_dir):
+            for name in os.listdir(journal_dir):
+                pid = name.split(".")[0]
+                if pid == own or not pid.isdigit():
+                    continue
+                journal_path = os.path.join(journal_dir, name)
+                f = _claim(journal_path, int(pid))
+                if f is None:
+                    continue
+                claimed[pid] = f
+                for intent in _pending_intents(f):
+                    if not os.path.exists(intent["tmp"]):
+                        continue
+                    if _replay(intent):
+                        forward += 1
+                    else:
+                        os.remove(intent["tmp"])  # Superseded by a later write
+                        back += 1
+
+        # Temp files without an intent never reached step 3: their target was not touched.
+        for root in roots:
+            for dirpath, _, names in os.walk(root):
+                for name in names:
+                    if not name.endswith(TMP_SUFFIX):
+                        continue
+                    pid = name[:-len(TMP_SUFFIX)].rsplit(".", 2)[-2]
+                    if pid != own and _orphaned(pid, claimed, journal_dir):
+                        try:
+                            os.remove(os.path.join(dirpath, name))
+                            back += 1
+                        except FileNotFoundError:
+                            pass  # Discarded by another process's recover()
+        finished = True
+    finally:
+        for f in claimed.values():
+            if finished:
+                os.remove(f.name)  # Left in place on error, so the next recover() retries it
+            f.close()
+    if forward or back:
+        print(f"🩹 Recovered interrupted writes: {forward} completed, {back} discarded.")
+    return forward, back
+
+
+def _reset_after_fork():
+    # The child must not share the parent's journal ids or its fd (the parent
+    # keeps the lock), the committer thread did not survive the fork, and
+    # _lock may have been held by another parent thread
+    global _journal, _committer, _lock
+    if _journal is not None:
+        _journal._file.close()
+    _journal = None
+    _committer = None
+    _lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+if __name__ == "__main__":
+    recover()
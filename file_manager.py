@@ -1,4 +1,19 @@
 import os
+import catalog
+import dedup_store
+import metrics
+import pack_store
+import quota
+import search_index
+from security import (CHUNK_SIZE, ensure_enc_extension, file_format_version, iter_decrypt, read_encrypted,
+                      read_range as read_encrypted_range, update_blocks, write_at, write_encrypted)
+
+# "files" stores one .enc per file; "dedup" stores content-defined chunks once
+# per user plus a manifest per file (see dedup_store); "pack" appends files to
+# a few pack files per user (see pack_store). Existing files are always read
+# and updated in whichever layout they were written; pack_store.migrate moves
+# a user between "files" and "pack".
+STORAGE_BACKEND = "files"
 
 def get_user_folder(username):
     """Create and return the folder path for a user."""
@@ -7,68 +22,263 @@ def get_user_folder(username):
     return folder_path
 
 
+@metrics.instrument("file_manager.create_file")
 def create_file(username, file_name, content):
-    """Create a file and write content."""
+    """Create an encrypted file from content; raises quota.QuotaExceededError before writing."""
     folder_path = get_user_folder(username)
-    file_path = os.path.join(folder_path, file_name)
+    file_path = os.path.join(folder_path, ensure_enc_extension(file_name))
+    name = catalog.logical_name(file_name)
 
-    with open(file_path, "w") as f:
-        f.write(content)
+    data = content.encode()
+    with quota.locked(username):
+        quota.check_write(username, name, len(data))
+        metrics.add_bytes("file_manager.create_file", len(data))
+        if STORAGE_BACKEND == "dedup":
+            dedup_store.put(username, name, data)
+            catalog.record_content(username, name, dedup_store.manifest_path(username, name), data)
+        elif STORAGE_BACKEND == "pack":
+            _put_packed(username, name, data)
+        else:
+            write_encrypted(file_path, data, owner=username)
+            catalog.record_content(username, name, file_path, data)
+        search_index.index_file(username, name, content)
 
-    print(f"✅ File '{file_name}' created for user '{username}'.")
+        print(f"✅ File '{file_name}' created for user '{username}'.")
 
 
+def _put_packed(username, name, data):
+    file_path, length, version = pack_store.put(username, name, data)
+    catalog.record_content(username, name, file_path, data, stored=(length, version))
+
+
+def stored_path(username, file_name):
+    """Return the path read_file would decrypt for a file, or None if it does not exist."""
+    folder_path = get_user_folder(username)
+    name = catalog.logical_name(file_name)
+    manifest_path = dedup_store.manifest_path(username, name)
+    if not os.path.exists(manifest_path):
+        packed = pack_store.locate(username, name)
+        if packed is not None:
+            return packed[0]
+    for path in (manifest_path,
+                 os.path.join(folder_path, ensure_enc_extension(file_name)),
+                 os.path.join(folder_path, file_name)):
+        if os.path.exists(path):
+            return path
+    return None
+
+
+@metrics.instrument("file_manager.read_file", counts="in")
 def read_file(username, file_name):
-    """Read a file's content and return it."""
+    """Decrypt a file's content in memory and return it."""
     folder_path = get_user_folder(username)
-    file_path = os.path.join(folder_path, file_name)
+    file_path = os.path.join(folder_path, ensure_enc_extension(file_name))
+    plain_path = os.path.join(folder_path, file_name)
+    name = catalog.logical_name(file_name)
 
-    if not os.path.exists(file_path):
+    if os.path.exists(dedup_store.manifest_path(username, name)):
+        return dedup_store.get(username, name).decode()
+
+    if pack_store.contains(username, name):
+        return pack_store.get(username, name).decode()
+
+    if os.path.exists(file_path):
+        return read_encrypted(file_path, owner=username).decode()
+
+    if not os.path.exists(plain_path):
         print(f"❌ Error: File '{file_name}' not found.")
         return None
 
-    with open(file_path, "r") as f:
+    # Files written before storage was encrypted are still plaintext
+    with open(plain_path, "r") as f:
         content = f.read()
 
     return content
 
 
+def iter_file(username, file_name):
+    """Yield a file's plaintext piece by piece, like read_file without holding it all.
+
+    Encrypted files are decrypted one chunk at a time; packed and
+    deduplicated ones are small enough to come back whole. Raises
+    FileNotFoundError if the file does not exist.
+    """
+    path = stored_path(username, file_name)
+    if path is None:
+        raise FileNotFoundError(f"File '{file_name}' not found.")
+    name = catalog.logical_name(file_name)
+    if path.endswith(dedup_store.MANIFEST_SUFFIX):
+        yield dedup_store.get(username, name)
+    elif path.endswith(pack_store.PACK_SUFFIX):
+        yield pack_store.get(username, name)
+    else:
+        with open(path, "rb") as f:
+            if path.endswith(".enc"):
+                yield from iter_decrypt(f, owner=username)
+            else:
+                yield from iter(lambda: f.read(CHUNK_SIZE), b"")
+
+
+@metrics.instrument("file_manager.read_range", counts="in")
+def read_range(username, file_name, offset=0, size=None):
+    """Return size bytes of a file's plaintext from offset (to the end if size is None).
+
+    Encrypted files decrypt only the chunks the range covers; packed and
+    deduplicated ones are small and are decrypted whole. Raises
+    FileNotFoundError if the file does not exist.
+    """
+    path = stored_path(username, file_name)
+    if path is None:
+        raise FileNotFoundError(f"File '{file_name}' not found.")
+    end = None if size is None else offset + size
+    name = catalog.logical_name(file_name)
+    if path.endswith(dedup_store.MANIFEST_SUFFIX):
+        return dedup_store.get(username, name)[offset:end]
+    if path.endswith(pack_store.PACK_SUFFIX):
+        return pack_store.get(username, name)[offset:end]
+    if path.endswith(".enc"):
+        return read_encrypted_range(path, offset, size, owner=username)
+    with open(path, "rb") as f:
+        f.seek(offset)
+        return f.read(-1 if size is None else size)
+
+
+@metrics.instrument("file_manager.update_file")
 def update_file(username, file_name, new_content):
-    """Update the content of an existing file."""
+    """Update the content of an existing file, re-encrypting only the blocks that changed."""
     folder_path = get_user_folder(username)
-    file_path = os.path.join(folder_path, file_name)
-
-    if not os.path.exists(file_path):
-        print(f"❌ Error: File '{file_name}' not found.")
-        return
-
-    with open(file_path, "w") as f:
-        f.write(new_content)
-
-    print(f"✅ File '{file_name}' updated successfully.")
-
-
+    file_path = os.path.join(folder_path, ensure_enc_extension(file_name))
+    plain_path = os.path.join(folder_path, file_name)
+    name = catalog.logical_name(file_name)
+    manifest_path = dedup_store.manifest_path(username, name)
+    data = new_content.encode()
+    with quota.locked(username):
+        quota.check_write(username, name, len(data))
+        metrics.add_bytes("file_manager.update_file", len(data))
+
+        if os.path.exists(manifest_path):
+            dedup_store.put(username, name, data)
+            catalog.record_content(username, name, manifest_path, data)
+            search_index.index_file(username, name, new_content)
+            print(f"✅ File '{file_name}' updated successfully.")
+            return
+
+        if pack_store.contains(username, name):
+            _put_packed(username, name, data)
+            search_index.index_file(username, name, new_content)
+            print(f"✅ File '{file_name}' updated successfully.")
+            return
+
+        if not os.path.exists(file_path) and not os.path.exists(plain_path):
+            print(f"❌ Error: File '{file_name}' not found.")
+            return
+
+        # Compressed, older-format and legacy files cannot be patched and are rewritten whole,
+        # uncompressed so that the next update can be
+        if not os.path.exists(file_path) or update_blocks(file_path, data, owner=username) is None:
+            write_encrypted(file_path, data, owner=username, compress=False)
+        # A file updated in place keeps its format version (and cipher suite)
+        catalog.record_content(username, name, file_path, data, file_format_version(file_path))
+        search_index.index_file(username, name, new_content)
+        if plain_path != file_path and os.path.exists(plain_path):
+            os.remove(plain_path)  # Drop the legacy plaintext copy
+
+        print(f"✅ File '{file_name}' updated successfully.")
+
+
+def _splice(old, offset, data):
+    """Return old with data written at offset (appended when offset is None)."""
+    if offset is None:
+        offset = len(old)
+    if not 0 <= offset <= len(old):
+        raise ValueError(f"Offset {offset} is outside the file ({len(old)} bytes).")
+    return old[:offset] + data + old[offset + len(data):]
+
+
+@metrics.instrument("file_manager.edit_file")
+def edit_file(username, file_name, content, offset=None):
+    """Write content into an existing file at a byte offset, or append it if offset is None.
+
+    Only the blocks the change touches are re-encrypted. A file that cannot
+    be patched in place is rewritten once, uncompressed, so that its next
+    edit can be.
+    """
+    folder_path = get_user_folder(username)
+    file_path = os.path.join(folder_path, ensure_enc_extension(file_name))
+    plain_path = os.path.join(folder_path, file_name)
+    name = catalog.logical_name(file_name)
+    manifest_path = dedup_store.manifest_path(username, name)
+    data = content.encode()
+    with quota.locked(username):
+        quota.check_edit(username, name, offset, len(data))
+        metrics.add_bytes("file_manager.edit_file", len(data))
+
+        if os.path.exists(manifest_path):
+            new_data = _splice(dedup_store.get(username, name), offset, data)
+            dedup_store.put(username, name, new_data)
+            catalog.record_content(username, name, manifest_path, new_data)
+            search_index.index_file(username, name, new_data.decode(errors="ignore"))
+            print(f"✅ File '{file_name}' updated successfully.")
+            return
+
+        if pack_store.contains(username, name):
+            # Packed files are small; the edited file is appended as a new record
+            new_data = _splice(pack_store.get(username, name), offset, data)
+            _put_packed(username, name, new_data)
+            search_index.index_file(username, name, new_data.decode(errors="ignore"))
+            print(f"✅ File '{file_name}' updated successfully.")
+            return
+
+        if not os.path.exists(file_path) and not os.path.exists(plain_path):
+            print(f"❌ Error: File '{file_name}' not found.")
+            return
+
+        length = write_at(file_path, offset, data, owner=username) if os.path.exists(file_path) else None
+        if length is not None:
+            # The content hash is left empty rather than reading the whole file back
+            catalog.record_file(username, name, file_path, length,
+                                format_version=file_format_version(file_path))
+            search_index.mark_stale(username, name)  # Re-read at the next search instead of now
+        else:
+            new_data = _splice(b"".join(iter_file(username, file_name)), offset, data)  # Bytes: any encoding
+            write_encrypted(file_path, new_data, owner=username, compress=False)
+            catalog.record_content(username, name, file_path, new_data)
+            search_index.index_file(username, name, new_data.decode(errors="ignore"))
+            if plain_path != file_path and os.path.exists(plain_path):
+                os.remove(plain_path)
+
+        print(f"✅ File '{file_name}' updated successfully.")
+
+
+@metrics.instrument("file_manager.delete_file")
 def delete_file(username, file_name):
     """Delete a file."""
     folder_path = get_user_folder(username)
-    file_path = os.path.join(folder_path, file_name)
+    name = catalog.logical_name(file_name)
+    if dedup_store.delete(username, name) or pack_store.delete(username, name):
+        catalog.remove_file(username, name)
+        search_index.remove_file(username, name)
+        print(f"🗑️ File '{file_name}' deleted.")
+        return
+
+    file_path = os.path.join(folder_path, ensure_enc_extension(file_name))
+    if not os.path.exists(file_path):
+        file_path = os.path.join(folder_path, file_name)
 
     if os.path.exists(file_path):
         os.remove(file_path)
+        catalog.remove_file(username, name)
+        search_index.remove_file(username, name)
         print(f"🗑️ File '{file_name}' deleted.")
     else:
         print(f"❌ Error: File '{file_name}' not found.")
 
 
+@metrics.instrument("file_manager.list_user_files")
 def list_user_files(username):
-    """List all files of a user and return them."""
-    folder_path = get_user_folder(username)
-
-    if not os.path.exists(folder_path):
-        print(f"❌ User '{username}' has no files.")
-        return []
-
-    files = os.listdir(folder_path)
+    """List all files of a user (from the catalog) and return them."""
+    get_user_folder(username)
+    files = catalog.list_names(username)
 
     if not files:
         print(f"📂 No files found for user '{username}'.")
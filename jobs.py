@@ -0,0 +1,415 @@
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+import bulk
+import catalog
+import db
+import dedup_store
+import metrics
+import pack_store
+import security
+
+# Maintenance jobs run in the background from a queue in SQLite, so they
+# survive restarts and any process with workers (the app, or `python jobs.py
+# work`) can pick them up. A job works through its items (files) in a fixed
+# order and saves the last finished one as its checkpoint every
+# CHECKPOINT_INTERVAL seconds; a paused, interrupted or crashed job resumes
+# after it. Every kind of item is safe to redo.
+#
+# Workers are throttled to IO_RATE bytes/s and CPU_SHARE of a core between
+# them. With metrics on, they also watch the p95 latency of interactive
+# operations (INTERACTIVE_PREFIX) and slow down further while it is over
+# LATENCY_TARGET_MS, speeding back up once it recovers.
+WORKERS = 1
+IO_RATE = 20 * 1024 * 1024   # bytes/s read plus written, across all workers in a process
+CPU_SHARE = 0.5              # fraction of one core, across all workers in a process
+LATENCY_TARGET_MS = 100
+INTERACTIVE_PREFIX = "file_manager."
+MIN_SCALE = 1 / 16           # slowest the latency guard throttles to, relative to the limits
+CHECKPOINT_INTERVAL = 2.0    # seconds between progress saves (and pause checks)
+POLL_INTERVAL = 2.0          # seconds an idle worker waits before looking for work again
+STALE_AFTER = 600            # seconds without a save before a running job is taken over
+HEARTBEAT_INTERVAL = 60      # seconds between keep-alives while a worker sleeps off a large item
+MAX_FAILURES = 100           # failed items listed per job; all are counted
+
+CREATE_JOBS = '''CREATE TABLE IF NOT EXISTS jobs (
+                   id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   kind TEXT NOT NULL,
+                   params TEXT NOT NULL,
+                   state TEXT NOT NULL,
+                   done INTEGER NOT NULL DEFAULT 0,
+                   total INTEGER,
+                   checkpoint TEXT,
+                   result TEXT,
+                   error TEXT,
+                   worker TEXT,
+                   created_at REAL NOT NULL,
+                   updated_at REAL NOT NULL)'''
+CREATE_JOBS_INDEX = 'CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, id)'
+INSERT_JOB = '''INSERT INTO jobs (kind, params, state, created_at, updated_at)
+                VALUES (?, ?, 'queued', ?, ?)'''
+# One statement, so two workers can never claim the same job
+CLAIM_JOB = '''UPDATE jobs SET state = 'running', worker = ?, updated_at = ?
+               WHERE id = (SELECT id FROM jobs
+                           WHERE state = 'queued' OR (state = 'running' AND updated_at < ?)
+                           ORDER BY id LIMIT 1)
+               RETURNING id, kind, params, done, checkpoint, result'''
+SAVE_PROGRESS = '''UPDATE jobs SET done = ?, total = ?, checkpoint = ?, result = ?, updated_at = ?
+                   WHERE id = ? AND worker = ?'''
+FINISH_JOB = '''UPDATE jobs SET state = ?, done = ?, total = ?, checkpoint = ?, result = ?, error = ?,
+                                worker = NULL, updated_at = ?
+                WHERE id = ? AND worker = ? AND state = 'running' '''
+SELECT_STATE = 'SELECT state, worker FROM jobs WHERE id = ?'
+TOUCH_JOB = "UPDATE jobs SET updated_at = ? WHERE id = ? AND worker = ? AND state = 'running'"
+# A paused or cancelled job keeps its worker until that worker has saved its last progress
+SET_STATE = '''UPDATE jobs SET state = ?, worker = CASE WHEN ? = 'queued' THEN NULL ELSE worker END, updated_at = ?
+               WHERE id = ? AND state IN ({})'''
+SELECT_JOBS = 'SELECT * FROM jobs ORDER BY id DESC LIMIT ?'
+COLUMNS = ("id", "kind", "params", "state", "done", "total", "checkpoint", "result", "error",
+           "worker", "created_at", "updated_at")
+
+_initialized = set()
+_lock = threading.Lock()
+_workers = []
+
+
+def initialize():
+    """Create the jobs table once per database per process."""
+    path = db.DB_NAME
+    if path in _initialized:
+        return
+    with _lock:
+        if path not in _initialized:
+            with db.transaction() as conn:
+                conn.execute(CREATE_JOBS)
+                conn.execute(CREATE_JOBS_INDEX)
+            _initialized.add(path)
+
+
+# --- job kinds ---
+# Each kind lists its items as sorted (key, item) pairs and handles one item,
+# returning (bytes read plus written, outcome); failures raise.
+def _users(params):
+    if params.get("users"):
+        return params["users"]
+    return sorted(os.listdir(catalog.ROOT)) if os.path.isdir(catalog.ROOT) else []
+
+
+def _recatalog(owner, path, old_path=None):
+    """Point a file's catalog row at its re-encrypted container, keeping its size and hash."""
+    st = os.stat(path)
+    name = catalog.logical_name(os.path.basename(old_path or path))
+    catalog.relocate(owner, name, path, st.st_size, st.st_mtime_ns, security.file_format_version(path))
+
+
+# Only .enc files are re-encrypted (the Jobs panel says so). Packed files and
+# deduplicated chunks keep their data keys until they are written again.
+def _reencrypt_items(params):
+    return sorted((path, (path, owner)) for path, owner in bulk.collect_tasks("reencrypt", _users(params)))
+
+
+def _reencrypt(item, params):
+    """Move a file onto the current format and suite under a fresh data key."""
+    path, owner = item
+    size = os.path.getsize(path)
+    if not params.get("force") and security.file_format_version(path) == security.FORMAT_VERSION:
+        return size, "current"
+    bulk.reencrypt_one(path, owner)
+    _recatalog(owner, path)
+    return size + os.path.getsize(path), "reencrypted"
+
+
+def _verify_items(params):
+    items = []
+    for username in _users(params):
+        for row in catalog.list_files(username):
+            items.append((f"{username}/{row['name']}", (username, row["name"], row["path"], row["content_hash"])))
+    return sorted(items)
+
+
+def _content_digest(username, name, path):
+    """Return the SHA-256 of a stored file's plaintext, checking every tag on the way."""
+    digest = hashlib.sha256()
+    if path.endswith(dedup_store.MANIFEST_SUFFIX):
+        digest.update(dedup_store.get(username, name))
+    elif path.endswith(pack_store.PACK_SUFFIX):
+        digest.update(pack_store.get(username, name))
+    elif path.endswith(".enc"):
+        with open(path, "rb") as f:
+            for chunk in security.iter_decrypt(f, owner=username):
+                digest.update(chunk)
+    else:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(security.CHUNK_SIZE), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _verify(item, params):
+    """Decrypt a file end to end, checking every tag and the catalog's content hash."""
+    username, name, path, content_hash = item
+    if not path.endswith((dedup_store.MANIFEST_SUFFIX, pack_store.PACK_SUFFIX, ".enc")):
+        return os.path.getsize(path), "plaintext"  # Never encrypted; the clean job fixes these
+    digest = _content_digest(username, name, path)  # Checks the tags even without a hash to compare
+    if content_hash is not None and digest != content_hash:
+        raise ValueError("Content does not match the catalog.")
+    return os.path.getsize(path), "verified"
+
+
+def _clean_items(params):
+    items = []
+    for username in _users(params):
+        folder_path = os.path.join(catalog.ROOT, username)
+        if not os.path.isdir(folder_path):
+            continue
+        with os.scandir(folder_path) as entries:
+            for entry in entries:
+                if (entry.is_file() and not entry.name.endswith((".enc", ".tmp", dedup_store.MANIFEST_SUFFIX))):
+                    items.append((entry.path, (entry.path, username)))
+    return sorted(items)
+
+
+def _encrypted_copy(owner, name, path):
+    """Return where the encrypted copy of a plaintext file is stored, or None."""
+    if os.path.exists(path + ".enc"):
+        return path + ".enc"
+    if os.path.exists(dedup_store.manifest_path(owner, name)):
+        return dedup_store.manifest_path(owner, name)
+    located = pack_store.locate(owner, name)
+    return located[0] if located else None
+
+
+def _clean(item, params):
+    """Remove plaintext left beside an identical encrypted copy, e.g. by an interrupted decrypt; encrypt any other.
+
+    Plaintext that differs from its encrypted copy is kept and reported as
+    "mismatch", since neither can be known to be the right one.
+    """
+    path, owner = item
+    if not os.path.exists(path):
+        return 0, "gone"
+    size = os.path.getsize(path)
+    name = catalog.logical_name(os.path.basename(path))
+    stored = _encrypted_copy(owner, name, path)
+    if stored is not None:
+        if _content_digest(owner, name, stored) != _content_digest(owner, name, path):
+            return size, "mismatch"
+        os.remove(path)  # Readers already prefer the encrypted copy
+        return size, "removed"
+    bulk.encrypt_one(path, owner)
+    _recatalog(owner, path + ".enc", path)
+    return size + os.path.getsize(path + ".enc"), "encrypted"
+
+
+KINDS = {
+    "reencrypt": (_reencrypt_items, _reencrypt),  # params: users, force; .enc files only
+    "verify": (_verify_items, _verify),           # params: users
+    "clean": (_clean_items, _clean),              # params: users
+}
+
+
+# --- queue ---
+def submit(kind, users=None, **params):
+    """Queue a job over the given users (all if None); returns its id."""
+    if kind not in KINDS:
+        raise ValueError(f"Unknown job kind {kind!r}; choose one of {', '.join(KINDS)}.")
+    initialize()
+    params["users"] = users
+    now = time.time()
+    with db.transaction() as conn:
+        return conn.execute(INSERT_JOB, (kind, json.dumps(params), now, now)).lastrowid
+
+
+def _set_state(job_id, state, from_states):
+    initialize()
+    sql = SET_STATE.format(", ".join("?" * len(from_states)))
+    return db.execute(sql, (state, state, time.time(), job_id) + tuple(from_states)) > 0
+
+
+def pause(job_id):
+    """Stop a job at its next checkpoint; resume picks it up from there."""
+    return _set_state(job_id, "paused", ("queued", "running"))
+
+
+def resume(job_id):
+    return _set_state(job_id, "queued", ("paused", "failed"))
+
+
+def cancel(job_id):
+    return _set_state(job_id, "cancelled", ("queued", "running", "paused"))
+
+
+def list_jobs(limit=50):
+    """Return the newest jobs as dicts, params and result decoded."""
+    initialize()
+    jobs = []
+    for row in db.query_all(SELECT_JOBS, (limit,)):
+        job = dict(zip(COLUMNS, row))
+        job["params"] = json.loads(job["params"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        jobs.append(job)
+    return jobs
+
+
+# --- workers ---
+class Throttle:
+    """Paces one worker to its share of IO_RATE and CPU_SHARE, scaled down while interactive latency is high."""
+
+    def __init__(self, share=1.0):
+        self.share = share
+        self.scale = 1.0
+        self._since = metrics.snapshot()
+
+    def pace(self, nbytes, wall, cpu, heartbeat=None):
+        """Sleep after an item that moved nbytes in wall seconds, cpu of them on the CPU.
+
+        A long sleep (a large file at a throttled rate) calls heartbeat every
+        HEARTBEAT_INTERVAL, so the job is not taken over as stale meanwhile,
+        and ends early once heartbeat returns False.
+        """
+        share = self.share * self.scale
+        io_wait = nbytes / (IO_RATE * share) - wall if IO_RATE else 0
+        cpu_wait = cpu / (CPU_SHARE * share) - wall if CPU_SHARE else 0
+        wait = max(io_wait, cpu_wait)
+        while wait > HEARTBEAT_INTERVAL and heartbeat is not None:
+            time.sleep(HEARTBEAT_INTERVAL)
+            wait -= HEARTBEAT_INTERVAL
+            if not heartbeat():
+                return
+        if wait > 0:
+            time.sleep(wait)
+
+    def adjust(self):
+        """Halve the pace while interactive p95 latency is over target; recover gradually."""
+        if not metrics.ENABLED:
+            return
+        p95 = metrics.quantile_since(self._since, 0.95, INTERACTIVE_PREFIX)
+        self._since = metrics.snapshot()
+        if p95 is not None and p95 > LATENCY_TARGET_MS:
+            self.scale = max(MIN_SCALE, self.scale / 2)
+        else:
+            self.scale = min(1.0, self.scale * 1.25)
+
+
+def _claim(worker):
+    initialize()
+    now = time.time()
+    with db.transaction() as conn:
+        return conn.execute(CLAIM_JOB, (worker, now, now - STALE_AFTER)).fetchone()
+
+
+def _save(job_id, worker, done, total, checkpoint, result):
+    """Save progress; returns False if the job was paused, cancelled or taken over meanwhile."""
+    with db.transaction() as conn:
+        conn.execute(SAVE_PROGRESS, (done, total, checkpoint, json.dumps(result), time.time(), job_id, worker))
+        state, owner = conn.execute(SELECT_STATE, (job_id,)).fetchone()
+    return state == "running" and owner == worker
+
+
+def _touch(job_id, worker):
+    """Mark a job as still being worked on; returns False if it was paused, cancelled or taken over."""
+    return db.execute(TOUCH_JOB, (time.time(), job_id, worker)) > 0
+
+
+def _run(job, worker, throttle):
+    """Work through a claimed job from its checkpoint until it ends or is stopped."""
+    job_id, kind, params, done, checkpoint, result = job
+    params = json.loads(params)
+    result = json.loads(result) if result else {"bytes": 0, "counts": {}, "failed": []}
+    total = done
+    try:
+        list_items, handle = KINDS[kind]
+        items = [item for item in list_items(params) if checkpoint is None or item[0] > checkpoint]
+        total = done + len(items)
+        last_save = time.monotonic()
+        for key, item in items:
+            wall, cpu = time.perf_counter(), time.thread_time()
+            try:
+                nbytes, outcome = handle(item, params)
+            except Exception as e:
+                nbytes, outcome = 0, "failed"
+                if len(result["failed"]) < MAX_FAILURES:
+                    result["failed"].append([key, f"{type(e).__name__}: {e}"])
+            result["counts"][outcome] = result["counts"].get(outcome, 0) + 1
+            result["bytes"] += nbytes
+            done, checkpoint = done + 1, key
+            throttle.pace(nbytes, time.perf_counter() - wall, time.thread_time() - cpu,
+                          lambda: _touch(job_id, worker))
+            if time.monotonic() - last_save >= CHECKPOINT_INTERVAL:
+                if not _save(job_id, worker, done, total, checkpoint, result):
+                    return
+                throttle.adjust()
+                last_save = time.monotonic()
+        state, error = "done", None
+    except Exception as e:  # The job itself broke, e.g. an unknown kind or an unreadable catalog
+        state, error = "failed", f"{type(e).__name__}: {e}"
+    with db.transaction() as conn:
+        conn.execute(FINISH_JOB, (state, done, total, checkpoint, json.dumps(result), error,
+                                  time.time(), job_id, worker))
+    print(f"{'✅' if state == 'done' else '❌'} Job {job_id} ({kind}) {state}: {done} item(s).")
+
+
+def work(worker, throttle, stop=None, until_idle=False):
+    """Claim and run jobs until stop is set (or, with until_idle, none are left)."""
+    while stop is None or not stop.is_set():
+        job = _claim(worker)
+        if job is not None:
+            _run(job, worker, throttle)
+        elif until_idle:
+            return
+        else:
+            time.sleep(POLL_INTERVAL)
+
+
+def start_workers(count=WORKERS):
+    """Start count worker threads (once per process); they split the rate limits between them."""
+    with _lock:
+        if _workers:
+            return _workers
+        prefix = f"{socket.gethostname()}:{os.getpid()}"
+        for i in range(count):
+            thread = threading.Thread(target=work, args=(f"{prefix}:{i}", Throttle(1 / count)),
+                                      name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            _workers.append(thread)
+        return _workers
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Queue, run and manage background maintenance jobs.")
+    sub = parser.add_subparsers(dest="action", required=True)
+    add = sub.add_parser("add", help="queue a job")
+    add.add_argument("kind", choices=KINDS)
+    add.add_argument("--user", action="append", help="user to process (repeatable; default: all)")
+    add.add_argument("--force", action="store_true", help="reencrypt: rewrite files already on the current format")
+    sub.add_parser("list", help="show recent jobs")
+    for action in ("pause", "resume", "cancel"):
+        sub.add_parser(action).add_argument("job_id", type=int)
+    run = sub.add_parser("work", help="run queued jobs in the foreground until none are left")
+    run.add_argument("--io-mb", type=float, default=IO_RATE / 1024 / 1024, help="MB/s read plus written")
+    run.add_argument("--cpu-share", type=float, default=CPU_SHARE, help="fraction of one core")
+    args = parser.parse_args()
+
+    if args.action == "add":
+        params = {"force": True} if args.force else {}
+        print(f"📋 Queued job {submit(args.kind, args.user, **params)}.")
+    elif args.action == "list":
+        for job in list_jobs():
+            print(f"📋 {job['id']} {job['kind']} {job['state']}: {job['done']}/{job['total'] or '?'} "
+                  f"{json.dumps(job['result']['counts']) if job['result'] else ''} {job['error'] or ''}")
+    elif args.action == "work":
+        IO_RATE = int(args.io_mb * 1024 * 1024)
+        CPU_SHARE = args.cpu_share
+        work(f"{socket.gethostname()}:{os.getpid()}:cli", Throttle(), until_idle=True)
+    else:
+        action, done = {"pause": (pause, "paused"), "resume": (resume, "resumed"),
+                        "cancel": (cancel, "cancelled")}[args.action]
+        if action(args.job_id):
+            print(f"✅ Job {args.job_id} {done}.")
+        else:
+            print(f"❌ Job {args.job_id} cannot be {done} in its current state.")
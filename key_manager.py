@@ -0,0 +1,394 @@
+import hashlib
+import hmac
+import json
+import os
+import struct
+import threading
+from contextlib import contextmanager
+from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
+import durable
+
+try:
+    import fcntl
+except ImportError:  # Windows: key stores and rotations are serialized only within this process
+    fcntl = None
+
+KEY_FILE = "encryption_key.key"
+USER_KEY_DIR = "user_keys"
+
+# A per-file data key is wrapped by the owner's key-encryption key (KEK), and
+# every KEK is wrapped by the master key. Rotating either key only rewrites
+# these small wrapped blobs; file bodies stay encrypted under their data keys.
+#
+# Wrapped data key header: owner length (1) | owner | KEK id (4) | nonce | tag | wrapped key
+#
+# A user's key store (user_keys/<owner>.json) is only changed under its
+# store lock, and replaced through durable. Writers that wrap new data keys
+# hold the user's rotation lock shared (see user_key_lock) until their file
+# is in place; a user key rotation holds it exclusively, so no file can be
+# written under a KEK the rotation is about to retire.
+KEY_SIZE = 32
+MAX_OWNER_BYTES = 255  # the key header stores the owner's length in one byte
+WRAP_NONCE_SIZE = 16
+WRAP_TAG_SIZE = 16
+
+_lock = threading.RLock()
+_master_key = None    # active master key, loaded once per process
+_master_keys = {}     # fingerprint -> master key, including one staged by a rotation
+_kek_cache = {}       # owner -> {"active": id, "keys": {id: kek}}
+_hmac_cache = {}      # owner -> key for keyed content identifiers (e.g. dedup chunk ids)
+
+
+def generate_key():
+    if not os.path.exists(KEY_FILE):
+        key = get_random_bytes(KEY_SIZE)  # 256-bit AES key
+        with open(KEY_FILE, "wb") as f:
+            f.write(key)
+        print("🔑 Encryption key generated.")
+    else:
+        print("🔑 Encryption key already exists.")
+
+
+def fingerprint(key):
+    """Short, non-secret identifier for a key."""
+    return hashlib.sha256(key).hexdigest()[:16]
+
+
+def _wrap(kek, key, aad):
+    cipher = AES.new(kek, AES.MODE_EAX)
+    cipher.update(aad)
+    wrapped, tag = cipher.encrypt_and_digest(key)
+    return cipher.nonce + tag + wrapped
+
+
+def _unwrap(kek, blob, aad):
+    nonce = blob[:WRAP_NONCE_SIZE]
+    tag = blob[WRAP_NONCE_SIZE:WRAP_NONCE_SIZE + WRAP_TAG_SIZE]
+    cipher = AES.new(kek, AES.MODE_EAX, nonce=nonce)
+    cipher.update(aad)
+    return cipher.decrypt_and_verify(blob[WRAP_NONCE_SIZE + WRAP_TAG_SIZE:], tag)
+
+
+def _write_atomic(path, data):
+    durable.write_bytes(path, data)
+
+
+def _create_exclusive(path, data):
+    """Write a brand-new file, failing if it already exists (even from another process)."""
+    tmp_path = durable.temp_path(path)
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    try:
+        os.link(tmp_path, path)  # Atomic and never overwrites
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        os.remove(tmp_path)
+
+
+def _read_key(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def master_key():
+    """Return the master key, reading it from disk only on first use."""
+    global _master_key
+    with _lock:
+        if _master_key is None:
+            if not os.path.exists(KEY_FILE):
+                _create_exclusive(KEY_FILE, get_random_bytes(KEY_SIZE))  # Another process may win
+            _master_key = _read_key(KEY_FILE)
+            _master_keys[fingerprint(_master_key)] = _master_key
+            if os.path.exists(KEY_FILE + ".new"):
+                staged = _read_key(KEY_FILE + ".new")
+                _master_keys[fingerprint(staged)] = staged
+        return _master_key
+
+
+def _master_key_by_fingerprint(fp):
+    master_key()
+    try:
+        return _master_keys[fp]
+    except KeyError:
+        raise ValueError(f"Master key {fp} is not available.")
+
+
+def check_owner(owner):
+    """Reject owner names that could not be a user (or would escape USER_KEY_DIR)."""
+    if (not owner or owner in (".", "..") or any(c in owner for c in "/\\\0")
+            or len(owner.encode()) > MAX_OWNER_BYTES):
+        raise ValueError(f"Invalid key owner: {owner!r}")
+    return owner
+
+
+def _user_key_path(owner):
+    return os.path.join(USER_KEY_DIR, check_owner(owner) + ".json")
+
+
+@contextmanager
+def _flock(path, exclusive=True):
+    os.makedirs(USER_KEY_DIR, exist_ok=True)
+    with open(path, "ab") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+
+
+def _store_lock(owner):
+    """Serialize read-modify-writes of owner's key store across processes."""
+    return _flock(_user_key_path(owner) + ".lock")
+
+
+def user_key_lock(owner, exclusive=False):
+    """Hold owner's rotation lock: shared while writing a file under a new data key, exclusive to rotate.
+
+    Always take it before security's per-file lock, never while holding one.
+    """
+    return _flock(os.path.join(USER_KEY_DIR, check_owner(owner) + ".rotation.lock"), exclusive)
+
+
+def _store_signature(owner):
+    """What changes whenever owner's key store is replaced, or None if it does not exist."""
+    try:
+        st = os.stat(_user_key_path(owner))
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def _read_user_store(owner):
+    path = _user_key_path(owner)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def _write_user_store(owner, store):
+    os.makedirs(USER_KEY_DIR, exist_ok=True)
+    _write_atomic(_user_key_path(owner), json.dumps(store, indent=2).encode())
+
+
+def _create_user_store(owner, store):
+    """Write a brand-new KEK store, failing if one already exists (even from another process)."""
+    os.makedirs(USER_KEY_DIR, exist_ok=True)
+    return _create_exclusive(_user_key_path(owner), json.dumps(store, indent=2).encode())
+
+
+def _wrap_kek(owner, kek_id, kek):
+    key = master_key()
+    aad = f"kek:{owner}:{kek_id}".encode()
+    return {"master": fingerprint(key), "wrapped": _wrap(key, kek, aad).hex()}
+
+
+def _unwrap_kek(owner, kek_id, entry):
+    key = _master_key_by_fingerprint(entry["master"])
+    aad = f"kek:{owner}:{kek_id}".encode()
+    return _unwrap(key, bytes.fromhex(entry["wrapped"]), aad)
+
+
+def _user_keks(owner, fresh=False):
+    """Return the cached {"active", "keys"} KEK set for owner, creating it if needed.
+
+    With fresh, the cache is first checked against the store on disk, which
+    another process may have rotated.
+    """
+    with _lock:
+        cached = _kek_cache.get(owner)
+        if cached is not None and (not fresh or cached["signature"] == _store_signature(owner)):
+            return cached
+
+        store = _read_user_store(owner)
+        if store is None:
+            kek = get_random_bytes(KEY_SIZE)
+            store = {"active": 1, "keys": {"1": _wrap_kek(owner, 1, kek)}}
+            if not _create_user_store(owner, store):
+                store = _read_user_store(owner)  # Another process created it first
+
+        keks = {
+            "active": store["active"],
+            "keys": {int(i): _unwrap_kek(owner, int(i), e) for i, e in store["keys"].items()},
+            "signature": _store_signature(owner),
+        }
+        _kek_cache[owner] = keks
+        return keks
+
+
+def user_hmac_key(owner):
+    """Return owner's secret key for keyed content identifiers, creating it if needed.
+
+    It is wrapped by the master key and is independent of the KEKs, so user
+    key rotation does not change identifiers derived from it.
+    """
+    with _lock:
+        if owner in _hmac_cache:
+            return _hmac_cache[owner]
+        _user_keks(owner)
+        aad = f"hmac:{owner}".encode()
+        with _store_lock(owner):
+            store = _read_user_store(owner)
+            if "hmac" not in store:
+                key = get_random_bytes(KEY_SIZE)
+                store["hmac"] = {"master": fingerprint(master_key()), "wrapped": _wrap(master_key(), key, aad).hex()}
+                _write_user_store(owner, store)
+            else:
+                entry = store["hmac"]
+                key = _unwrap(_master_key_by_fingerprint(entry["master"]), bytes.fromhex(entry["wrapped"]), aad)
+        _hmac_cache[owner] = key
+        return key
+
+
+def token_key():
+    """Return the key that signs session tokens, derived from the master key.
+
+    Rotating the master key therefore invalidates every outstanding token.
+    """
+    return hmac.new(master_key(), b"secure-file:token-signing", hashlib.sha256).digest()
+
+
+def ensure_user_key(owner):
+    """Make sure owner has a KEK, creating it if needed."""
+    _user_keks(owner)
+
+
+def new_data_key(owner):
+    """Generate a random data key for a new file; returns (data key, wrapped key header)."""
+    keks = _user_keks(owner, fresh=True)  # Never wrap under a KEK another process retired
+    data_key = get_random_bytes(KEY_SIZE)
+    return data_key, _build_key_header(owner, keks["active"], keks["keys"][keks["active"]], data_key)
+
+
+def _build_key_header(owner, kek_id, kek, data_key):
+    owner_bytes = owner.encode()
+    prefix = struct.pack(">B", len(owner_bytes)) + owner_bytes + struct.pack(">I", kek_id)
+    return prefix + _wrap(kek, data_key, prefix)
+
+
+def _parse_key_header(key_header):
+    owner_len = key_header[0]
+    owner = key_header[1:1 + owner_len].decode()
+    (kek_id,) = struct.unpack(">I", key_header[1 + owner_len:5 + owner_len])
+    return owner, kek_id, key_header[:5 + owner_len], key_header[5 + owner_len:]
+
+
+def unwrap_data_key(key_header, owner=None):
+    """Recover a file's data key from its wrapped key header.
+
+    With an owner, a header wrapped for anyone else is refused, so a file
+    copied into another user's folder cannot be read as theirs.
+    """
+    header_owner, kek_id, prefix, blob = _parse_key_header(key_header)
+    if owner is not None and header_owner != owner:
+        raise ValueError(f"Encrypted file belongs to '{header_owner}', not '{owner}'.")
+    owner = header_owner
+    keks = _user_keks(owner)
+    if kek_id not in keks["keys"]:
+        keks = _user_keks(owner, fresh=True)  # Added by a rotation in another process
+    if kek_id not in keks["keys"]:
+        raise ValueError(f"Key {kek_id} for '{owner}' is not available.")
+    return _unwrap(keks["keys"][kek_id], blob, prefix)
+
+
+def key_header_owner(key_header):
+    """Return the owner recorded in a wrapped key header."""
+    return _parse_key_header(key_header)[0]
+
+
+def rewrap_key_header(key_header):
+    """Rewrap a data key under its owner's active KEK. The result has the same length."""
+    owner = key_header_owner(key_header)
+    data_key = unwrap_data_key(key_header)
+    keks = _user_keks(owner, fresh=True)
+    return _build_key_header(owner, keks["active"], keks["keys"][keks["active"]], data_key)
+
+
+def add_user_key(owner):
+    """Start a user key rotation: make a fresh KEK active, keeping the old ones readable."""
+    with _lock:
+        _user_keks(owner)
+        with _store_lock(owner):
+            store = _read_user_store(owner)
+            kek_id = max(int(i) for i in store["keys"]) + 1
+            store["keys"][str(kek_id)] = _wrap_kek(owner, kek_id, get_random_bytes(KEY_SIZE))
+            store["active"] = kek_id
+            _write_user_store(owner, store)
+        _user_keks(owner, fresh=True)
+        return kek_id
+
+
+def retire_user_keys(owner):
+    """Finish a user key rotation by dropping every KEK except the active one.
+
+    Only call it once every data key is durably rewrapped under the active KEK.
+    """
+    with _lock:
+        _user_keks(owner)
+        with _store_lock(owner):
+            store = _read_user_store(owner)
+            active = str(store["active"])
+            store["keys"] = {active: store["keys"][active]}
+            _write_user_store(owner, store)
+        _user_keks(owner, fresh=True)
+
+
+def list_key_owners():
+    """Return every user that has a KEK on disk."""
+    if not os.path.exists(USER_KEY_DIR):
+        return []
+    return [f[:-5] for f in os.listdir(USER_KEY_DIR) if f.endswith(".json")]
+
+
+def rotate_master_key():
+    """Replace the master key, rewrapping only the per-user KEKs (and HMAC keys).
+
+    The new key is staged next to the old one first, so a crash part-way
+    leaves every KEK unwrappable by one of the two keys.
+    """
+    global _master_key
+    with _lock:
+        old_key = master_key()
+        owners = list_key_owners()
+        hmac_keys = {}
+        for owner in owners:
+            _user_keks(owner)  # Unwrap every KEK under the old key first
+            if "hmac" in _read_user_store(owner):
+                hmac_keys[owner] = user_hmac_key(owner)
+
+        if os.path.exists(KEY_FILE + ".new"):
+            new_key = _read_key(KEY_FILE + ".new")  # Resume an interrupted rotation
+        else:
+            new_key = get_random_bytes(KEY_SIZE)
+            _write_atomic(KEY_FILE + ".new", new_key)
+        _master_keys[fingerprint(new_key)] = new_key
+        _master_key = new_key
+
+        for owner in owners:
+            with _store_lock(owner):
+                keks = _user_keks(owner, fresh=True)
+                store = _read_user_store(owner)
+                store["keys"] = {str(i): _wrap_kek(owner, i, kek) for i, kek in keks["keys"].items()}
+                if owner in hmac_keys:
+                    aad = f"hmac:{owner}".encode()
+                    store["hmac"] = {"master": fingerprint(new_key),
+                                     "wrapped": _wrap(new_key, hmac_keys[owner], aad).hex()}
+                _write_user_store(owner, store)
+
+        os.replace(KEY_FILE + ".new", KEY_FILE)
+        _master_keys.clear()
+        _master_keys[fingerprint(new_key)] = new_key
+        print(f"🔄 Master key rotated ({fingerprint(old_key)} -> {fingerprint(new_key)}).")
+
+
+def clear_cache():
+    """Forget all cached key material; the next use reloads it from disk."""
+    global _master_key
+    with _lock:
+        _master_key = None
+        _master_keys.clear()
+        _kek_cache.clear()
+        _hmac_cache.clear()
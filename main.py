@@ -1,7 +1,9 @@
 import os
+import catalog
 from auth import register, login
-from security import encrypt_and_store, decrypt_and_read, encrypt_file, decrypt_file
-from file_manager import delete_file
+from quota import QuotaExceededError
+from security import decrypt_and_read
+from file_manager import create_file, read_file, update_file as update_file_content, edit_file, delete_file
 
 def list_user_files(username):
     folder_path = os.path.join("secure_files", username)
@@ -9,7 +11,7 @@ def list_user_files(username):
     if not os.path.exists(folder_path):
         os.makedirs(folder_path)
 
-    return [f[:-4] for f in os.listdir(folder_path) if f.endswith(".enc")]
+    return catalog.list_names(username)
 
 def update_file(username):
     files = list_user_files(username)
@@ -32,22 +34,19 @@ def update_file(username):
         print("Invalid selection.")
         return
 
-    enc_file_path = os.path.join("secure_files", username, files[index] + ".enc")
-    decrypt_file(enc_file_path)
-    decrypted_path = enc_file_path.replace(".enc", "")
-
-    with open(decrypted_path, "r") as f:
-        current_content = f.read()
+    current_content = read_file(username, files[index])
 
     print("Current content:")
     print(current_content)
 
-    new_content = input("Enter new content: ")
-
-    with open(decrypted_path, "w") as f:
-        f.write(new_content)
-
-    encrypt_file(decrypted_path)
+    try:
+        if input("Append to the end instead of replacing? (y/n): ").strip().lower() == "y":
+            edit_file(username, files[index], input("Enter text to append: "))
+        else:
+            update_file_content(username, files[index], input("Enter new content: "))
+    except QuotaExceededError as e:
+        print(f"❌ Storage quota exceeded: {e}")
+        return
     print(f"File '{files[index]}' updated.")
 
 def delete_selected_file(username):
@@ -82,13 +81,12 @@ def user_dashboard(username):
         choice = input("Choose an option: ").strip()
         if choice == "1":
             file_name = input("Enter new file name (with .txt extension): ").strip()
-            folder_path = os.path.join("secure_files", username)
-            os.makedirs(folder_path, exist_ok=True)
-            file_path = os.path.join(folder_path, file_name)
-            with open(file_path, "w") as f:
-                content = input("Enter file content: ")
-                f.write(content)
-            encrypt_and_store(username, file_name)
+            content = input("Enter file content: ")
+            try:
+                create_file(username, file_name, content)
+            except QuotaExceededError as e:
+                print(f"❌ Storage quota exceeded: {e}")
+                continue
             print(f"File '{file_name}' created and encrypted.")
         elif choice == "2":
             files = list_user_files(username)
@@ -0,0 +1,278 @@
+import bisect
+import contextvars
+import functools
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Instrumentation for auth, file_manager and security. Off by default: every
+# hook starts with a check of ENABLED, so a disabled build only pays for one
+# global lookup per call. Enable with SECURE_FILE_METRICS=1 (or enable()),
+# and SECURE_FILE_TRACE=1 to also keep recent span trees for inspection.
+ENABLED = os.environ.get("SECURE_FILE_METRICS", "") not in ("", "0")
+TRACING = os.environ.get("SECURE_FILE_TRACE", "") not in ("", "0")
+
+# Latency histogram bucket upper bounds, in seconds (Prometheus "le" values).
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+TRACE_LIMIT = 200  # finished root spans kept when tracing
+METRICS_PORT = 9464
+
+_lock = threading.Lock()
+_calls = {}      # op -> count
+_errors = {}     # op -> count
+_bytes = {}      # (op, direction) -> bytes
+_histograms = {}  # op -> [bucket counts..., +Inf count, sum]
+_traces = deque(maxlen=TRACE_LIMIT)
+_current_span = contextvars.ContextVar("metrics_span", default=None)
+_server = None
+
+
+def enable(tracing=None):
+    """Turn metrics on at runtime, optionally switching span tracing too."""
+    global ENABLED, TRACING
+    ENABLED = True
+    if tracing is not None:
+        TRACING = tracing
+
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+
+def reset():
+    """Drop everything recorded so far."""
+    with _lock:
+        _calls.clear()
+        _errors.clear()
+        _bytes.clear()
+        _histograms.clear()
+        _traces.clear()
+
+
+def _observe(op, seconds, failed):
+    with _lock:
+        _calls[op] = _calls.get(op, 0) + 1
+        if failed:
+            _errors[op] = _errors.get(op, 0) + 1
+        hist = _histograms.get(op)
+        if hist is None:
+            hist = _histograms[op] = [0] * (len(BUCKETS) + 2)
+        hist[bisect.bisect_left(BUCKETS, seconds)] += 1
+        hist[-1] += seconds
+
+
+def add_bytes(op, count, direction="out"):
+    """Count bytes moved by an operation ("in" = read or decrypted, "out" = written)."""
+    if not ENABLED or not count:
+        return
+    with _lock:
+        key = (op, direction)
+        _bytes[key] = _bytes.get(key, 0) + count
+
+
+class _Span:
+    __slots__ = ("name", "start", "seconds", "children", "error")
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.perf_counter()
+        self.seconds = None
+        self.children = []
+        self.error = None
+
+    def as_dict(self):
+        return {"name": self.name, "ms": round(self.seconds * 1000, 3), "error": self.error,
+                "children": [c.as_dict() for c in self.children]}
+
+
+@contextmanager
+def span(name):
+    """Time a phase, e.g. span("decrypt"); nested spans form a tree per request.
+
+    Every span feeds the latency histogram for its name; with TRACING the
+    finished root spans are also kept (see recent_traces).
+    """
+    if not ENABLED:
+        yield
+        return
+    current = _Span(name)
+    parent = _current_span.get()
+    token = _current_span.set(current)
+    failed = False
+    try:
+        yield
+    except BaseException as e:
+        failed = True
+        current.error = type(e).__name__
+        raise
+    finally:
+        current.seconds = time.perf_counter() - current.start
+        _current_span.reset(token)
+        _observe(name, current.seconds, failed)
+        if TRACING:
+            if parent is not None:
+                parent.children.append(current)
+            else:
+                _traces.append(current)
+
+
+def instrument(op, counts=None):
+    """Decorator recording calls, errors and latency of a function under op.
+
+    With counts="in" or "out" the result is also counted as bytes moved: its
+    len() for bytes or str results, the value itself for int results.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return fn(*args, **kwargs)
+            with span(op):
+                result = fn(*args, **kwargs)
+            if counts is not None and result is not None:
+                add_bytes(op, result if isinstance(result, int) else len(result), counts)
+            return result
+        return wrapper
+    return decorator
+
+
+def snapshot():
+    """Return a consistent copy of all counters and histograms."""
+    with _lock:
+        return {
+            "calls": dict(_calls),
+            "errors": dict(_errors),
+            "bytes": dict(_bytes),
+            "histograms": {op: list(h) for op, h in _histograms.items()},
+        }
+
+
+def summary():
+    """Per-operation rows (op, calls, errors, mean ms, p95 ms, bytes in, bytes out) for display."""
+    snap = snapshot()
+    rows = []
+    for op in sorted(snap["calls"]):
+        hist = snap["histograms"][op]
+        calls = snap["calls"][op]
+        rows.append({
+            "op": op,
+            "calls": calls,
+            "errors": snap["errors"].get(op, 0),
+            "mean_ms": round(hist[-1] / calls * 1000, 3),
+            "p95_ms": _quantile_ms(hist, calls, 0.95),
+            "bytes_in": snap["bytes"].get((op, "in"), 0),
+            "bytes_out": snap["bytes"].get((op, "out"), 0),
+        })
+    return rows
+
+
+def _quantile_ms(hist, calls, q):
+    """Upper bound of the bucket holding the q-quantile, in ms (None if past the last bucket)."""
+    target = q * calls
+    seen = 0
+    for bound, count in zip(BUCKETS, hist):
+        seen += count
+        if seen >= target:
+            return bound * 1000
+    return None
+
+
+def quantile_since(before, q=0.95, prefix=""):
+    """q-quantile latency in ms of the ops named prefix* recorded since the snapshot before.
+
+    None if there were no such calls; inf if the quantile is past the last bucket.
+    """
+    after = snapshot()
+    merged = [0] * (len(BUCKETS) + 2)
+    for op, hist in after["histograms"].items():
+        if op.startswith(prefix):
+            old = before["histograms"].get(op, [0] * len(hist))
+            for i, (new_count, old_count) in enumerate(zip(hist, old)):
+                merged[i] += new_count - old_count
+    calls = sum(merged[:-1])
+    if not calls:
+        return None
+    quantile = _quantile_ms(merged, calls, q)
+    return float("inf") if quantile is None else quantile
+
+
+def recent_traces():
+    """Return the kept span trees, newest first."""
+    return [s.as_dict() for s in reversed(_traces)]
+
+
+def _label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def prometheus_text():
+    """Render all metrics in the Prometheus text exposition format."""
+    snap = snapshot()
+    lines = ["# HELP securefile_operations_total Completed operations.",
+             "# TYPE securefile_operations_total counter"]
+    for op, n in sorted(snap["calls"].items()):
+        lines.append(f'securefile_operations_total{{op="{_label(op)}"}} {n}')
+    lines += ["# HELP securefile_errors_total Operations that raised.",
+              "# TYPE securefile_errors_total counter"]
+    for op, n in sorted(snap["errors"].items()):
+        lines.append(f'securefile_errors_total{{op="{_label(op)}"}} {n}')
+    lines += ["# HELP securefile_bytes_total Bytes read (in) or written (out) by operations.",
+              "# TYPE securefile_bytes_total counter"]
+    for (op, direction), n in sorted(snap["bytes"].items()):
+        lines.append(f'securefile_bytes_total{{op="{_label(op)}",direction="{direction}"}} {n}')
+    lines += ["# HELP securefile_operation_seconds Operation latency.",
+              "# TYPE securefile_operation_seconds histogram"]
+    for op, hist in sorted(snap["histograms"].items()):
+        op = _label(op)
+        cumulative = 0
+        for bound, count in zip(BUCKETS, hist):
+            cumulative += count
+            lines.append(f'securefile_operation_seconds_bucket{{op="{op}",le="{bound}"}} {cumulative}')
+        cumulative += hist[len(BUCKETS)]
+        lines.append(f'securefile_operation_seconds_bucket{{op="{op}",le="+Inf"}} {cumulative}')
+        lines.append(f'securefile_operation_seconds_sum{{op="{op}"}} {hist[-1]:.6f}')
+        lines.append(f'securefile_operation_seconds_count{{op="{op}"}} {cumulative}')
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path):
+    """Write the metrics to path atomically, e.g. for node_exporter's textfile collector."""
+    with open(path + ".tmp", "w") as f:
+        f.write(prometheus_text())
+    os.replace(path + ".tmp", path)
+
+
+def _handler_class():
+    import http.server  # Pulls in email/http.client; only loaded when serving
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = prometheus_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass  # Scrapes would otherwise flood stderr
+
+    return http.server.ThreadingHTTPServer, MetricsHandler
+
+
+def serve(port=METRICS_PORT, host="127.0.0.1"):
+    """Serve /metrics from a daemon thread, once per process, and return the server."""
+    global _server
+    with _lock:
+        if _server is None:
+            server_class, handler_class = _handler_class()
+            _server = server_class((host, port), handler_class)
+            threading.Thread(target=_server.serve_forever, name="metrics-http", daemon=True).start()
+            print(f"📈 Metrics available at http://{host}:{_server.server_port}/metrics")
+    return _server
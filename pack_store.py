@@ -0,0 +1,606 @@
+import io
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+import db
+import durable
+import key_manager
+import dedup_store
+import security
+
+try:
+    import fcntl
+except ImportError:  # Windows: appends are only serialized within one process
+    fcntl = None
+
+# Optional storage backend for users with many small files: each file is an
+# encrypted container (see security) appended as a record to one of a few
+# per-user pack files instead of getting a .enc file of its own:
+#   pack_store/<username>/<seq>.pack
+#   record: MAGIC (4) | kind (1) | name length (2) | version (8) | payload length (4) | name | payload
+# The payload is a complete container, exactly what the .enc file would hold,
+# and version is the time of the put, kept through compaction so the catalog
+# and search index can tell a moved record from a new one.
+# A put appends a new record and points the file's pack_index row at it; a
+# delete appends a tombstone and drops the row. The index is what reads go
+# by; the records only make it rebuildable from the packs (rebuild_index).
+# Superseded records and tombstones are dead weight until compact() copies
+# the live records of sparse packs into a fresh pack and deletes the old ones.
+PACK_ROOT = "pack_store"
+PACK_SUFFIX = ".pack"
+RECORD_MAGIC = b"SFR\x00"
+RECORD_FORMAT = ">4sBHQI"
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+PUT = 1
+TOMBSTONE = 2
+MAX_PACK_SIZE = 64 * 1024 * 1024  # appends go to a new pack past this
+COMPACT_RATIO = 0.5               # packs whose live records fill less than this get compacted
+COMPACT_INTERVAL = 600            # seconds between background compaction passes
+COPY_BATCH = 8 * 1024 * 1024      # bytes of live records copied per write while compacting
+MAX_MAPS = 32                     # pack files kept mapped per process
+LOCK_NAME = ".lock"               # per-user lock file for compaction and rewrap
+
+CREATE_INDEX = '''CREATE TABLE IF NOT EXISTS pack_index (
+                    username TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    pack TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    length INTEGER NOT NULL,
+                    version INTEGER NOT NULL,
+                    PRIMARY KEY (username, name))'''
+UPSERT_ENTRY = '''INSERT INTO pack_index (username, name, pack, position, length, version)
+                  VALUES (?, ?, ?, ?, ?, ?)
+                  ON CONFLICT (username, name) DO UPDATE SET
+                     pack = excluded.pack, position = excluded.position, length = excluded.length,
+                     version = excluded.version'''
+# Compaction only moves a row that still points where the record was copied from
+MOVE_ENTRY = '''UPDATE pack_index SET pack = ?, position = ?
+                WHERE username = ? AND name = ? AND pack = ? AND position = ?'''
+DELETE_ENTRY = 'DELETE FROM pack_index WHERE username = ? AND name = ?'
+DELETE_USER = 'DELETE FROM pack_index WHERE username = ?'
+SELECT_ENTRY = 'SELECT pack, position, length, version FROM pack_index WHERE username = ? AND name = ?'
+SELECT_ENTRIES = 'SELECT name, pack, position, length, version FROM pack_index WHERE username = ? ORDER BY pack, position'
+SELECT_LIVE = 'SELECT pack, COALESCE(SUM(length), 0), COUNT(*) FROM pack_index WHERE username = ? GROUP BY pack'
+COUNT_IN_PACK = 'SELECT COUNT(*) FROM pack_index WHERE username = ? AND pack = ?'
+
+_initialized = set()
+_lock = threading.Lock()
+_user_locks = {}
+_maps = OrderedDict()  # (pack path, inode) -> read-only mmap
+_compactor = None
+
+
+def initialize():
+    """Create the pack index table once per database per process."""
+    if db.DB_NAME in _initialized:
+        return
+    with _lock:
+        if db.DB_NAME not in _initialized:
+            with db.transaction() as conn:
+                conn.execute(CREATE_INDEX)
+            _initialized.add(db.DB_NAME)
+
+
+def _user_dir(username):
+    return os.path.join(PACK_ROOT, username)
+
+
+def pack_path(username, pack):
+    return os.path.join(PACK_ROOT, username, pack)
+
+
+def _packs(username):
+    """Return the user's pack file names, oldest first."""
+    try:
+        names = os.listdir(_user_dir(username))
+    except FileNotFoundError:
+        return []
+    return sorted(n for n in names if n.endswith(PACK_SUFFIX))
+
+
+def _next_pack(username):
+    packs = _packs(username)
+    seq = int(packs[-1][:-len(PACK_SUFFIX)]) + 1 if packs else 1
+    return f"{seq:06d}{PACK_SUFFIX}"
+
+
+def _create_pack(username):
+    """Create the user's next pack exclusively; returns its name, or None if another process just did.
+
+    This is the only way a pack file comes into being, so a pack deleted by
+    compaction is never brought back by a late append.
+    """
+    pack = _next_pack(username)
+    try:
+        fd = os.open(pack_path(username, pack), os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0))
+    except FileExistsError:
+        return None
+    os.close(fd)
+    return pack
+
+
+def _user_lock(username):
+    with _lock:
+        return _user_locks.setdefault(username, threading.RLock())
+
+
+@contextmanager
+def _maintenance_lock(username):
+    """Hold the user's pack maintenance lock, so compaction and rewrap never overlap.
+
+    Taken within this process with _user_lock and across processes with an
+    flock on <user dir>/.lock.
+    """
+    with _user_lock(username):
+        os.makedirs(_user_dir(username), exist_ok=True)
+        with open(os.path.join(_user_dir(username), LOCK_NAME), "ab") as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            yield
+
+
+def _record(kind, name, payload=b"", version=0):
+    encoded = name.encode()
+    return (struct.pack(RECORD_FORMAT, RECORD_MAGIC, kind, len(encoded), version, len(payload))
+            + encoded + payload)
+
+
+def _append(username, records, pack=None):
+    """Append records to pack (default: the active one) and flush them to disk.
+
+    Returns (pack, [position of each record]). Appends are serialized across
+    processes with flock. Existing packs are opened without O_CREAT, so a
+    pack deleted by a concurrent compaction is never re-created: the append
+    notices (at open, or once the lock is held) and moves on to the newest
+    pack. An explicit pack must already exist (see _create_pack).
+    """
+    os.makedirs(_user_dir(username), exist_ok=True)
+    while True:
+        target = pack
+        if target is None:
+            packs = _packs(username)
+            target = packs[-1] if packs else None
+            try:
+                if target is None or os.path.getsize(pack_path(username, target)) >= MAX_PACK_SIZE:
+                    target = _create_pack(username)
+            except FileNotFoundError:
+                continue  # Compacted away just now
+            if target is None:
+                continue  # Another process created the next pack first; append to it
+        path = pack_path(username, target)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | getattr(os, "O_BINARY", 0))
+        except FileNotFoundError:
+            if pack is not None:
+                raise
+            continue
+        with os.fdopen(fd, "ab") as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                if os.stat(path).st_ino != os.fstat(f.fileno()).st_ino:
+                    continue  # Compacted away while we waited for the lock
+            except FileNotFoundError:
+                continue
+            position = f.seek(0, os.SEEK_END)
+            positions = []
+            for record in records:
+                positions.append(position)
+                position += len(record)
+            f.write(b"".join(records))
+            f.flush()
+            os.fsync(f.fileno())
+        return target, positions
+
+
+def _map(path, end):
+    """Return a read-only mmap of path that covers at least end bytes.
+
+    Maps are keyed by inode as well as path: pack names start again at
+    000001 once all of a user's packs are gone, and a map of a removed pack
+    keeps its inode from being reused.
+    """
+    key = (path, os.stat(path).st_ino)
+    with _lock:
+        mm = _maps.get(key)
+        if mm is not None and len(mm) >= end:
+            _maps.move_to_end(key)
+            return mm
+    with open(path, "rb") as f:
+        key = (path, os.fstat(f.fileno()).st_ino)
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    with _lock:
+        # Maps are never closed explicitly: readers may still hold the old
+        # one, and it is released once the last of them drops it.
+        _maps[key] = mm
+        _maps.move_to_end(key)
+        while len(_maps) > MAX_MAPS:
+            _maps.popitem(last=False)
+    return mm
+
+
+def _forget_map(path):
+    with _lock:
+        for key in [k for k in _maps if k[0] == path]:
+            del _maps[key]
+
+
+def _read_record(username, name, pack, position, length):
+    """Return the payload of the record at position, checking it is name's."""
+    mm = _map(pack_path(username, pack), position + length)
+    magic, kind, name_len, _, payload_len = struct.unpack_from(RECORD_FORMAT, mm, position)
+    start = position + RECORD_SIZE
+    if (magic != RECORD_MAGIC or kind != PUT or RECORD_SIZE + name_len + payload_len != length
+            or mm[start:start + name_len] != name.encode()):
+        raise ValueError(f"Pack index entry for '{name}' does not point at its record.")
+    return mm[start + name_len:position + length]
+
+
+def _entry(username, name):
+    if not os.path.isdir(_user_dir(username)):
+        return None  # Users without packs cost a stat, not a query
+    initialize()
+    return db.query_one(SELECT_ENTRY, (username, name))
+
+
+def contains(username, name):
+    return _entry(username, name) is not None
+
+
+def locate(username, name):
+    """Return (pack path, record length, version) of a packed file, or None."""
+    row = _entry(username, name)
+    if row is None:
+        return None
+    pack, _, length, version = row
+    return pack_path(username, pack), length, version
+
+
+def tail_version(username):
+    """(mtime_ns, size) of the user's newest pack, or None.
+
+    Every put, delete and compaction appends to the newest pack, so this
+    changes whenever the set of packed files may have.
+    """
+    packs = _packs(username)
+    if not packs:
+        return None
+    try:
+        st = os.stat(pack_path(username, packs[-1]))
+    except FileNotFoundError:
+        return None  # Compacted away just now
+    return st.st_mtime_ns, st.st_size
+
+
+def put_payload(username, name, payload):
+    """Append an already encrypted container as name; returns (pack path, record length, version)."""
+    initialize()
+    version = time.time_ns()
+    record = _record(PUT, name, payload, version)
+    with _user_lock(username):
+        pack, (position,) = _append(username, [record])
+        db.execute(UPSERT_ENTRY, (username, name, pack, position, len(record), version))
+    return pack_path(username, pack), len(record), version
+
+
+def put(username, name, data):
+    """Encrypt data for username and append it as name; returns (pack path, record length, version)."""
+    with key_manager.user_key_lock(username):  # Not appended during a key rotation
+        buf = io.BytesIO()
+        security.encrypt_stream(io.BytesIO(data), buf, owner=username, compress=True)
+        return put_payload(username, name, buf.getvalue())
+
+
+def read_payload(username, name):
+    """Return the encrypted container stored for name, read through mmap."""
+    row = _entry(username, name)
+    if row is None:
+        raise FileNotFoundError(f"'{name}' is not in {username}'s packs.")
+    pack, position, length, _ = row
+    return _read_record(username, name, pack, position, length)
+
+
+def get(username, name):
+    """Decrypt and return a packed file's content."""
+    plain = io.BytesIO()
+    security.decrypt_stream(io.BytesIO(read_payload(username, name)), plain, owner=username)
+    return plain.getvalue()
+
+
+def delete(username, name):
+    """Append a tombstone for name and drop it from the index. Returns False if it was not packed."""
+    if _entry(username, name) is None:
+        return False
+    with _user_lock(username):
+        _append(username, [_record(TOMBSTONE, name)])
+        db.execute(DELETE_ENTRY, (username, name))
+    return True
+
+
+def entries(username):
+    """Return {name: (pack path, record length, version)} for every packed file of a user."""
+    if not os.path.isdir(_user_dir(username)):
+        return {}
+    initialize()
+    return {name: (pack_path(username, pack), length, version)
+            for name, pack, _, length, version in db.query_all(SELECT_ENTRIES, (username,))}
+
+
+def payload_version(payload):
+    """Container format version of a payload (0 for the legacy layout)."""
+    prefix = payload[:security.HEADER_SIZE]
+    if len(prefix) < security.HEADER_SIZE or prefix[:len(security.MAGIC)] != security.MAGIC:
+        return 0
+    return struct.unpack(security.HEADER_FORMAT, prefix)[1]
+
+
+def scan(path):
+    """Yield (kind, name, position, length, version) for every record in a pack file.
+
+    A record torn by a crash mid-append is skipped by searching for the next
+    record header after it.
+    """
+    size = os.path.getsize(path)
+    if not size:
+        return
+    mm = _map(path, size)
+    position = 0
+    while position + RECORD_SIZE <= size:
+        magic, kind, name_len, version, payload_len = struct.unpack_from(RECORD_FORMAT, mm, position)
+        length = RECORD_SIZE + name_len + payload_len
+        end = position + length
+        # A record only counts if the next one (or the end of the pack) follows it
+        if (magic == RECORD_MAGIC and kind in (PUT, TOMBSTONE) and end <= size
+                and (end == size or mm[end:end + len(RECORD_MAGIC)] == RECORD_MAGIC)):
+            try:
+                name = mm[position + RECORD_SIZE:position + RECORD_SIZE + name_len].decode()
+            except UnicodeDecodeError:
+                name = None
+            if name:
+                yield kind, name, position, length, version
+                position = end
+                continue
+        position = mm.find(RECORD_MAGIC, position + 1)
+        if position == -1:
+            return
+
+
+def rebuild_index(username):
+    """Rebuild a user's pack index by replaying every record of their packs in order."""
+    initialize()
+    latest = {}
+    for pack in _packs(username):
+        for kind, name, position, length, version in scan(pack_path(username, pack)):
+            if kind == PUT:
+                latest[name] = (pack, position, length, version)
+            else:
+                latest.pop(name, None)
+    with _user_lock(username), db.transaction() as conn:
+        conn.execute(DELETE_USER, (username,))
+        conn.executemany(UPSERT_ENTRY, [(username, name) + entry for name, entry in latest.items()])
+    return len(latest)
+
+
+def stats(username):
+    """Return pack count, bytes on disk, live bytes and the dead fraction for a user."""
+    initialize()
+    live = {pack: (size, count) for pack, size, count in db.query_all(SELECT_LIVE, (username,))}
+    packs = _packs(username)
+    total = sum(os.path.getsize(pack_path(username, p)) for p in packs)
+    live_bytes = sum(size for size, _ in live.values())
+    return {
+        "packs": len(packs),
+        "files": sum(count for _, count in live.values()),
+        "pack_bytes": total,
+        "live_bytes": live_bytes,
+        "dead_ratio": round(1 - live_bytes / total, 3) if total else 0.0,
+    }
+
+
+def compact(username, full=False):
+    """Copy the live records of sparse packs (every pack if full) into a new pack and delete them.
+
+    Tombstones in the compacted packs are carried over unless every pack is
+    compacted, since an older record in a surviving pack may still need
+    them for rebuild_index. Returns the bytes reclaimed.
+    """
+    initialize()
+    with _maintenance_lock(username):
+        live = {pack: size for pack, size, _ in db.query_all(SELECT_LIVE, (username,))}
+        packs = _packs(username)
+        sizes = {p: os.path.getsize(pack_path(username, p)) for p in packs}
+        sparse = [p for p in packs if full or live.get(p, 0) < COMPACT_RATIO * sizes[p]]
+        if not sparse or (len(sparse) == 1 and live.get(sparse[0], 0) == sizes[sparse[0]]):
+            return 0
+
+        sparse_set = set(sparse)
+        rows = [row for row in db.query_all(SELECT_ENTRIES, (username,)) if row[1] in sparse_set]
+        tombstones = []
+        if len(sparse) < len(packs):
+            alive = {row[0] for row in db.query_all(SELECT_ENTRIES, (username,))}
+            for pack in sparse:
+                tombstones += [name for kind, name, _, _, _ in scan(pack_path(username, pack))
+                               if kind == TOMBSTONE and name not in alive]
+
+        target = None
+        while target is None:
+            target = _create_pack(username)
+        moves = []
+        batch, batch_rows, batch_bytes = [], [], 0
+        for row in rows + [None]:
+            if row is not None:
+                name, pack, position, length, _ = row
+                mm = _map(pack_path(username, pack), position + length)
+                batch.append(mm[position:position + length])
+                batch_rows.append(row)
+                batch_bytes += length
+            if batch and (row is None or batch_bytes >= COPY_BATCH):
+                _, positions = _append(username, batch, target)
+                moves += [(target, new, username, name, pack, old)
+                          for (name, pack, old, _, _), new in zip(batch_rows, positions)]
+                batch, batch_rows, batch_bytes = [], [], 0
+        if tombstones:
+            _append(username, [_record(TOMBSTONE, name) for name in sorted(set(tombstones))], target)
+        with db.transaction() as conn:
+            conn.executemany(MOVE_ENTRY, moves)
+
+        reclaimed = 0
+        for pack in sparse:
+            path = pack_path(username, pack)
+            with open(path, "rb") as f:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)  # No append may be half done
+                if db.query_one(COUNT_IN_PACK, (username, pack))[0]:
+                    continue  # Written to by another process meanwhile; next time
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue  # e.g. still mapped on Windows
+            _forget_map(path)
+            reclaimed += sizes[pack]
+        if os.path.exists(pack_path(username, target)):
+            reclaimed -= os.path.getsize(pack_path(username, target))
+    print(f"🧹 Compacted {len(sparse)} pack(s) for '{username}', reclaimed {max(reclaimed, 0)} bytes.")
+    return max(reclaimed, 0)
+
+
+def compact_all(full=False):
+    """Compact the packs of every user that has any."""
+    if not os.path.isdir(PACK_ROOT):
+        return 0
+    return sum(compact(username, full) for username in sorted(os.listdir(PACK_ROOT))
+               if os.path.isdir(_user_dir(username)))
+
+
+def start_compactor(interval=COMPACT_INTERVAL):
+    """Run compact_all every interval seconds on a daemon thread (once per process)."""
+    global _compactor
+    with _lock:
+        if _compactor is not None:
+            return _compactor
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    compact_all()
+                except Exception as e:
+                    print(f"❌ Background compaction failed: {e}")
+
+        _compactor = threading.Thread(target=run, name="pack-compactor", daemon=True)
+        _compactor.start()
+        return _compactor
+
+
+def rewrap(username):
+    """Rewrap the data key of every live record under the user's active key, in place.
+
+    Called by security.rotate_user_key; the key header keeps its length, so
+    only those bytes of each record are rewritten, one durable.patch_file
+    per pack: a crash part-way leaves every header either old or new.
+    """
+    if not os.path.isdir(_user_dir(username)):
+        return 0
+    initialize()
+    rewrapped = 0
+    with _maintenance_lock(username):  # A compaction elsewhere would copy the old headers
+        edits = {}  # pack -> [(offset, new key header)]
+        for name, pack, position, length, _ in db.query_all(SELECT_ENTRIES, (username,)):
+            payload = _read_record(username, name, pack, position, length)
+            layout = security._read_layout(io.BytesIO(payload))
+            if layout is None or layout.key_header is None:
+                continue
+            header = key_manager.rewrap_key_header(layout.key_header)
+            start = position + RECORD_SIZE + len(name.encode()) + layout.key_header_offset
+            edits.setdefault(pack, []).append((start, header))
+        for pack, pack_edits in edits.items():
+            with open(pack_path(username, pack), "rb") as f:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)  # No append runs alongside the patch
+                durable.patch_file(pack_path(username, pack), pack_edits, None)
+            rewrapped += len(pack_edits)
+    return rewrapped
+
+
+def migrate(username, to):
+    """Move a user's files between the one-file-per-object layout and packs.
+
+    Offline: run it while nothing else is writing the user's files. .enc
+    files are copied byte for byte (master-key ones are upgraded to a data
+    key first), legacy plaintext files are encrypted on the way in, and
+    deduplicated files are left alone. Returns the number of files moved.
+    """
+    import catalog  # catalog itself reconciles against the pack index
+
+    folder = os.path.join("secure_files", username)
+    moved = 0
+    if to == "pack":
+        names = sorted(os.listdir(folder)) if os.path.isdir(folder) else []
+        for file_name in names:
+            path = os.path.join(folder, file_name)
+            if file_name.endswith((".tmp", dedup_store.MANIFEST_SUFFIX)) or not os.path.isfile(path):
+                continue
+            name = catalog.logical_name(file_name)
+            if file_name.endswith(".enc"):
+                security.upgrade_file(path, username)
+                with open(path, "rb") as f:
+                    stored = put_payload(username, name, f.read())
+            elif os.path.exists(path + ".enc"):
+                continue  # Leftover plaintext next to its .enc; removed with it below
+            else:
+                with open(path, "rb") as f:
+                    stored = put(username, name, f.read())
+            catalog.relocate(username, name, *stored)
+            os.remove(path)
+            plain = os.path.join(folder, name)
+            if file_name.endswith(".enc") and os.path.exists(plain):
+                os.remove(plain)
+            moved += 1
+    elif to == "files":
+        os.makedirs(folder, exist_ok=True)
+        for name in entries(username):
+            target = os.path.join(folder, security.ensure_enc_extension(name))
+            durable.write_bytes(target, read_payload(username, name))
+            st = os.stat(target)
+            catalog.relocate(username, name, target, st.st_size, st.st_mtime_ns)
+            db.execute(DELETE_ENTRY, (username, name))
+            moved += 1
+        for pack in _packs(username):
+            _forget_map(pack_path(username, pack))
+            os.remove(pack_path(username, pack))
+        if os.path.isdir(_user_dir(username)):
+            if os.path.exists(os.path.join(_user_dir(username), LOCK_NAME)):
+                os.remove(os.path.join(_user_dir(username), LOCK_NAME))
+            os.rmdir(_user_dir(username))
+    else:
+        raise ValueError(f"Unknown layout {to!r}; expected 'pack' or 'files'.")
+    print(f"📦 Moved {moved} file(s) of '{username}' to {to}.")
+    return moved
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Pack-file storage maintenance.")
+    parser.add_argument("action", choices=("stats", "compact", "rebuild-index", "migrate"))
+    parser.add_argument("users", nargs="+")
+    parser.add_argument("--to", choices=("pack", "files"), help="target layout for migrate")
+    parser.add_argument("--full", action="store_true", help="compact every pack, dropping all tombstones")
+    args = parser.parse_args()
+    for user in args.users:
+        if args.action == "stats":
+            s = stats(user)
+            print(f"📦 {user}: {s['files']} file(s) in {s['packs']} pack(s), {s['pack_bytes']} bytes, "
+                  f"{round(100 * s['dead_ratio'], 1)}% dead")
+        elif args.action == "compact":
+            compact(user, args.full)
+        elif args.action == "rebuild-index":
+            print(f"📦 {user}: {rebuild_index(user)} file(s) indexed.")
+        elif args.to is None:
+            parser.error("migrate needs --to pack or --to files")
+        else:
+            migrate(user, args.to)
@@ -0,0 +1,209 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+
+# Hash strings are versioned by scheme so stored hashes can be upgraded on login:
+#   $scrypt$ln=<log2 N>,r=<r>,p=<p>$<salt>$<hash>
+#   $pbkdf2-sha256$i=<iterations>$<salt>$<hash>
+#   <64 hex chars>   legacy unsalted SHA-256
+PARAMS_FILE = "kdf_params.json"
+DEFAULT_SCHEME = "scrypt"
+DEFAULT_PARAMS = {
+    "scrypt": {"ln": 14, "r": 8, "p": 1},
+    "pbkdf2-sha256": {"i": 600000},
+}
+SALT_SIZE = 16
+HASH_SIZE = 32
+
+# hashlib's KDFs release the GIL, so a thread pool spreads concurrent logins
+# across cores. MAX_PENDING bounds how much work can queue up behind it.
+MAX_WORKERS = os.cpu_count() or 2
+MAX_PENDING = MAX_WORKERS * 4
+
+_config = None
+_executor = None
+_pending = threading.BoundedSemaphore(MAX_PENDING)
+_lock = threading.Lock()
+_dummy_hashes = {}  # (scheme, params) -> hash of a password nobody knows, see dummy_hash
+
+
+def _b64(data):
+    return base64.b64encode(data).decode().rstrip("=")
+
+
+def _unb64(text):
+    return base64.b64decode(text + "=" * (-len(text) % 4))
+
+
+def _scrypt(password, salt, params):
+    n = 1 << params["ln"]
+    return hashlib.scrypt(
+        password.encode(), salt=salt, n=n, r=params["r"], p=params["p"],
+        maxmem=256 * n * params["r"] + 1024 * 1024, dklen=HASH_SIZE,
+    )
+
+
+def _pbkdf2_sha256(password, salt, params):
+    return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, params["i"], HASH_SIZE)
+
+
+# scheme name -> derive(password, salt, params)
+SCHEMES = {
+    "scrypt": _scrypt,
+    "pbkdf2-sha256": _pbkdf2_sha256,
+}
+
+
+def _format_params(params):
+    return ",".join(f"{k}={v}" for k, v in params.items())
+
+
+def _parse_params(text):
+    return {k: int(v) for k, v in (item.split("=") for item in text.split(","))}
+
+
+def load_config():
+    """Return {"scheme", "params"} from PARAMS_FILE, falling back to the defaults."""
+    global _config
+    with _lock:
+        if _config is None:
+            config = {"scheme": DEFAULT_SCHEME, "params": DEFAULT_PARAMS[DEFAULT_SCHEME]}
+            if os.path.exists(PARAMS_FILE):
+                with open(PARAMS_FILE, "r") as f:
+                    config.update(json.load(f))
+            _config = config
+        return _config
+
+
+def hash_password(password, scheme=None, params=None):
+    """Hash a password with a fresh salt under the configured (or given) scheme."""
+    if scheme is None:
+        config = load_config()
+        scheme, params = config["scheme"], config["params"]
+    elif params is None:
+        params = DEFAULT_PARAMS[scheme]
+    salt = os.urandom(SALT_SIZE)
+    digest = SCHEMES[scheme](password, salt, params)
+    return f"${scheme}${_format_params(params)}${_b64(salt)}${_b64(digest)}"
+
+
+def verify_password(password, stored):
+    """Check a password against a stored hash string.
+
+    Returns (matches, needs_rehash); needs_rehash is True when the stored hash
+    uses a legacy scheme or weaker parameters than the current configuration.
+    """
+    if not stored:
+        return False, False
+    if not stored.startswith("$"):
+        legacy = hashlib.sha256(password.encode()).hexdigest()
+        return hmac.compare_digest(legacy, stored), True
+
+    try:
+        _, scheme, param_text, salt, digest = stored.split("$")
+        derive = SCHEMES[scheme]
+        params = _parse_params(param_text)
+        matches = hmac.compare_digest(derive(password, _unb64(salt), params), _unb64(digest))
+    except (ValueError, KeyError, TypeError):
+        return False, False  # A malformed stored hash matches nothing
+
+    config = load_config()
+    needs_rehash = scheme != config["scheme"] or params != config["params"]
+    return matches, needs_rehash
+
+
+def dummy_hash():
+    """Return a hash under the current configuration of a random password nobody knows.
+
+    Checking a login for an unknown user against it costs as much as checking
+    a wrong password, so timing does not reveal which accounts exist.
+    """
+    config = load_config()
+    key = (config["scheme"], _format_params(config["params"]))
+    with _lock:
+        stored = _dummy_hashes.get(key)
+    if stored is None:
+        stored = hash_password(_b64(os.urandom(SALT_SIZE)), config["scheme"], config["params"])
+        with _lock:
+            _dummy_hashes[key] = stored
+    return stored
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            from concurrent.futures import ThreadPoolExecutor  # Only needed once a hash is computed
+            _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="kdf")
+        return _executor
+
+
+def _submit(fn, *args):
+    _pending.acquire()
+    try:
+        future = _get_executor().submit(fn, *args)
+    except Exception:
+        _pending.release()
+        raise
+    future.add_done_callback(lambda _: _pending.release())
+    return future
+
+
+def hash_password_async(password):
+    """Hash on the KDF worker pool; returns a Future of the hash string."""
+    return _submit(hash_password, password)
+
+
+def verify_password_async(password, stored):
+    """Verify on the KDF worker pool; returns a Future of (matches, needs_rehash)."""
+    return _submit(verify_password, password, stored)
+
+
+def calibrate(target_ms=100, scheme=DEFAULT_SCHEME):
+    """Pick the strongest cost parameters that hash within target_ms on this host."""
+    def measure(params):
+        start = time.perf_counter()
+        SCHEMES[scheme]("calibration-password", os.urandom(SALT_SIZE), params)
+        return (time.perf_counter() - start) * 1000
+
+    if scheme == "scrypt":
+        params = dict(DEFAULT_PARAMS["scrypt"], ln=10)
+        while params["ln"] < 22:
+            candidate = dict(params, ln=params["ln"] + 1)
+            if measure(candidate) > target_ms:
+                break
+            params = candidate
+    else:
+        params = {"i": 10000}
+        elapsed = measure(params)
+        params = {"i": max(10000, int(params["i"] * target_ms / elapsed))}
+    return {"scheme": scheme, "params": params, "ms": round(measure(params), 1)}
+
+
+def save_config(scheme, params):
+    """Write the KDF configuration; existing hashes are upgraded on next login."""
+    global _config
+    with open(PARAMS_FILE, "w") as f:
+        json.dump({"scheme": scheme, "params": params}, f, indent=2)
+    with _lock:
+        _config = None
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Calibrate password hashing cost for this host.")
+    parser.add_argument("--target-ms", type=float, default=100, help="target hash latency in milliseconds")
+    parser.add_argument("--scheme", choices=sorted(SCHEMES), default=DEFAULT_SCHEME)
+    parser.add_argument("--save", action="store_true", help=f"write the result to {PARAMS_FILE}")
+    args = parser.parse_args()
+
+    result = calibrate(args.target_ms, args.scheme)
+    print(f"⏱️ {result['scheme']} {_format_params(result['params'])}: {result['ms']} ms per hash")
+    if args.save:
+        save_config(result["scheme"], result["params"])
+        print(f"✅ Saved to {PARAMS_FILE}.")
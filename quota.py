@@ -0,0 +1,210 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+import catalog
+import db
+import key_manager
+import user_store
+
+try:
+    import fcntl
+except ImportError:  # Windows: writes are serialized only within this process
+    fcntl = None
+
+# Per-user storage limits, checked against the catalog's running totals (see
+# catalog.user_usage) before a write touches the disk. Limits count plaintext
+# bytes, which the user can predict, not what compression and encryption make
+# of them. A user with no row in quotas gets the defaults; None means no
+# limit. Writes that do not grow a file or add one are always allowed, so a
+# user over quota can still shrink and delete files. file_manager makes the
+# check and the write under the user's quota lock (see locked), so two writes
+# cannot both pass the check against the same total. Users without limits
+# skip the lock, so a quota set while such a user's writes are in flight is
+# only enforced from their next write on; those writes may take the user past
+# it, and the user is then over quota as if the limit had been lowered.
+DEFAULT_MAX_BYTES = None
+DEFAULT_MAX_FILES = None
+LOCK_DIR = "quota_locks"  # one lock file per user, for writers in other processes
+RECONCILE_INTERVAL = 3600  # seconds between background passes comparing the totals with disk
+
+CREATE_QUOTAS = '''CREATE TABLE IF NOT EXISTS quotas (
+                     username TEXT PRIMARY KEY,
+                     max_bytes INTEGER,
+                     max_files INTEGER)'''
+UPSERT_QUOTA = '''INSERT INTO quotas (username, max_bytes, max_files) VALUES (?, ?, ?)
+                  ON CONFLICT (username) DO UPDATE SET
+                     max_bytes = excluded.max_bytes, max_files = excluded.max_files'''
+DELETE_QUOTA = 'DELETE FROM quotas WHERE username = ?'
+SELECT_QUOTA = 'SELECT max_bytes, max_files FROM quotas WHERE username = ?'
+SELECT_REPORT = '''SELECT u.username, u.role, COALESCE(g.files, 0), COALESCE(g.logical_bytes, 0),
+                          COALESCE(g.stored_bytes, 0), COALESCE(q.max_bytes, ?), COALESCE(q.max_files, ?)
+                   FROM users u
+                   LEFT JOIN user_usage g ON g.username = u.username
+                   LEFT JOIN quotas q ON q.username = u.username
+                   ORDER BY u.username'''
+SELECT_COUNTED_USERS = 'SELECT username FROM user_usage WHERE files != 0'
+REPORT_COLUMNS = ("user", "role", "files", "logical_bytes", "stored_bytes", "max_bytes", "max_files")
+
+_initialized = set()
+_lock = threading.Lock()
+_reconciler = None
+_user_locks = {}  # username -> [lock, holders]
+
+
+class QuotaExceededError(Exception):
+    """A write would take a user past their storage quota."""
+
+
+def initialize():
+    """Create the quotas table (and the tables the report joins) once per database per process."""
+    path = db.DB_NAME
+    if path in _initialized:
+        return
+    with _lock:
+        if path not in _initialized:
+            catalog.initialize()
+            user_store.initialize()
+            with db.transaction() as conn:
+                conn.execute(CREATE_QUOTAS)
+            _initialized.add(path)
+
+
+def limits(username):
+    """Return (max bytes, max files) for a user; None means unlimited."""
+    initialize()
+    row = db.query_one(SELECT_QUOTA, (username,))
+    max_bytes, max_files = row if row else (None, None)
+    return (DEFAULT_MAX_BYTES if max_bytes is None else max_bytes,
+            DEFAULT_MAX_FILES if max_files is None else max_files)
+
+
+def set_quota(username, max_bytes=None, max_files=None):
+    """Set a user's limits; None for either falls back to the default."""
+    initialize()
+    if max_bytes is None and max_files is None:
+        db.execute(DELETE_QUOTA, (username,))
+    else:
+        db.execute(UPSERT_QUOTA, (username, max_bytes, max_files))
+
+
+@contextmanager
+def locked(username):
+    """Hold a user's quota lock from the quota check until the catalog records the write.
+
+    Users without limits are not locked, since there is nothing to check
+    (see the note on in-flight writes above). Raises ValueError for a
+    username that cannot name a lock file (see key_manager.check_owner).
+    """
+    key_manager.check_owner(username)
+    if limits(username) == (None, None):
+        yield
+        return
+    with _lock:
+        entry = _user_locks.setdefault(username, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            os.makedirs(LOCK_DIR, exist_ok=True)
+            with open(os.path.join(LOCK_DIR, username + ".lock"), "ab") as f:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                yield
+    finally:
+        with _lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del _user_locks[username]  # Keep the table as small as the set of busy users
+
+
+def _check(username, name, new_size):
+    max_bytes, max_files = limits(username)
+    if max_bytes is None and max_files is None:
+        return
+    catalog.ensure_reconciled(username)
+    row = catalog.get_file(username, name)
+    old_size = row["size"] if row else 0
+    size = new_size(old_size)
+    files, used, _ = catalog.usage(username)
+    if row is None and max_files is not None and files + 1 > max_files:
+        raise QuotaExceededError(f"'{username}' already has {files} of {max_files} files allowed.")
+    if size > old_size and max_bytes is not None and used + size - old_size > max_bytes:
+        raise QuotaExceededError(f"'{username}' is using {used} of {max_bytes} bytes allowed; "
+                                 f"'{name}' needs {size - old_size} more.")
+
+
+def check_write(username, name, size):
+    """Raise QuotaExceededError if writing size bytes as name would exceed the user's quota."""
+    _check(username, name, lambda old_size: size)
+
+
+def check_edit(username, name, offset, length):
+    """Like check_write, for writing length bytes at offset (appending if None)."""
+    _check(username, name, lambda old_size: old_size + length if offset is None
+           else max(old_size, offset + length))
+
+
+def usage_report():
+    """Return one dict per registered user with their totals and limits, in one query."""
+    initialize()
+    rows = db.query_all(SELECT_REPORT, (DEFAULT_MAX_BYTES, DEFAULT_MAX_FILES))
+    return [dict(zip(REPORT_COLUMNS, row)) for row in rows]
+
+
+def reconcile_all(root=catalog.ROOT):
+    """Reconcile every user's catalog with disk, then their totals with the catalog.
+
+    Returns (users reconciled, users whose totals had drifted).
+    """
+    initialize()
+    users = {row[0] for row in db.query_all(SELECT_COUNTED_USERS)}
+    if os.path.isdir(root):
+        users.update(name for name in os.listdir(root) if os.path.isdir(os.path.join(root, name)))
+    for username in sorted(users):
+        catalog.reconcile(username, root)
+    return len(users), catalog.recount_usage()
+
+
+def start_reconciler(interval=RECONCILE_INTERVAL):
+    """Run reconcile_all every interval seconds on a daemon thread (once per process)."""
+    global _reconciler
+    with _lock:
+        if _reconciler is not None:
+            return _reconciler
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    reconcile_all()
+                except Exception as e:
+                    print(f"❌ Background usage reconcile failed: {e}")
+
+        _reconciler = threading.Thread(target=run, name="usage-reconciler", daemon=True)
+        _reconciler.start()
+        return _reconciler
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Show and manage per-user storage quotas.")
+    parser.add_argument("action", nargs="?", default="report", choices=("report", "set", "reconcile"))
+    parser.add_argument("--user", help="user to set limits for")
+    parser.add_argument("--max-mb", type=float, help="plaintext megabytes allowed; omit for the default")
+    parser.add_argument("--max-files", type=int, help="files allowed; omit for the default")
+    args = parser.parse_args()
+
+    if args.action == "set":
+        if not args.user:
+            parser.error("set needs --user")
+        max_bytes = None if args.max_mb is None else int(args.max_mb * 1024 * 1024)
+        set_quota(args.user, max_bytes, args.max_files)
+        print(f"✅ Limits for '{args.user}': {limits(args.user)}")
+    elif args.action == "reconcile":
+        users, drifted = reconcile_all()
+        print(f"🔄 Reconciled {users} users; corrected the totals of {drifted}.")
+    else:
+        for r in usage_report():
+            print(f"📦 {r['user']} ({r['role']}): {r['files']} files, {r['logical_bytes']} bytes "
+                  f"({r['stored_bytes']} stored), limits {r['max_bytes']} bytes / {r['max_files']} files")
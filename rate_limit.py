@@ -0,0 +1,204 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+import db
+
+# Login throttling. Every attempt takes a token from two buckets, one for the
+# username and one for the client it comes from (an IP address, or a fixed
+# name for local consoles); an attempt that finds either bucket empty is
+# refused before the password is hashed or the database is read. Buckets
+# refill continuously at their rate up to their burst size. Each limiter
+# keeps at most MAX_BUCKETS of them and evicts the least recently used,
+# which comes back full if its key returns.
+# With PERSIST on, buckets that failed attempts have emptied are saved in
+# SQLite and loaded once per process, so restarting the app (or running the
+# CLI again) does not reopen a key that is being refused. Only emptied
+# buckets get a row, so guessing at many names costs a full burst per row,
+# and rows whose bucket has refilled are deleted every PRUNE_INTERVAL.
+ENABLED = True
+PERSIST = True
+USER_RATE = 1 / 30   # attempts per second per username once the burst is used up
+USER_BURST = 10
+CLIENT_RATE = 0.5    # attempts per second per client once the burst is used up
+CLIENT_BURST = 10
+MAX_BUCKETS = 100000  # per limiter
+PRUNE_INTERVAL = 600  # seconds between sweeps of refilled rows
+
+CREATE_BUCKETS = '''CREATE TABLE IF NOT EXISTS login_buckets (
+                      scope TEXT NOT NULL,
+                      key TEXT NOT NULL,
+                      tokens REAL NOT NULL,
+                      updated REAL NOT NULL,
+                      PRIMARY KEY (scope, key))'''
+SAVE_BUCKET = '''INSERT INTO login_buckets (scope, key, tokens, updated) VALUES (?, ?, ?, ?)
+                 ON CONFLICT (scope, key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated'''
+DELETE_BUCKET = 'DELETE FROM login_buckets WHERE scope = ? AND key = ?'
+SELECT_BUCKETS = 'SELECT scope, key, tokens, updated FROM login_buckets'
+
+
+class TokenBucketLimiter:
+    """Token buckets per key, keeping at most max_keys of them (least recently used go first)."""
+
+    def __init__(self, rate, burst, max_keys=MAX_BUCKETS):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> [tokens, time of last update]
+        self._lock = threading.Lock()
+
+    def _level(self, bucket, now):
+        return min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+
+    def take(self, key, now=None):
+        """Take a token for key. Returns 0 if one was available, else the seconds until one is."""
+        now = time.time() if now is None else now
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(self.burst), now]
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            tokens = self._level(bucket, now)
+            if tokens < 1:
+                bucket[0], bucket[1] = tokens, now
+                return (1 - tokens) / self.rate
+            bucket[0], bucket[1] = tokens - 1, now
+            return 0
+
+    def state(self, key):
+        """Return (tokens, updated) for key, or None if it has no bucket."""
+        with self._lock:
+            bucket = self._buckets.get(key)
+            return tuple(bucket) if bucket else None
+
+    def restore(self, key, tokens, updated):
+        with self._lock:
+            self._buckets[key] = [tokens, updated]
+            self._buckets.move_to_end(key, last=False)  # First to go if memory runs short
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+
+    def reset(self, key):
+        with self._lock:
+            self._buckets.pop(key, None)
+
+    def is_full(self, tokens, updated, now):
+        return tokens + (now - updated) * self.rate >= self.burst
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+_limiters = {
+    "user": TokenBucketLimiter(USER_RATE, USER_BURST),
+    "client": TokenBucketLimiter(CLIENT_RATE, CLIENT_BURST),
+}
+_saved = set()  # (scope, key) rows in login_buckets
+_loaded = set()
+_pruned = {}  # database -> time of the last sweep
+_lock = threading.Lock()
+
+
+def _prune(conn, now):
+    """Delete the saved rows whose bucket has refilled; returns the others."""
+    kept, refilled = [], []
+    for scope, key, tokens, updated in conn.execute(SELECT_BUCKETS).fetchall():
+        limiter = _limiters.get(scope)
+        if limiter is None or limiter.is_full(tokens, updated, now):
+            refilled.append((scope, key))
+        else:
+            kept.append((scope, key, tokens, updated))
+    conn.executemany(DELETE_BUCKET, refilled)
+    _saved.difference_update(refilled)
+    _pruned[db.DB_NAME] = now
+    return kept
+
+
+def _load():
+    """Restore the saved buckets once per database per process, dropping those that refilled."""
+    if not PERSIST or db.DB_NAME in _loaded:
+        return
+    with _lock:
+        if db.DB_NAME in _loaded:
+            return
+        with db.transaction() as conn:
+            conn.execute(CREATE_BUCKETS)
+            for scope, key, tokens, updated in _prune(conn, time.time()):
+                _limiters[scope].restore(key, tokens, updated)
+                _saved.add((scope, key))
+        _loaded.add(db.DB_NAME)
+
+
+def _keys(username, client):
+    keys = [("client", client)] if client is not None else []
+    return keys + [("user", username)]
+
+
+def check_login(username, client=None):
+    """Take a login attempt for username from client.
+
+    Returns 0 if the attempt may go ahead, else the whole seconds to wait.
+    Costs no database access after the first call in a process.
+    """
+    if not ENABLED:
+        return 0
+    _load()
+    for scope, key in _keys(username, client):
+        wait = _limiters[scope].take(key)
+        if wait:
+            return math.ceil(wait)
+    return 0
+
+
+def record_failure(username, client=None):
+    """Save the buckets a failed attempt emptied, so they survive a restart.
+
+    Buckets that already have a row are kept up to date; others are saved
+    only once they refuse attempts.
+    """
+    if not (ENABLED and PERSIST):
+        return
+    _load()
+    rows = []
+    for scope, key in _keys(username, client):
+        state = _limiters[scope].state(key)
+        if state is not None and (state[0] < 1 or (scope, key) in _saved):
+            rows.append((scope, key) + state)
+    now = time.time()
+    due = now - _pruned.get(db.DB_NAME, 0) >= PRUNE_INTERVAL
+    if not rows and not due:
+        return
+    with _lock, db.transaction() as conn:
+        conn.executemany(SAVE_BUCKET, rows)
+        _saved.update(row[:2] for row in rows)
+        if due:
+            _prune(conn, now)
+
+
+def record_success(username, client=None):
+    """Refill a user's bucket after a full login; the client's keeps its count."""
+    if not ENABLED:
+        return
+    _limiters["user"].reset(username)
+    if ("user", username) in _saved:
+        db.execute(DELETE_BUCKET, ("user", username))
+        _saved.discard(("user", username))
+
+
+def reset(username=None, client=None):
+    """Lift the limits on a username and/or client, e.g. from an admin console."""
+    _load()
+    for scope, key in (("user", username), ("client", client)):
+        if key is not None:
+            _limiters[scope].reset(key)
+            if PERSIST:
+                db.execute(DELETE_BUCKET, (scope, key))
+            _saved.discard((scope, key))
+
+
+def stats():
+    """Return the number of buckets held per scope."""
+    return {scope: len(limiter) for scope, limiter in _limiters.items()}
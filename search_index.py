@@ -0,0 +1,524 @@
+import bisect
+import itertools
+import json
+import os
+import re
+import threading
+import time
+from array import array
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+import catalog
+import dedup_store
+import metrics
+import pack_store
+import security
+
+try:
+    import fcntl
+except ImportError:  # Windows: merges are not serialized against other processes' writes
+    fcntl = None
+
+# Per-user full-text index, kept as a log of encrypted segments:
+#   search_index/<username>/<time_ns>-<pid>-<n>.seg    changes (indexed, stale or deleted files)
+#   search_index/<username>/<time_ns>-<pid>-<n>.base   the whole index as of that point
+# Each segment is JSON encrypted under the user's key like any stored file,
+# holding each indexed file's version and how often each term occurs in it
+# (segments written before counts were kept hold the terms in order instead).
+# A user's index is loaded on their first search, by replaying the newest
+# base and every later segment; writes only append a small segment, and
+# once enough have piled up they are merged into a new base.
+#
+# Files edited in place (file_manager.edit_file) are only marked stale and
+# re-read at the next search, so an append does not cost a full decrypt.
+#
+# Term positions are only kept where phrase queries need them: words and
+# prefixes are scored from the counts, and a phrase is checked against the
+# term id sequences of the files that contain all of its words, read from
+# the files the first time and then kept (up to PHRASE_CACHE_BYTES, least
+# recently used first out). Merges renumber the terms, dropping those no
+# file contains any more.
+# On load, the index is also checked against the catalog, which picks up
+# files changed outside file_manager.
+#
+# Writers hold search_index/<username>/.lock shared while writing a segment
+# and a merge holds it exclusively, so when a merge names its base no segment
+# is half written: every segment named before the base is in it, and every
+# later one is named after it.
+INDEX_ROOT = "search_index"
+SEGMENT_SUFFIX = ".seg"
+BASE_SUFFIX = ".base"
+LOCK_NAME = ".lock"
+MERGE_SEGMENTS = 32          # segments since the base before a merge (more for big indexes)
+MAX_UNLOADED_SEGMENTS = 256  # a process that never searched loads and merges past this
+MAX_TERM_LENGTH = 64
+TOKEN_RE = re.compile(r"\w+")
+QUERY_RE = re.compile(r'"([^"]*)"|(\S+)')
+TERM_ID_TYPE = "I"
+TERM_ID_SIZE = array(TERM_ID_TYPE).itemsize
+NO_TERM = (1 << (8 * TERM_ID_SIZE)) - 1  # stands for words the index has no id for
+PHRASE_CACHE_BYTES = 64 * 1024 * 1024   # term id sequences kept per user for phrase queries
+
+_indexes = {}
+_lock = threading.Lock()
+_counter = itertools.count()
+
+
+def tokenize(text):
+    """Return the index terms of text, in order: lowercase words of at most MAX_TERM_LENGTH."""
+    return [w for w in TOKEN_RE.findall(text.lower()) if len(w) <= MAX_TERM_LENGTH]
+
+
+def _index_dir(username):
+    return os.path.join(INDEX_ROOT, username)
+
+
+def _segment_names(username):
+    """Return the user's segment file names in write order."""
+    try:
+        names = os.listdir(_index_dir(username))
+    except FileNotFoundError:
+        return []
+    return sorted(n for n in names if n.endswith((SEGMENT_SUFFIX, BASE_SUFFIX)))
+
+
+@contextmanager
+def _dir_lock(username, exclusive=False):
+    """Hold the user's index lock: shared to write a segment, exclusive to merge."""
+    os.makedirs(_index_dir(username), exist_ok=True)
+    with open(os.path.join(_index_dir(username), LOCK_NAME), "ab") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+
+
+def _write_segment(username, segment, suffix=SEGMENT_SUFFIX, locked=False):
+    """Encrypt a segment into a new file under the user's index directory; returns its name.
+
+    The name is taken under the index lock (pass locked=True if the caller
+    already holds it), so it orders correctly against merges.
+    """
+    if not locked:
+        with _dir_lock(username):
+            return _write_segment(username, segment, suffix, locked=True)
+    name = f"{time.time_ns():020d}-{os.getpid()}-{next(_counter)}{suffix}"
+    data = json.dumps(segment, separators=(",", ":")).encode()
+    security.write_encrypted(os.path.join(_index_dir(username), name), data, owner=username, compress=True)
+    return name
+
+
+def _read_stored(username, name, path):
+    """Return the plaintext of a stored file as text, for indexing."""
+    if path.endswith(dedup_store.MANIFEST_SUFFIX):
+        data = dedup_store.get(username, name)
+    elif path.endswith(pack_store.PACK_SUFFIX):
+        data = pack_store.get(username, name)
+    elif path.endswith(".enc"):
+        data = security.read_encrypted(path, owner=username)
+    else:
+        with open(path, "rb") as f:
+            data = f.read()
+    return data.decode(errors="ignore")
+
+
+def _count(haystack, needle):
+    """Count occurrences of a term id sequence in a document, at term boundaries only."""
+    count = 0
+    i = haystack.find(needle)
+    while i != -1:
+        if i % TERM_ID_SIZE == 0:
+            count += 1
+            i = haystack.find(needle, i + TERM_ID_SIZE)
+        else:
+            i = haystack.find(needle, i + 1)
+    return count
+
+
+def _doc_entry(doc):
+    """Return {term: count} of a segment's document entry, in either format."""
+    return doc["c"] if "c" in doc else Counter(doc["t"].split())
+
+
+class UserIndex:
+    """In-memory inverted index of one user's files.
+
+    Postings map term ids to the sorted ids of the files containing them, and
+    every file keeps its sorted term ids with their counts. Phrases are found
+    with a plain substring search in a file's term id sequence, packed into
+    bytes, which is only built for files that have all of a phrase's words.
+    """
+
+    def __init__(self, username):
+        self.username = username
+        self.term_ids = {}  # term -> term id
+        self.postings = {}  # term id -> array of doc ids, ascending
+        self.docs = {}      # file name -> doc id
+        self.info = {}      # doc id -> (file name, version, packed sorted term ids, packed counts)
+        self.stale = set()  # files edited in place since they were indexed
+        self.segments = []  # segment files replayed so far
+        self._terms = None  # sorted terms for prefix queries, rebuilt when None
+        self._doc_ids = itertools.count()
+        self._sequences = OrderedDict()  # doc id -> packed term ids in order, for phrases
+        self._sequence_bytes = 0
+        self.lock = threading.RLock()
+
+    # --- in-memory changes ---
+
+    def _term_id(self, term):
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            term_id = self.term_ids[term] = len(self.term_ids)
+            self._terms = None
+        return term_id
+
+    def _add(self, name, version, counts):
+        self._remove(name)
+        doc_id = next(self._doc_ids)  # Always the highest, so appending keeps postings sorted
+        items = sorted((self._term_id(term), count) for term, count in counts.items())
+        ids = array(TERM_ID_TYPE, [term_id for term_id, _ in items])
+        for term_id in ids:
+            self.postings.setdefault(term_id, array(TERM_ID_TYPE)).append(doc_id)
+        self.docs[name] = doc_id
+        self.info[doc_id] = (name, version, ids.tobytes(), array(TERM_ID_TYPE, [c for _, c in items]).tobytes())
+
+    def _remove(self, name):
+        self.stale.discard(name)
+        doc_id = self.docs.pop(name, None)
+        if doc_id is None:
+            return
+        self._sequence_bytes -= len(self._sequences.pop(doc_id, b""))
+        packed = self.info.pop(doc_id)[2]
+        for term_id in array(TERM_ID_TYPE, packed):
+            files = self.postings[term_id]
+            del files[bisect.bisect_left(files, doc_id)]
+            if not files:
+                del self.postings[term_id]
+
+    def _clear(self):
+        self.postings.clear()
+        self.docs.clear()
+        self.info.clear()
+        self.stale.clear()
+        self._sequences.clear()
+        self._sequence_bytes = 0
+
+    def _apply(self, segment):
+        if segment.get("base"):
+            self._clear()
+        for name in segment.get("deleted", ()):
+            self._remove(name)
+        for name, doc in segment.get("docs", {}).items():
+            self._add(name, tuple(doc["v"]), _doc_entry(doc))
+        self.stale.update(n for n in segment.get("stale", ()) if n in self.docs)
+
+    # --- segments on disk ---
+
+    def _write(self, segment, suffix=SEGMENT_SUFFIX, locked=False):
+        name = _write_segment(self.username, segment, suffix, locked)
+        self.segments.append(name)
+        return name
+
+    def refresh(self):
+        """Replay segments written since the last refresh, by this or another process.
+
+        Only segments from the newest base on count; a newer base than the
+        one loaded resets the index by itself when it is applied.
+        """
+        names = _segment_names(self.username)
+        bases = [n for n in names if n.endswith(BASE_SUFFIX)]
+        live = names[names.index(bases[-1]):] if bases else names
+        applied = set(self.segments)
+        pending = [n for n in live if n not in applied]
+        if not pending:
+            return 0
+        if self.segments and pending[0] < self.segments[-1]:
+            # A segment landed behind one already applied: replay everything in order
+            self._clear()
+            applied = set()
+            pending = live
+        for name in pending:
+            path = os.path.join(_index_dir(self.username), name)
+            try:
+                self._apply(json.loads(security.read_encrypted(path, owner=self.username)))
+            except FileNotFoundError:
+                continue  # Merged away by another process meanwhile
+            applied.add(name)
+        self.segments = [n for n in live if n in applied]
+        return len(pending)
+
+    def load(self):
+        """Replay the segments, then index whatever the catalog says is missing or changed."""
+        self.refresh()
+        state = catalog.disk_state(self.username)
+        versions = {name: version for name, version, _, _ in self.info.values()}
+        changed = [name for name, (path, size, mtime) in state.items()
+                   if versions.get(name) != (size, mtime)]
+        deleted = [name for name in self.docs if name not in state]
+        if changed or deleted:
+            self._reindex(changed, deleted, state)
+        self.merge_if_needed()
+
+    def _reindex(self, names, deleted=(), state=None):
+        """Read and index files, drop deleted ones, and record it all in one segment."""
+        if state is None:
+            state = catalog.disk_state(self.username)
+        docs = {}
+        for name in names:
+            if name not in state:
+                deleted = list(deleted) + [name]
+                continue
+            path, size, mtime = state[name]
+            try:
+                terms = tokenize(_read_stored(self.username, name, path))
+            except (OSError, ValueError):
+                print(f"❌ Could not index '{name}' for user '{self.username}'.")
+                self.stale.discard(name)
+                continue
+            docs[name] = {"v": [size, mtime], "c": Counter(terms)}
+        segment = {"docs": docs, "deleted": list(deleted)}
+        self._apply(segment)
+        self._write(segment)
+
+    def merge_if_needed(self):
+        # Merging rewrites the whole index, so large indexes wait for more
+        # segments: the merge cost per write stays bounded.
+        if len(self.segments) > max(MERGE_SEGMENTS, len(self.docs) // 16):
+            self.merge()
+
+    def merge(self):
+        """Write the whole index as a new base and delete the segments it replaces.
+
+        Under the exclusive index lock no other process is writing a segment,
+        so the last refresh sees every segment the base will be named after.
+        """
+        with _dir_lock(self.username, exclusive=True):
+            self.refresh()
+            self._renumber_terms()
+            terms = self._terms_by_id()
+            docs = {}
+            for name, version, packed, counts in self.info.values():
+                docs[name] = {"v": list(version), "c": dict(zip((terms[i] for i in array(TERM_ID_TYPE, packed)),
+                                                              array(TERM_ID_TYPE, counts)))}
+            old = list(self.segments)
+            base = {"base": True, "docs": docs, "stale": sorted(self.stale)}
+            self.segments = [self._write(base, BASE_SUFFIX, locked=True)]
+            for name in old:
+                try:
+                    os.remove(os.path.join(_index_dir(self.username), name))
+                except FileNotFoundError:
+                    pass
+
+    def _renumber_terms(self):
+        """Give the terms some file still contains ids 0..n-1, forgetting the others."""
+        terms = self._terms_by_id()
+        used = sorted(self.postings)
+        if len(used) == len(terms):
+            return
+        new_ids = {old: new for new, old in enumerate(used)}
+        self.term_ids = {terms[old]: new for old, new in new_ids.items()}
+        self.postings = {new_ids[old]: files for old, files in self.postings.items()}
+        for doc_id, (name, version, packed, counts) in self.info.items():
+            # Renumbering keeps the order of the remaining ids, so they stay sorted
+            ids = array(TERM_ID_TYPE, [new_ids[i] for i in array(TERM_ID_TYPE, packed)])
+            self.info[doc_id] = (name, version, ids.tobytes(), counts)
+        self._sequences.clear()
+        self._sequence_bytes = 0
+        self._terms = None
+
+    # --- queries ---
+
+    def _count_of(self, doc_id, term_id):
+        """How often a term occurs in a file."""
+        _, _, packed, counts = self.info[doc_id]
+        ids = array(TERM_ID_TYPE, packed)
+        i = bisect.bisect_left(ids, term_id)
+        return array(TERM_ID_TYPE, counts)[i] if i < len(ids) and ids[i] == term_id else 0
+
+    def _sequence(self, doc_id):
+        """Return a file's term ids in order, packed into bytes, reading the file if it is not cached."""
+        packed = self._sequences.get(doc_id)
+        if packed is not None:
+            self._sequences.move_to_end(doc_id)
+            return packed
+        name = self.info[doc_id][0]
+        row = catalog.get_file(self.username, name)
+        try:
+            text = _read_stored(self.username, name, row["path"]) if row else ""
+        except (OSError, ValueError):
+            text = ""
+        packed = array(TERM_ID_TYPE, [self.term_ids.get(term, NO_TERM) for term in tokenize(text)]).tobytes()
+        self._sequences[doc_id] = packed
+        self._sequence_bytes += len(packed)
+        while self._sequence_bytes > PHRASE_CACHE_BYTES:
+            self._sequence_bytes -= len(self._sequences.popitem(last=False)[1])
+        return packed
+
+    def _terms_by_id(self):
+        terms = [None] * len(self.term_ids)
+        for term, term_id in self.term_ids.items():
+            terms[term_id] = term
+        return terms
+
+    def _sorted_terms(self):
+        if self._terms is None:
+            self._terms = sorted(self.term_ids)
+        return self._terms
+
+    def _prefix(self, prefix):
+        """Files containing any term starting with prefix, scored by the number of such terms."""
+        terms = self._sorted_terms()
+        matches = {}
+        for term in itertools.islice(terms, bisect.bisect_left(terms, prefix), None):
+            if not term.startswith(prefix):
+                break
+            for doc_id in self.postings.get(self.term_ids[term], ()):
+                matches[doc_id] = matches.get(doc_id, 0) + 1
+        return matches
+
+    def search(self, query):
+        """Return [(file name, score)] matching every clause of query, best first.
+
+        Candidates are narrowed with the postings of every clause first, so
+        occurrences are only counted in files that can still match.
+        """
+        clauses = []  # (doc id -> score) for prefixes, (postings, term ids) for words and phrases
+        for phrase, word in QUERY_RE.findall(query):
+            terms = tokenize(phrase or word)
+            if not terms:
+                continue  # Nothing searchable in this clause, e.g. punctuation
+            if not phrase and word.endswith("*") and len(terms) == 1:
+                clauses.append((self._prefix(terms[0]), None))
+                continue
+            ids = [self.term_ids.get(term) for term in terms]  # A word is a phrase of one term
+            lists = [self.postings.get(term_id) for term_id in ids]
+            if not all(lists):
+                return []
+            clauses.append((lists, ids))
+        if not clauses:
+            return []
+
+        sets = []
+        for found, ids in clauses:
+            sets.extend(found if ids is not None else [found.keys()])
+        sets.sort(key=len)
+        candidates = set(sets[0])
+        for files in sets[1:]:
+            candidates.intersection_update(files)
+        scores = dict.fromkeys(candidates, 0)
+        for found, ids in clauses:
+            if ids is None:
+                for doc_id in scores:
+                    scores[doc_id] += found[doc_id]
+                continue
+            needle = array(TERM_ID_TYPE, ids).tobytes()
+            for doc_id in list(scores):
+                if len(ids) == 1:
+                    count = self._count_of(doc_id, ids[0])
+                else:
+                    count = _count(self._sequence(doc_id), needle)
+                if count:
+                    scores[doc_id] += count
+                else:
+                    del scores[doc_id]  # Has the words, but not in this order
+        named = [(self.info[doc_id][0], score) for doc_id, score in scores.items()]
+        return sorted(named, key=lambda item: (-item[1], item[0]))
+
+
+def _get_index(username, load=True):
+    """Return the user's index, loading it on first use if load is set (else None when not loaded)."""
+    with _lock:
+        index = _indexes.get((INDEX_ROOT, username))
+        if index is None:
+            if not load:
+                return None
+            index = _indexes[(INDEX_ROOT, username)] = UserIndex(username)
+            index.lock.acquire()
+            loading = True
+        else:
+            loading = False
+    if loading:
+        try:
+            index.load()
+        except BaseException:
+            with _lock:
+                _indexes.pop((INDEX_ROOT, username), None)
+            raise
+        finally:
+            index.lock.release()
+    return index
+
+
+def _append_segment(username, segment):
+    """Record a change: applied to the loaded index if there is one, else only written to disk."""
+    index = _get_index(username, load=False)
+    if index is None:
+        _write_segment(username, segment)  # Applied whenever the index is next loaded
+        if len(_segment_names(username)) <= MAX_UNLOADED_SEGMENTS:
+            return
+        _get_index(username)  # Loading merges the backlog
+        return
+    with index.lock:
+        index.refresh()
+        index._apply(segment)
+        index._write(segment)
+        index.merge_if_needed()
+
+
+@metrics.instrument("search_index.index_file")
+def index_file(username, name, text):
+    """Index (or re-index) a file's content after it was written and recorded in the catalog."""
+    row = catalog.get_file(username, name)
+    version = [row["stored_size"], row["disk_mtime_ns"]] if row else [None, None]
+    _append_segment(username, {"docs": {name: {"v": version, "c": Counter(tokenize(text))}}})
+
+
+@metrics.instrument("search_index.mark_stale")
+def mark_stale(username, name):
+    """Note that a file changed without its full text at hand; it is re-read at the next search."""
+    _append_segment(username, {"stale": [name]})
+
+
+@metrics.instrument("search_index.remove_file")
+def remove_file(username, name):
+    _append_segment(username, {"deleted": [name]})
+
+
+@metrics.instrument("search_index.search")
+def search(username, query, limit=None):
+    """Return [(file name, score)] for a query, best match first.
+
+    A query is a list of clauses that must all match: a word, a prefix
+    ending in * (e.g. "encrypt*"), or a phrase in double quotes. Matching
+    ignores case.
+    """
+    index = _get_index(username)
+    with index.lock:
+        index.refresh()
+        if index.stale:
+            index._reindex(sorted(index.stale))
+        results = index.search(query)
+    return results if limit is None else results[:limit]
+
+
+@metrics.instrument("search_index.rebuild")
+def rebuild(username):
+    """Drop a user's index and build it again from their files."""
+    with _lock:
+        _indexes.pop((INDEX_ROOT, username), None)
+    for name in _segment_names(username):
+        os.remove(os.path.join(_index_dir(username), name))
+    index = _get_index(username)
+    with index.lock:
+        index.merge()
+    return len(index.docs)
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) < 3:
+        print("Usage: python search_index.py <username> <query> | --rebuild <username>")
+    elif sys.argv[1] == "--rebuild":
+        print(f"🔎 Indexed {rebuild(sys.argv[2])} file(s) for '{sys.argv[2]}'.")
+    else:
+        for name, score in search(sys.argv[1], " ".join(sys.argv[2:])):
+            print(f"{score:>6}  {name}")
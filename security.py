@@ -1,94 +1,862 @@
+import hashlib
+import hmac
+import io
 import os
+import struct
+from collections import namedtuple
+from contextlib import contextmanager
+from itertools import chain
 from Crypto.Cipher import AES
-from Crypto.Random import get_random_bytes
+import cipher_suites
+import compression
+import durable
+import key_manager
+import metrics
+from key_manager import KEY_FILE, generate_key
 
-KEY_FILE = "encryption_key.key"
+try:
+    import fcntl
+except ImportError:  # Windows: writers of the same file are not serialized, see _file_lock
+    fcntl = None
 
-def generate_key():
-    if not os.path.exists(KEY_FILE):
-        key = get_random_bytes(32)  # 256-bit AES key
-        with open(KEY_FILE, "wb") as f:
-            f.write(key)
-        print("🔑 Encryption key generated.")
-    else:
-        print("🔑 Encryption key already exists.")
+# Chunked container format:
+#   header: MAGIC | version (1 byte) | chunk size (4 bytes, big-endian)
+#           version 3 adds: codec (1) | level (1), see compression
+#           version 4 adds: chunk stream length (8 bytes), right after the codec
+#           version 5 adds: cipher suite (1 byte, see cipher_suites) between the codec and
+#                   the length; a length of NO_LENGTH means the file has no block map
+#           versions 2+ add: key header length (2 bytes) | wrapped data key (see key_manager)
+#   chunks: nonce (16) | tag (16) | ciphertext (chunk size bytes, or fewer for the last one)
+#   version 4+ trailer: block map, i.e. per chunk its tag (16) | keyed digest of its
+#           contents (16), then a MAC (32) over the header, stream length and block map
+# The last chunk is always shorter than the chunk size (possibly empty) and is
+# authenticated as final, so a file cut at a chunk boundary fails to decrypt.
+# The wrapped data key is deliberately left out of the chunks' associated data
+# so key rotation can rewrite it in place; an empty one means the file is
+# encrypted directly under the caller's key (the master key by default).
+# With a codec, the chunks hold the compressed stream rather than the plaintext.
+# Version 4 lets single chunks be re-encrypted in place (see write_at): the
+# stream length and block map are rewritten with them, and the MAC over the
+# map ties every chunk to the current version of the file, so an old chunk
+# copied back over a new one fails to verify. Version 4 files were written
+# whenever the destination was seekable, and version 3 for pure streams.
+# Versions 1-4 are always AES-EAX. Version 5, which every new file gets,
+# records the suite (authenticated with every chunk, like the rest of the
+# header) and has a block map only when the destination could seek.
+# Files without MAGIC are the original single-shot nonce | tag | ciphertext layout.
+MAGIC = b"SFC\x00"
+FORMAT_VERSION = 5
+SUPPORTED_VERSIONS = (1, 2, 3, 4, 5)
+CHUNK_SIZE = 64 * 1024
+NONCE_SIZE = 16
+TAG_SIZE = 16
+HEADER_FORMAT = ">4sBI"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+CODEC_FORMAT = ">BB"
+CODEC_SIZE = struct.calcsize(CODEC_FORMAT)
+LENGTH_FORMAT = ">Q"
+LENGTH_SIZE = struct.calcsize(LENGTH_FORMAT)
+NO_LENGTH = 2 ** 64 - 1  # version 5 streams written to destinations that cannot seek
+SUITE_FORMAT = ">B"
+SUITE_SIZE = struct.calcsize(SUITE_FORMAT)
+DIGEST_SIZE = 16
+BLOCK_ENTRY_SIZE = TAG_SIZE + DIGEST_SIZE
+MAP_MAC_SIZE = 32
+
+# Codec and level for new streams; data that fails the compressibility sniff
+# is stored uncompressed regardless. Files written seekably are left raw by
+# default: a compressed chunk stream would make every range read decode from
+# the start and every update rewrite the whole file (see encrypt_stream).
+COMPRESSION = ("zlib", 6)
+
+# Every directory that holds per-user encrypted data, as <root>/<username>/...
+# Key rotation must rewrap all of it before old keys are retired.
+USER_DATA_ROOTS = ("secure_files", "chunk_store", "search_index")
+
+# aad: fixed header bytes authenticated with every chunk
+# data_offset: where the first chunk starts
+# key_header: wrapped data key, or None when the file uses the master key directly
+# key_header_offset: where the wrapped data key starts, for in-place rewrapping
+# codec: compression codec id of the chunk stream (compression.NONE if raw)
+# stream_length: bytes in the chunk stream (version 4+), or None if the file has no block map
+# length_offset: where stream_length is stored, for in-place updates
+# suite: cipher suite of the chunks (cipher_suites.EAX before version 5)
+Layout = namedtuple("Layout", ["aad", "chunk_size", "data_offset", "key_header",
+                               "key_header_offset", "codec", "stream_length", "length_offset",
+                               "suite"])
 
 def load_key():
-    generate_key()  # Ensure key exists before loading
-    with open(KEY_FILE, "rb") as f:
-        return f.read()
+    """Return the master key (read from disk once per process)."""
+    return key_manager.master_key()
 
 
-generate_key()
+def _read_exact(f, size):
+    """Read up to size bytes, looping over short reads from pipes and sockets."""
+    buf = bytearray()
+    while len(buf) < size:
+        data = f.read(size - len(buf))
+        if not data:
+            break
+        buf += data
+    return bytes(buf)
 
+def _chunk_aad(header, index, final):
+    """Associated data binding a chunk to its header, position and final flag."""
+    return header + struct.pack(">QB", index, 1 if final else 0)
 
-def encrypt_file(file_path):
-    """Encrypt a file using AES encryption."""
-    key = load_key()
-    cipher = AES.new(key, AES.MODE_EAX)
+def _block_keys(key):
+    """Derive the (digest key, map MAC key) of a version 4 file from its data key."""
+    return (hashlib.blake2b(b"block-digest", key=key).digest(),
+            hashlib.blake2b(b"block-map", key=key).digest())
 
-    with open(file_path, "rb") as f:
-        plaintext = f.read()
+def _block_digest(digest_key, chunk):
+    return hashlib.blake2b(chunk, key=digest_key, digest_size=DIGEST_SIZE).digest()
 
-    ciphertext, tag = cipher.encrypt_and_digest(plaintext)
+def _map_mac(mac_key, aad, stream_length, entries):
+    mac = hashlib.blake2b(key=mac_key, digest_size=MAP_MAC_SIZE)
+    mac.update(aad)
+    mac.update(struct.pack(LENGTH_FORMAT, stream_length))
+    mac.update(entries)
+    return mac.digest()
 
-    with open(file_path + ".enc", "wb") as f:
-        f.write(cipher.nonce + tag + ciphertext)
+def _block_count(layout):
+    """Number of chunks in a version 4 file, including the (possibly empty) final one."""
+    return layout.stream_length // layout.chunk_size + 1
 
-    os.remove(file_path)  # Remove the original file
-    print(f"🔒 File '{file_path}' encrypted successfully.")
+def _trailer_offset(layout, stream_length=None):
+    """Where the block map starts, for the file's stream length or the given one."""
+    if stream_length is None:
+        stream_length = layout.stream_length
+    blocks = stream_length // layout.chunk_size + 1
+    return layout.data_offset + stream_length + blocks * (NONCE_SIZE + TAG_SIZE)
 
-def decrypt_file(file_path):
-    """Decrypt a file encrypted with AES."""
-    key = load_key()
+def _verify_block_map(layout, key, trailer, tags=None):
+    """Check a version 4 trailer (and, if given, the tags actually read); returns the map entries."""
+    entries, mac = trailer[:-MAP_MAC_SIZE], trailer[-MAP_MAC_SIZE:]
+    expected = _map_mac(_block_keys(key)[1], layout.aad, layout.stream_length, entries)
+    if (len(trailer) != _block_count(layout) * BLOCK_ENTRY_SIZE + MAP_MAC_SIZE
+            or not hmac.compare_digest(mac, expected)):
+        raise ValueError("Encrypted file's block map failed verification.")
+    if tags is not None and tags != b"".join(entries[i:i + TAG_SIZE]
+                                             for i in range(0, len(entries), BLOCK_ENTRY_SIZE)):
+        raise ValueError("Encrypted file's chunks do not match its block map.")
+    return entries
+
+def _load_block_map(f, layout, key):
+    """Read and verify the block map of an open version 4 file."""
+    f.seek(_trailer_offset(layout))
+    trailer = _read_exact(f, _block_count(layout) * BLOCK_ENTRY_SIZE + MAP_MAC_SIZE)
+    return _verify_block_map(layout, key, trailer)
+
+def _seekable(f):
+    return getattr(f, "seekable", lambda: False)()
+
+def _resolve_compression(compress, sample):
+    """Return (codec id, level) for a new file given the first chunk of its data."""
+    if compress is False:
+        return compression.NONE, 0
+    name, level = COMPRESSION if compress in (None, True) else compress
+    codec = compression.codec_id(name)
+    if codec == compression.NONE or not compression.should_compress(sample):
+        return compression.NONE, 0
+    return codec, level
+
+@metrics.instrument("security.encrypt_stream", counts="out")
+def encrypt_stream(src, dst, key=None, chunk_size=CHUNK_SIZE, owner=None, compress=None, suite=None):
+    """Encrypt a readable binary stream into dst using the chunked format.
+
+    With an owner, the file gets a fresh data key wrapped by that user's key;
+    otherwise it is encrypted directly under key (the master key by default).
+    compress is True for COMPRESSION, False to store raw, or a (codec name,
+    level) pair; either way the first chunk is sniffed first. The default,
+    None, compresses only when dst cannot seek: a seekable dst gets a block
+    map, which serves range reads and in-place updates only while chunk
+    offsets are plaintext offsets. Callers that always read whole files
+    (packs, dedup chunks, index segments) pass True.
+    Memory use is bounded by chunk_size regardless of the stream length.
+    Chunks use suite (default: cipher_suites.active_suite()). A seekable
+    dst gets a block map written at the end and the stream length filled in
+    last. Returns the number of plaintext bytes encrypted.
+    """
+    if owner is not None:
+        with metrics.span("security.wrap_key"):
+            key, key_header = key_manager.new_data_key(owner)
+    else:
+        key_header = b""
+        if key is None:
+            key = load_key()
+
+    block_map = _seekable(dst)
+    if compress is None and block_map:
+        compress = False
+    first = _read_exact(src, chunk_size)
+    codec, level = _resolve_compression(compress, first)
+    if suite is None:
+        suite = cipher_suites.active_suite()
+    header = (struct.pack(HEADER_FORMAT, MAGIC, FORMAT_VERSION, chunk_size)
+              + struct.pack(CODEC_FORMAT, codec, level) + struct.pack(SUITE_FORMAT, suite))
+    dst.write(header)
+    if block_map:
+        length_offset = dst.tell()
+        digest_key, mac_key = _block_keys(key)
+        entries = bytearray()
+        dst.write(struct.pack(LENGTH_FORMAT, 0))  # Filled in once the length is known
+    else:
+        dst.write(struct.pack(LENGTH_FORMAT, NO_LENGTH))
+    dst.write(struct.pack(">H", len(key_header)) + key_header)
+
+    if codec != compression.NONE:
+        stats = {"in": 0}
+        rest = iter(lambda: src.read(chunk_size), b"")
+        source = IterReader(compression.iter_compress(chain([first], rest), codec, level, stats))
+        chunk = _read_exact(source, chunk_size)
+    else:
+        source = src
+        chunk = first
+
+    stream_length = 0
+    index = 0
+    while True:
+        # A full chunk is only final if nothing follows it, in which case an
+        # empty final chunk is written after it instead.
+        final = len(chunk) < chunk_size
+        cipher, nonce = cipher_suites.new_cipher(suite, key)
+        cipher.update(_chunk_aad(header, index, final))
+        ciphertext, tag = cipher.encrypt_and_digest(chunk)
+        dst.write(nonce + tag + ciphertext)
+        stream_length += len(chunk)
+        if block_map:
+            entries += tag + _block_digest(digest_key, chunk)
+        if final:
+            if block_map:
+                dst.write(bytes(entries) + _map_mac(mac_key, header, stream_length, entries))
+                end = dst.tell()
+                dst.seek(length_offset)
+                dst.write(struct.pack(LENGTH_FORMAT, stream_length))
+                dst.seek(end)
+            return stats["in"] if codec != compression.NONE else stream_length
+        index += 1
+        chunk = _read_exact(source, chunk_size)
+
+def _read_header(src):
+    """Read a container header from the current position.
+
+    Returns (raw prefix, Layout), with Layout None for the legacy layout.
+    """
+    prefix = _read_exact(src, HEADER_SIZE)
+    if len(prefix) < HEADER_SIZE or prefix[:len(MAGIC)] != MAGIC:
+        return prefix, None
+
+    _, version, chunk_size = struct.unpack(HEADER_FORMAT, prefix)
+    if version not in SUPPORTED_VERSIONS:
+        raise ValueError(f"Unsupported encrypted file version: {version}")
+    if version == 1:
+        return prefix, Layout(prefix, chunk_size, HEADER_SIZE, None, None, compression.NONE, None, None,
+                              cipher_suites.EAX)
+
+    aad = prefix
+    codec = compression.NONE
+    if version >= 3:
+        codec_bytes = _read_exact(src, CODEC_SIZE)
+        codec = struct.unpack(CODEC_FORMAT, codec_bytes)[0]
+        aad += codec_bytes
+    suite = cipher_suites.EAX
+    if version >= 5:
+        suite_bytes = _read_exact(src, SUITE_SIZE)
+        (suite,) = struct.unpack(SUITE_FORMAT, suite_bytes)
+        aad += suite_bytes
+    stream_length = length_offset = None
+    if version >= 4:
+        length_offset = len(aad)
+        (stream_length,) = struct.unpack(LENGTH_FORMAT, _read_exact(src, LENGTH_SIZE))
+        if stream_length == NO_LENGTH:
+            stream_length = length_offset = None
+    key_header_offset = len(aad) + (LENGTH_SIZE if version >= 4 else 0) + 2
+    (key_header_len,) = struct.unpack(">H", _read_exact(src, 2))
+    key_header = _read_exact(src, key_header_len) or None
+    return prefix, Layout(aad, chunk_size, key_header_offset + key_header_len, key_header,
+                          key_header_offset, codec, stream_length, length_offset, suite)
 
-    with open(file_path, "rb") as f:
-        nonce = f.read(16)
-        tag = f.read(16)
-        ciphertext = f.read()
+def _layout_key(layout, key, owner=None):
+    """Return the key that decrypts a file's chunks, checking it is wrapped for owner if given."""
+    if layout.key_header is not None:
+        with metrics.span("security.unwrap_key"):
+            return key_manager.unwrap_data_key(layout.key_header, owner)
+    return key if key is not None else load_key()
 
+def _iter_legacy(src, key, prefix):
+    """Decrypt the original nonce | tag | ciphertext layout, verifying at the end.
+
+    The single tag covers the whole file, so the last next() raises ValueError
+    on tampering after the earlier pieces were already yielded.
+    """
+    head = prefix + _read_exact(src, NONCE_SIZE + TAG_SIZE - len(prefix))
+    if len(head) < NONCE_SIZE + TAG_SIZE:
+        raise ValueError("Encrypted file is truncated.")
+    nonce, tag = head[:NONCE_SIZE], head[NONCE_SIZE:]
     cipher = AES.new(key, AES.MODE_EAX, nonce=nonce)
-    plaintext = cipher.decrypt_and_verify(ciphertext, tag)
 
+    while True:
+        data = src.read(CHUNK_SIZE)
+        if not data:
+            break
+        yield cipher.decrypt(data)
+    cipher.verify(tag)
+
+def _iter_chunks(src, layout, key):
+    """Yield the verified contents of each chunk following the header.
+
+    With a block map, the final chunk is only yielded once the map verified.
+    """
+    chunk_size = layout.chunk_size
+    blocks = None if layout.stream_length is None else _block_count(layout)
+    tags = bytearray()
+    index = 0
+    while True:
+        if blocks is not None and index == blocks - 1:
+            expected = layout.stream_length % chunk_size
+        else:
+            expected = chunk_size
+        record = _read_exact(src, NONCE_SIZE + TAG_SIZE + expected)
+        if len(record) < NONCE_SIZE + TAG_SIZE + (expected if blocks is not None else 0):
+            raise ValueError("Encrypted file is truncated.")
+        nonce = record[:NONCE_SIZE]
+        tag = record[NONCE_SIZE:NONCE_SIZE + TAG_SIZE]
+        ciphertext = record[NONCE_SIZE + TAG_SIZE:]
+        final = len(ciphertext) < chunk_size if blocks is None else index == blocks - 1
+
+        cipher = cipher_suites.new_cipher(layout.suite, key, nonce)[0]
+        cipher.update(_chunk_aad(layout.aad, index, final))
+        chunk = cipher.decrypt_and_verify(ciphertext, tag)
+        if blocks is not None:
+            tags += tag
+            if final:
+                trailer = _read_exact(src, blocks * BLOCK_ENTRY_SIZE + MAP_MAC_SIZE)
+                _verify_block_map(layout, key, trailer, tags)
+        yield chunk
+        if final:
+            return
+        index += 1
+
+def iter_decrypt(src, key=None, owner=None):
+    """Yield the verified plaintext of an encrypted stream one piece at a time.
+
+    key is only used for files that are not wrapped for an owner. With an
+    owner, files wrapped for another user are refused (see key_manager).
+    Compressed files are decompressed transparently.
+    Raises ValueError if the data was tampered with or truncated.
+    """
+    prefix, layout = _read_header(src)
+    if layout is None:
+        yield from _iter_legacy(src, key if key is not None else load_key(), prefix)
+        return
+
+    chunks = _iter_chunks(src, layout, _layout_key(layout, key, owner))
+    if layout.codec != compression.NONE:
+        chunks = compression.iter_decompress(chunks, layout.codec)
+    yield from chunks
+
+@metrics.instrument("security.decrypt_stream", counts="in")
+def decrypt_stream(src, dst, key=None, owner=None):
+    """Decrypt a stream written by encrypt_stream (or the legacy layout) into dst.
+
+    Returns the number of plaintext bytes written.
+    """
+    total = 0
+    for chunk in iter_decrypt(src, key, owner):
+        dst.write(chunk)
+        total += len(chunk)
+    return total
+
+class IterReader:
+    """Minimal read()-able file object over an iterator of byte chunks."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b""
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+@metrics.instrument("security.encrypt_file")
+def encrypt_file(file_path, owner=None):
+    """Encrypt a file using AES encryption."""
+    with _owner_lock(owner), open(file_path, "rb") as src:
+        durable.atomic_write(file_path + ".enc", lambda dst: encrypt_stream(src, dst, owner=owner))
+
+    os.remove(file_path)  # Remove the original only once the .enc is safely on disk
+    print(f"🔒 File '{file_path}' encrypted successfully.")
+
+@metrics.instrument("security.decrypt_file")
+def decrypt_file(file_path):
+    """Decrypt a file encrypted with AES."""
     original_path = file_path.replace(".enc", "")
-    with open(original_path, "wb") as f:
-        f.write(plaintext)
+    # A failed authentication discards the temp file, so no unverified plaintext is left behind
+    with open(file_path, "rb") as src:
+        durable.atomic_write(original_path, lambda dst: decrypt_stream(src, dst))
 
     os.remove(file_path)  # Remove the encrypted file
     print(f"🔓 File '{original_path}' decrypted successfully.")
 
+def _read_layout(f):
+    """Return the Layout of an open encrypted file, or None for the legacy layout."""
+    f.seek(0)
+    return _read_header(f)[1]
+
+def _chunk_count(f, layout):
+    """Return (number of full chunks, length of the final chunk) from the file size."""
+    if layout.stream_length is not None:
+        return divmod(layout.stream_length, layout.chunk_size)
+    record_size = NONCE_SIZE + TAG_SIZE + layout.chunk_size
+    body = os.fstat(f.fileno()).st_size - layout.data_offset
+    full, last = divmod(body, record_size)
+    if last < NONCE_SIZE + TAG_SIZE:
+        raise ValueError("Encrypted file is truncated.")
+    return full, last - NONCE_SIZE - TAG_SIZE
+
+def _decrypt_chunk(f, key, layout, index, final, entries=None):
+    """Decrypt and verify a single chunk by index, and against the block map entries if given."""
+    record_size = NONCE_SIZE + TAG_SIZE + layout.chunk_size
+    f.seek(layout.data_offset + index * record_size)
+    record = _read_exact(f, record_size)
+    if final and layout.stream_length is not None:
+        record = record[:NONCE_SIZE + TAG_SIZE + layout.stream_length % layout.chunk_size]
+    nonce = record[:NONCE_SIZE]
+    tag = record[NONCE_SIZE:NONCE_SIZE + TAG_SIZE]
+    if entries is not None and tag != entries[index * BLOCK_ENTRY_SIZE:index * BLOCK_ENTRY_SIZE + TAG_SIZE]:
+        raise ValueError("Encrypted file's chunks do not match its block map.")
+    cipher = cipher_suites.new_cipher(layout.suite, key, nonce)[0]
+    cipher.update(_chunk_aad(layout.aad, index, final))
+    return cipher.decrypt_and_verify(record[NONCE_SIZE + TAG_SIZE:], tag)
+
+def file_format_version(enc_path):
+    """Return the container version of an encrypted file (0 for the legacy layout)."""
+    with open(enc_path, "rb") as f:
+        prefix = _read_exact(f, HEADER_SIZE)
+    if len(prefix) < HEADER_SIZE or prefix[:len(MAGIC)] != MAGIC:
+        return 0
+    return struct.unpack(HEADER_FORMAT, prefix)[1]
+
+def stream_size(size, chunk_size=CHUNK_SIZE):
+    """Bytes encrypt_stream writes for size bytes, uncompressed and without an owner, to a non-seekable dst.
+
+    Lets a caller declare the length up front, e.g. in an archive header.
+    """
+    header = HEADER_SIZE + CODEC_SIZE + SUITE_SIZE + LENGTH_SIZE + 2
+    return header + (size // chunk_size + 1) * (NONCE_SIZE + TAG_SIZE) + size
+
+@metrics.instrument("security.plaintext_size")
+def plaintext_size(enc_path):
+    """Return the plaintext length of an encrypted file.
+
+    Uncompressed chunked files are sized from their length alone; compressed
+    ones have to be decoded.
+    """
+    with open(enc_path, "rb") as f:
+        layout = _read_layout(f)
+        if layout is None:
+            return os.fstat(f.fileno()).st_size - NONCE_SIZE - TAG_SIZE
+        if layout.codec != compression.NONE:
+            f.seek(0)
+            return sum(len(piece) for piece in iter_decrypt(f))
+        if layout.stream_length is not None:
+            return layout.stream_length
+        full, last_len = _chunk_count(f, layout)
+        return full * layout.chunk_size + last_len
+
+@metrics.instrument("security.read_into", counts="in")
+def read_into(enc_path, buffer, offset=0, key=None, owner=None):
+    """Decrypt plaintext starting at offset directly into a writable buffer.
+
+    Only the chunks overlapping [offset, offset + len(buffer)) are read and
+    decrypted. Compressed files are decoded from the start up to the end of
+    the range instead. Returns the number of bytes written, which is less
+    than len(buffer) when the range runs past the end of the file.
+    """
+    out = memoryview(buffer).cast("B")
+
+    with open(enc_path, "rb") as f:
+        layout = _read_layout(f)
+        if layout is None:
+            # The legacy layout has a single tag over the whole file, so the
+            # only way to authenticate a range is to decrypt everything.
+            f.seek(0)
+            plain = io.BytesIO()
+            decrypt_stream(f, plain, key, owner)
+            data = plain.getbuffer()[offset:offset + len(out)]
+            out[:len(data)] = data
+            return len(data)
+
+        if layout.codec != compression.NONE:
+            f.seek(0)
+            return _read_into_sequential(iter_decrypt(f, key, owner), out, offset)
+
+        key = _layout_key(layout, key, owner)
+        chunk_size = layout.chunk_size
+        full, last_len = _chunk_count(f, layout)
+        size = full * chunk_size + last_len
+        end = min(offset + len(out), size)
+        if offset >= end:
+            return 0
+
+        entries = _load_block_map(f, layout, key) if layout.stream_length is not None else None
+        written = 0
+        for index in range(offset // chunk_size, (end - 1) // chunk_size + 1):
+            chunk = _decrypt_chunk(f, key, layout, index, index == full, entries)
+            chunk_start = index * chunk_size
+            lo = max(offset, chunk_start) - chunk_start
+            hi = min(end, chunk_start + len(chunk)) - chunk_start
+            out[written:written + hi - lo] = chunk[lo:hi]
+            written += hi - lo
+        return written
+
+def _read_into_sequential(pieces, out, offset):
+    """Copy [offset, offset + len(out)) of a plaintext stream into out."""
+    position = 0
+    written = 0
+    for piece in pieces:
+        lo = max(offset - position, 0)
+        position += len(piece)
+        if lo >= len(piece):
+            continue
+        take = min(len(piece) - lo, len(out) - written)
+        out[written:written + take] = piece[lo:lo + take]
+        written += take
+        if written == len(out):
+            break
+    return written
+
+@metrics.instrument("security.read_range", counts="in")
+def read_range(enc_path, offset=0, size=None, key=None, owner=None):
+    """Decrypt and return a byte range of an encrypted file (to the end if size is None).
+
+    Holds the file lock shared, so an edit being patched in is never half seen.
+    """
+    with _file_lock(enc_path, shared=True):
+        if size is None:
+            with open(enc_path, "rb") as f:
+                layout = _read_layout(f)
+                if layout is None or layout.codec != compression.NONE:
+                    # Sizing these means decoding them, so decode once and keep the tail
+                    f.seek(0)
+                    out = bytearray()
+                    position = 0
+                    for piece in iter_decrypt(f, key, owner):
+                        out += piece[max(offset - position, 0):]
+                        position += len(piece)
+                    return bytes(out)
+            size = max(plaintext_size(enc_path) - offset, 0)
+        buffer = bytearray(size)
+        written = read_into(enc_path, buffer, offset, key, owner)
+        del buffer[written:]
+        return bytes(buffer)
+
+@metrics.instrument("security.read_encrypted", counts="in")
+def read_encrypted(enc_path, key=None, owner=None):
+    """Decrypt an encrypted file straight into memory, leaving the disk untouched.
+
+    Holds the file lock shared, like read_range.
+    """
+    plain = io.BytesIO()
+    with _file_lock(enc_path, shared=True), open(enc_path, "rb") as f:
+        decrypt_stream(f, plain, key, owner)
+    return plain.getvalue()
+
+@contextmanager
+def _owner_lock(owner):
+    """Hold owner's key rotation lock shared while a file under a new data key is written."""
+    if owner is None:
+        yield
+        return
+    with key_manager.user_key_lock(owner):
+        yield
+
+@contextmanager
+def _file_lock(enc_path, shared=False):
+    """Hold an exclusive flock on enc_path while it is read and rewritten or patched.
+
+    Serializes write_at, update_blocks, upgrade_file and write_encrypted on
+    the same file, across threads and processes, so a re-encryption cannot
+    put back content that an edit replaced meanwhile. The lock belongs to the
+    inode and atomic_write swaps in a new one, so the lock is taken again if
+    the file was replaced while waiting. A file that does not exist yet is
+    not locked. Readers take it shared, so they never see a patch half done.
+    """
+    while True:
+        try:
+            f = open(enc_path, "rb")
+        except FileNotFoundError:
+            yield
+            return
+        with f:
+            if fcntl is None:
+                yield
+                return
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                current = os.stat(enc_path).st_ino == os.fstat(f.fileno()).st_ino
+            except FileNotFoundError:
+                current = False
+            if current:
+                yield
+                return
+
+@metrics.instrument("security.write_encrypted", counts="out")
+def write_encrypted(enc_path, data, key=None, owner=None, compress=None, atomic=True):
+    """Encrypt bytes from memory straight into enc_path, with no plaintext on disk.
+
+    The file is replaced atomically and durably (see durable) unless atomic
+    is False, for callers that write to a temp file of their own.
+    """
+    if not atomic:
+        with open(enc_path, "wb") as f:
+            return encrypt_stream(io.BytesIO(data), f, key, owner=owner, compress=compress)
+    with _owner_lock(owner if key is None else None), _file_lock(enc_path):
+        return durable.atomic_write(
+            enc_path, lambda f: encrypt_stream(io.BytesIO(data), f, key, owner=owner, compress=compress))
+
+def _open_blocks(f, key, owner=None):
+    """Return (layout, data key, block map) of an open file whose chunks can be updated in place, else None."""
+    layout = _read_layout(f)
+    if layout is None or layout.stream_length is None or layout.codec != compression.NONE:
+        return None
+    key = _layout_key(layout, key, owner)
+    return layout, key, _load_block_map(f, layout, key)
+
+def _commit_blocks(enc_path, layout, key, entries, blocks, length):
+    """Encrypt {index: plaintext} blocks with fresh nonces and patch them into enc_path.
+
+    The stream length and the block map (with a new MAC) are patched in the
+    same durable.patch_file call, so the file is only ever seen complete.
+    """
+    chunk_size = layout.chunk_size
+    record_size = NONCE_SIZE + TAG_SIZE + chunk_size
+    count = length // chunk_size + 1
+    digest_key, mac_key = _block_keys(key)
+    # Blocks past the old end must all be in blocks; their placeholders get overwritten
+    entries = bytearray(entries[:count * BLOCK_ENTRY_SIZE])
+    entries += bytes(count * BLOCK_ENTRY_SIZE - len(entries))
+
+    edits = []
+    for index in sorted(blocks):
+        chunk = blocks[index]
+        cipher, nonce = cipher_suites.new_cipher(layout.suite, key)
+        cipher.update(_chunk_aad(layout.aad, index, index == count - 1))
+        ciphertext, tag = cipher.encrypt_and_digest(chunk)
+        edits.append((layout.data_offset + index * record_size, nonce + tag + ciphertext))
+        entries[index * BLOCK_ENTRY_SIZE:(index + 1) * BLOCK_ENTRY_SIZE] = tag + _block_digest(digest_key, chunk)
+
+    map_offset = _trailer_offset(layout, length)
+    edits.append((layout.length_offset, struct.pack(LENGTH_FORMAT, length)))
+    edits.append((map_offset, bytes(entries) + _map_mac(mac_key, layout.aad, length, entries)))
+    durable.patch_file(enc_path, edits, map_offset + len(entries) + MAP_MAC_SIZE)
+
+@metrics.instrument("security.write_at")
+def write_at(enc_path, offset, data, key=None, owner=None):
+    """Write data at a plaintext offset, re-encrypting only the chunks it touches.
+
+    offset None (or the current length) appends. Only uncompressed files
+    with a block map (version 4, or 5 written seekably) can be changed in
+    place: returns None for any other file, which the caller has to
+    rewrite, and the new plaintext length otherwise. The cost is that of len(data) plus at most two chunks, whatever the file size.
+    """
+    with _file_lock(enc_path):
+        with open(enc_path, "rb") as f:
+            opened = _open_blocks(f, key, owner)
+            if opened is None:
+                return None
+            layout, key, entries = opened
+            old_length = layout.stream_length
+            if offset is None:
+                offset = old_length
+            if not 0 <= offset <= old_length:
+                raise ValueError(f"Offset {offset} is outside the file ({old_length} bytes).")
+            if not data:
+                return old_length
+
+            chunk_size = layout.chunk_size
+            end = offset + len(data)
+            length = max(old_length, end)
+            # Growing the file also rewrites the old final chunk, which is no longer final
+            last = length // chunk_size if length > old_length else (end - 1) // chunk_size
+            blocks = {}
+            for index in range(offset // chunk_size, last + 1):
+                start = index * chunk_size
+                stop = min(start + chunk_size, length)
+                if offset <= start and stop <= end:
+                    blocks[index] = data[start - offset:stop - offset]
+                    continue
+                block = bytearray(stop - start)
+                if start < old_length:
+                    old = _decrypt_chunk(f, key, layout, index, index == old_length // chunk_size, entries)
+                    block[:len(old)] = old
+                lo, hi = max(offset, start), min(end, stop)
+                block[lo - start:hi - start] = data[lo - offset:hi - offset]
+                blocks[index] = bytes(block)
+
+        _commit_blocks(enc_path, layout, key, entries, blocks, length)
+        return length
+
+@metrics.instrument("security.update_blocks")
+def update_blocks(enc_path, data, key=None, owner=None):
+    """Replace a file's plaintext with data, re-encrypting only the chunks that changed.
+
+    Changed chunks are found by comparing keyed digests from the block map,
+    so nothing old is decrypted. Like write_at, returns None for files that
+    cannot be updated in place, and the new length otherwise.
+    """
+    with _file_lock(enc_path):
+        with open(enc_path, "rb") as f:
+            opened = _open_blocks(f, key, owner)
+        if opened is None:
+            return None
+        layout, key, entries = opened
+        chunk_size = layout.chunk_size
+        count = len(data) // chunk_size + 1
+        old_count = _block_count(layout)
+        digest_key = _block_keys(key)[0]
+
+        view = memoryview(data)
+        blocks = {}
+        for index in range(count):
+            chunk = view[index * chunk_size:(index + 1) * chunk_size]
+            moved_final = count != old_count and index in (count - 1, old_count - 1)
+            old_digest = entries[index * BLOCK_ENTRY_SIZE + TAG_SIZE:(index + 1) * BLOCK_ENTRY_SIZE]
+            if index >= old_count or moved_final or old_digest != _block_digest(digest_key, chunk):
+                blocks[index] = bytes(chunk)
+        if blocks or count != old_count:
+            _commit_blocks(enc_path, layout, key, entries, blocks, len(data))
+        return len(data)
+
+@metrics.instrument("security.rewrap_file")
+def rewrap_file(enc_path):
+    """Rewrap a file's data key under its owner's active key, rewriting only the header.
+
+    The header is patched in through durable, so it is on disk once this
+    returns. Returns False for files that are not wrapped for an owner.
+    """
+    with _file_lock(enc_path):
+        with open(enc_path, "rb") as f:
+            layout = _read_layout(f)
+        if layout is None or layout.key_header is None:
+            return False
+        new_header = key_manager.rewrap_key_header(layout.key_header)
+        durable.patch_file(enc_path, [(layout.key_header_offset, new_header)], None)
+    return True
+
+@metrics.instrument("security.upgrade_file")
+def upgrade_file(enc_path, owner, force=False):
+    """Re-encrypt a legacy or master-key file under a fresh data key for owner.
+
+    This is the one case that rewrites a file body; afterwards rotations only
+    touch its header. Returns False if the file already has a wrapped key,
+    unless force is set (e.g. to move it onto the current format).
+    """
+    with _owner_lock(owner), _file_lock(enc_path):
+        with open(enc_path, "rb") as src:
+            layout = _read_layout(src)
+            if not force and layout is not None and layout.key_header is not None:
+                return False
+            src.seek(0)
+            plain = IterReader(iter_decrypt(src, owner=owner))
+            durable.atomic_write(enc_path, lambda dst: encrypt_stream(plain, dst, owner=owner))
+        return True
+
+def _user_files(username, roots=USER_DATA_ROOTS):
+    """Yield the path of every stored file of a user under roots, skipping temp and lock files."""
+    for root in roots:
+        folder_path = os.path.join(root, username)
+        if not os.path.isdir(folder_path):
+            continue
+        for dirpath, _, names in os.walk(folder_path):
+            for name in sorted(names):
+                if not name.endswith(".tmp") and not name.startswith("."):
+                    yield os.path.join(dirpath, name)
+
+def _under_master_key(path):
+    """Whether a stored file is encrypted directly under the master key."""
+    with open(path, "rb") as f:
+        layout = _read_layout(f)
+    if layout is not None:
+        return layout.key_header is None
+    return path.endswith(".enc")  # The legacy layout has no header; anything else is plaintext
+
+@metrics.instrument("security.rotate_user_key")
+def rotate_user_key(username):
+    """Give a user a new key-encryption key and rewrap all of their files' data keys.
+
+    File bodies are not re-encrypted; each file costs one small header write.
+    New files for the user wait until the rotation is over, and the old KEK
+    is only retired once every rewrapped header is durable.
+    """
+    import pack_store  # Packs hold many containers each; pack_store itself builds on this module
+
+    with key_manager.user_key_lock(username, exclusive=True):
+        key_manager.add_user_key(username)
+        rewrapped = 0
+        for path in _user_files(username):
+            if rewrap_file(path):
+                rewrapped += 1
+        rewrapped += pack_store.rewrap(username)
+        key_manager.retire_user_keys(username)
+    print(f"🔄 Key rotated for '{username}' ({rewrapped} file(s) rewrapped).")
+    return rewrapped
+
+@metrics.instrument("security.rotate_master_key")
+def rotate_master_key():
+    """Rotate the master key after moving every stored file onto a wrapped data key.
+
+    Files still encrypted directly under the master key (the legacy layout and
+    format version 1) are upgraded first, since they would otherwise become
+    unreadable.
+    """
+    for root in USER_DATA_ROOTS:
+        if not os.path.isdir(root):
+            continue
+        for username in os.listdir(root):
+            for path in _user_files(username, (root,)):
+                if _under_master_key(path):
+                    upgrade_file(path, username)
+    key_manager.rotate_master_key()
+
 def ensure_enc_extension(file_name):
     """Ensure the file has the .enc extension."""
     if not file_name.endswith(".enc"):
         file_name += ".enc"
     return file_name
 
+@metrics.instrument("security.encrypt_and_store")
 def encrypt_and_store(username, file_name):
     """Encrypt a file and store it securely."""
     folder_path = os.path.join("secure_files", username)
     file_path = os.path.join(folder_path, file_name)
 
     if os.path.exists(file_path):
-        encrypt_file(file_path)
+        encrypt_file(file_path, owner=username)
     else:
         print(f"❌ Error: '{file_name}' not found for user '{username}'.")
 
+@metrics.instrument("security.decrypt_and_read")
 def decrypt_and_read(username, file_name):
     """Decrypt a file and read its content."""
     folder_path = os.path.join("secure_files", username)
     enc_file_path = os.path.join(folder_path, ensure_enc_extension(file_name))
 
     if os.path.exists(enc_file_path):
-        decrypt_file(enc_file_path)
-        decrypted_path = enc_file_path.replace(".enc", "")
-
-        with open(decrypted_path, "r") as f:
-            content = f.read()
-            print(f"\n📖 Content of '{file_name}':\n{content}\n")
-
-        encrypt_file(decrypted_path)  # Re-encrypt after reading
+        content = read_encrypted(enc_file_path, owner=username).decode()
+        print(f"\n📖 Content of '{file_name}':\n{content}\n")
+        return content
     else:
         print(f"❌ Error: '{file_name}' not found.")
+        return None
 
 if __name__ == "__main__":
     print("🔐 Secure Encryption Module Loaded.")
\ No newline at end of file
@@ -0,0 +1,36 @@
+import os
+import sys
+from collections import OrderedDict
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import catalog
+import db
+import durable
+import key_manager
+import pack_store
+import passwords
+import rate_limit
+import search_index
+import user_store
+
+
+@pytest.fixture(autouse=True)
+def workspace(tmp_path, monkeypatch):
+    """Run each test in an empty directory with its own database, keys, journal and caches."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(db, "DB_NAME", str(tmp_path / "test.db"))
+    monkeypatch.setattr(durable, "_journal", None)
+    monkeypatch.setattr(key_manager, "_master_key", None)
+    monkeypatch.setattr(passwords, "_config", None)
+    for module, name in ((key_manager, "_master_keys"), (key_manager, "_kek_cache"),
+                         (key_manager, "_hmac_cache"), (search_index, "_indexes"),
+                         (pack_store, "_maps"), (catalog, "_reconciled"), (user_store, "_records"),
+                         (rate_limit, "_saved")):
+        monkeypatch.setattr(module, name, type(getattr(module, name))())
+    for limiter in rate_limit._limiters.values():
+        monkeypatch.setattr(limiter, "_buckets", OrderedDict())
+    return tmp_path
+
@@ -0,0 +1,79 @@
+import io
+import json
+import tarfile
+
+import pytest
+
+import archive
+import file_manager
+
+FILES = {"a.txt": "hello", "b.txt": "x" * 100000, "empty.txt": ""}
+
+
+def _export(fmt, passphrase=None):
+    for name, content in FILES.items():
+        file_manager.create_file("amy", name, content)
+    return b"".join(archive.export_stream("amy", fmt, passphrase))
+
+
+@pytest.mark.parametrize("fmt", archive.FORMATS)
+@pytest.mark.parametrize("passphrase", [None, "correct horse"])
+def test_export_import_round_trip(fmt, passphrase):
+    data = _export(fmt, passphrase)
+    records = list(archive.import_stream("bob", io.BytesIO(data), passphrase))
+
+    assert all(r["ok"] for r in records), records
+    assert sorted(r["name"] for r in records) == sorted(FILES)
+    for name, content in FILES.items():
+        assert file_manager.read_file("bob", name) == content
+
+
+def test_wrong_passphrase_is_refused():
+    data = _export("tar", "correct horse")
+    with pytest.raises(ValueError, match="Wrong passphrase"):
+        list(archive.import_stream("bob", io.BytesIO(data), "battery staple"))
+
+
+def test_foreign_kdf_parameters_are_refused():
+    header = json.dumps({"version": 1, "kdf": "scrypt", "params": {"ln": 30, "r": 8, "p": 1},
+                         "salt": "00", "check": ""}).encode()
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tf:
+        info = tarfile.TarInfo(archive.TRANSPORT_ENTRY)
+        info.size = len(header)
+        tf.addfile(info, io.BytesIO(header))
+    with pytest.raises(ValueError, match="unsupported"):
+        list(archive.import_stream("bob", io.BytesIO(buf.getvalue()), "anything"))
+
+
+def test_oversized_and_unsafe_entries_are_skipped(monkeypatch):
+    data = _export("tar")
+    monkeypatch.setattr(archive, "MAX_MEMBER_SIZE", 1000)
+    records = {r["name"]: r for r in archive.import_stream("bob", io.BytesIO(data))}
+    assert not records["b.txt"]["ok"]
+    assert records["a.txt"]["ok"]
+
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tf:
+        info = tarfile.TarInfo("../escape.txt")
+        tf.addfile(info, io.BytesIO(b""))
+    (record,) = archive.import_stream("bob", io.BytesIO(buf.getvalue()))
+    assert not record["ok"]
+
+
+def test_import_read_ahead_is_bounded_by_bytes(monkeypatch):
+    data = _export("tar")
+    read = []
+    members = archive._members
+
+    def counting(src):
+        for member in members(src):
+            read.append(member[0])
+            yield member
+
+    monkeypatch.setattr(archive, "_members", counting)
+    monkeypatch.setattr(archive, "IMPORT_BUFFER", 50000)
+    records = archive.import_stream("bob", io.BytesIO(data), workers=8)
+    next(records)
+    assert read == ["a.txt", "b.txt"]
+    assert all(r["ok"] for r in records)
@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+
+import file_manager
+from async_file_manager import AsyncFileManager
+
+CONTENT = "".join(f"line {i}\n" for i in range(20000))
+
+
+@pytest.mark.parametrize("backend", ["files", "dedup", "pack"])
+def test_read_range_in_every_backend(backend, monkeypatch):
+    monkeypatch.setattr(file_manager, "STORAGE_BACKEND", backend)
+    file_manager.create_file("amy", "notes.txt", CONTENT)
+
+    async def run():
+        async with AsyncFileManager() as manager:
+            return await asyncio.gather(manager.read_range("amy", "notes.txt", 1000, 500),
+                                        manager.read_range("amy", "notes.txt", 150000),
+                                        manager.read_range("amy", "notes.txt"))
+
+    middle, tail, whole = asyncio.run(run())
+    data = CONTENT.encode()
+    assert (middle, tail, whole) == (data[1000:1500], data[150000:], data)
+
+
+def test_read_range_of_a_missing_file():
+    async def run():
+        async with AsyncFileManager() as manager:
+            return await manager.read_range("amy", "missing.txt")
+
+    with pytest.raises(FileNotFoundError):
+        asyncio.run(run())
+
+
+def test_concurrent_writes_to_one_file_are_serialized():
+    file_manager.create_file("amy", "notes.txt", "start")
+    versions = [f"version {i} " * 1000 for i in range(20)]
+
+    async def run():
+        async with AsyncFileManager(max_workers=8) as manager:
+            await asyncio.gather(*(manager.update_file("amy", "notes.txt", v) for v in versions),
+                                 manager.create_file("bob", "notes.txt", "bob's own"))
+            return await manager.read_file("amy", "notes.txt"), await manager.read_file("bob", "notes.txt")
+
+    amy, bob = asyncio.run(run())
+    assert amy in versions
+    assert bob == "bob's own"
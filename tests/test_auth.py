@@ -0,0 +1,42 @@
+import time
+
+import auth
+import user_store
+
+
+def test_tokens_work_only_where_they_were_issued_for():
+    user_store.create_user("amy", None, "user", None)
+    cli_token = auth.issue_token("amy")
+    session_token = auth.start_session("amy")
+
+    assert auth.verify_token(cli_token) == "amy"
+    assert auth.resolve_session(session_token).username == "amy"
+    assert auth.verify_token(session_token) is None
+    assert auth.resolve_session(cli_token) is None
+    assert auth.verify_token(cli_token[:-2] + "xx") is None
+
+
+def test_ending_sessions_voids_every_earlier_token():
+    user_store.create_user("amy", None, "user", None)
+    cli_token, session_token = auth.issue_token("amy"), auth.start_session("amy")
+    time.sleep(0.01)
+    auth.end_user_sessions("amy")
+    user_store.invalidate()  # As another process would see it, once its cache expires
+
+    assert auth.verify_token(cli_token) is None
+    assert auth.resolve_session(session_token) is None
+    assert auth.verify_token(auth.issue_token("amy")) == "amy"
+    assert auth.resolve_session(auth.start_session("amy")) is not None
+
+
+def test_sessions_follow_role_changes_and_single_logouts():
+    user_store.create_user("amy", None, "user", None)
+    first, second = auth.start_session("amy"), auth.start_session("amy")
+    assert auth.resolve_session(first).role == "user"
+
+    assert auth.set_user_role("amy", "admin")
+    assert auth.resolve_session(first).role == "admin"
+
+    auth.end_session(first)
+    assert auth.resolve_session(first) is None
+    assert auth.resolve_session(second) is not None
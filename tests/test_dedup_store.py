@@ -0,0 +1,31 @@
+import os
+import random
+
+import pytest
+
+import dedup_store
+
+
+def _data():
+    rng = random.Random(7)
+    block = bytes(rng.randrange(256) for _ in range(40000))
+    return block * 3 + bytes(rng.randrange(4) for _ in range(100000)) + b"\0" * 70000
+
+
+def test_put_get_and_dedup():
+    data = _data()
+    dedup_store.put("amy", "a.bin", data)
+    _, written = dedup_store.put("amy", "b.bin", data)
+    assert written == 0
+    assert dedup_store.get("amy", "b.bin") == data
+    leftovers = [n for _, _, names in os.walk(dedup_store.CHUNK_ROOT) for n in names if n.endswith(".tmp")]
+    assert leftovers == []
+
+
+def test_vectorized_boundaries_match_the_python_loop(monkeypatch):
+    pytest.importorskip("numpy")
+    data = _data() + os.urandom(300000)
+    monkeypatch.setattr(dedup_store, "HASH_BLOCK", 65536)  # Several blocks, so their seams are covered
+    vectorized = list(dedup_store.chunk_boundaries(data))
+    monkeypatch.setattr(dedup_store, "numpy", None)
+    assert vectorized == list(dedup_store.chunk_boundaries(data))
@@ -0,0 +1,55 @@
+import json
+import os
+
+import durable
+
+
+def _pending(path, data):
+    tmp = durable.temp_path(path)
+    with open(tmp, "wb") as f:
+        f.write(data)
+    return durable._PendingWrite(tmp, path)
+
+
+def test_one_failed_rename_does_not_fail_its_batch():
+    os.makedirs("secure_files/amy/taken")
+    batch = [_pending("secure_files/amy/a.enc", b"a"), _pending("secure_files/amy/taken", b"x"),
+             _pending("secure_files/amy/b.enc", b"b")]
+    durable._get_committer()._commit(batch)
+
+    assert [w.error is None for w in batch] == [True, False, True]
+    with open("secure_files/amy/a.enc", "rb") as f:
+        assert f.read() == b"a"
+    with open("secure_files/amy/b.enc", "rb") as f:
+        assert f.read() == b"b"
+
+
+def _dead_intent(path, data, patch=False):
+    """Leave an open intent in the journal of a process that died, as a crash would."""
+    tmp = f"{path}.999999999.0{durable.TMP_SUFFIX}"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.makedirs(durable.JOURNAL_DIR, exist_ok=True)
+    with open(os.path.join(durable.JOURNAL_DIR, "999999999.log"), "w") as f:
+        f.write(json.dumps({"i": 0, "tmp": tmp, "path": path, "before": durable._state(path)}) + "\n")
+    return tmp
+
+
+def test_recover_rolls_forward_an_untouched_target():
+    os.makedirs("secure_files")
+    durable.write_bytes("secure_files/a.enc", b"old")
+    _dead_intent("secure_files/a.enc", b"new")
+    assert durable.recover() == (1, 0)
+    with open("secure_files/a.enc", "rb") as f:
+        assert f.read() == b"new"
+
+
+def test_recover_keeps_a_target_rewritten_since():
+    os.makedirs("secure_files")
+    durable.write_bytes("secure_files/a.enc", b"old")
+    tmp = _dead_intent("secure_files/a.enc", b"dead process")
+    durable.write_bytes("secure_files/a.enc", b"live process")
+    assert durable.recover() == (0, 1)
+    assert not os.path.exists(tmp)
+    with open("secure_files/a.enc", "rb") as f:
+        assert f.read() == b"live process"
@@ -0,0 +1,39 @@
+import os
+import threading
+
+import file_manager
+import security
+
+
+def test_readers_never_see_an_edit_half_patched():
+    file_manager.create_file("amy", "a.txt", "0" * 200000)
+    file_manager.edit_file("amy", "a.txt", "1", 0)  # Now stored uncompressed, so edits patch in place
+    path = file_manager.stored_path("amy", "a.txt")
+    stop = threading.Event()
+    errors = []
+
+    def read():
+        while not stop.is_set():
+            try:
+                security.read_range(path, 100000, 10, owner="amy")
+                security.read_encrypted(path, owner="amy")
+            except ValueError as e:
+                errors.append(e)
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    try:
+        for i in range(50):
+            file_manager.edit_file("amy", "a.txt", str(i % 10) * 10, 100000)
+    finally:
+        stop.set()
+        reader.join()
+    assert errors == []
+
+
+def test_editing_a_legacy_file_that_is_not_utf8():
+    os.makedirs("secure_files/amy")
+    with open("secure_files/amy/old.txt", "wb") as f:
+        f.write(b"caf\xe9 au lait")
+    file_manager.edit_file("amy", "old.txt", "!", 4)
+    assert file_manager.read_range("amy", "old.txt") == b"caf\xe9!au lait"
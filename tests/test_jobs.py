@@ -0,0 +1,76 @@
+import os
+
+import file_manager
+import jobs
+
+
+def test_job_resumes_from_its_checkpoint(monkeypatch):
+    for i in range(6):
+        file_manager.create_file("amy", f"f{i}.txt", f"content {i}")
+    job_id = jobs.submit("verify", ["amy"])
+    monkeypatch.setattr(jobs, "CHECKPOINT_INTERVAL", 0)  # Save after every item
+
+    handled = []
+    list_items, verify = jobs.KINDS["verify"]
+
+    def pausing_verify(item, params):
+        handled.append(item[1])
+        if len(handled) == 2:
+            jobs.pause(job_id)
+        return verify(item, params)
+
+    monkeypatch.setitem(jobs.KINDS, "verify", (list_items, pausing_verify))
+    jobs.work("test-worker", jobs.Throttle(), until_idle=True)
+    job = jobs.list_jobs()[0]
+    assert (job["state"], job["done"]) == ("paused", 2)
+
+    assert jobs.resume(job_id)
+    jobs.work("test-worker", jobs.Throttle(), until_idle=True)
+    job = jobs.list_jobs()[0]
+    assert (job["state"], job["done"], job["total"]) == ("done", 6, 6)
+    assert job["result"]["counts"] == {"verified": 6}
+    assert sorted(handled) == [f"f{i}.txt" for i in range(6)]  # None redone, none skipped
+
+
+def test_reencrypt_moves_files_to_fresh_keys():
+    file_manager.create_file("amy", "a.txt", "hello")
+    path = file_manager.stored_path("amy", "a.txt")
+    with open(path, "rb") as f:
+        before = f.read()
+    jobs.submit("reencrypt", ["amy"], force=True)
+    jobs.work("test-worker", jobs.Throttle(), until_idle=True)
+
+    job = jobs.list_jobs()[0]
+    assert job["result"]["counts"] == {"reencrypted": 1}
+    with open(path, "rb") as f:
+        assert f.read() != before
+    assert file_manager.read_file("amy", "a.txt") == "hello"
+
+
+def test_pace_keeps_a_long_sleep_alive(monkeypatch):
+    monkeypatch.setattr(jobs, "HEARTBEAT_INTERVAL", 0.01)
+    monkeypatch.setattr(jobs, "IO_RATE", 1000)
+    beats = []
+
+    def heartbeat():
+        beats.append(1)
+        return len(beats) < 3  # The job is paused after the third
+
+    jobs.Throttle().pace(1000, 0, 0, heartbeat)  # A second's worth of I/O
+    assert len(beats) == 3
+
+
+def test_clean_removes_only_plaintext_matching_its_encrypted_copy():
+    file_manager.create_file("amy", "same.txt", "kept encrypted")
+    file_manager.create_file("amy", "other.txt", "encrypted version")
+    with open("secure_files/amy/same.txt", "w") as f:
+        f.write("kept encrypted")
+    with open("secure_files/amy/other.txt", "w") as f:
+        f.write("a different plaintext")
+    jobs.submit("clean", ["amy"])
+    jobs.work("test-worker", jobs.Throttle(), until_idle=True)
+
+    job = jobs.list_jobs()[0]
+    assert job["result"]["counts"] == {"removed": 1, "mismatch": 1}
+    assert not os.path.exists("secure_files/amy/same.txt")
+    assert os.path.exists("secure_files/amy/other.txt")
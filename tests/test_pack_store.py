@@ -0,0 +1,64 @@
+import os
+
+import db
+import pack_store
+
+
+def test_compact_then_read():
+    for i in range(20):
+        pack_store.put("amy", f"f{i}.txt", f"version 1 of {i}".encode() * 50)
+    for i in range(0, 20, 2):
+        pack_store.put("amy", f"f{i}.txt", f"version 2 of {i}".encode())
+    for i in range(1, 20, 4):
+        pack_store.delete("amy", f"f{i}.txt")
+    before = pack_store.stats("amy")
+
+    assert pack_store.compact("amy", full=True) > 0
+    after = pack_store.stats("amy")
+    assert after["pack_bytes"] < before["pack_bytes"]
+    assert after["files"] == before["files"]
+    for i in range(20):
+        name = f"f{i}.txt"
+        if i % 4 == 1:
+            assert not pack_store.contains("amy", name)
+        elif i % 2 == 0:
+            assert pack_store.get("amy", name) == f"version 2 of {i}".encode()
+        else:
+            assert pack_store.get("amy", name) == f"version 1 of {i}".encode() * 50
+
+    # Packs removed by compaction stay removed; new writes go to a new pack
+    pack_store.put("amy", "late.txt", b"after compaction")
+    assert pack_store.get("amy", "late.txt") == b"after compaction"
+    assert pack_store.rebuild_index("amy") == after["files"] + 1
+
+
+def test_rebuild_index_after_torn_append():
+    pack_store.put("amy", "a.txt", b"first")
+    pack_store.put("amy", "b.txt", b"second")
+    pack_store.put("amy", "a.txt", b"first, again")
+    path = pack_store.pack_path("amy", pack_store._packs("amy")[-1])
+    with open(path, "ab") as f:  # A crash halfway through appending a record
+        f.write(pack_store._record(pack_store.PUT, "c.txt", b"x" * 1000)[:40])
+    pack_store._forget_map(path)
+
+    assert pack_store.rebuild_index("amy") == 2
+    assert pack_store.get("amy", "a.txt") == b"first, again"
+    assert pack_store.get("amy", "b.txt") == b"second"
+    assert not pack_store.contains("amy", "c.txt")
+
+    # The next append lands after the torn bytes and is found by a rebuild
+    pack_store.put("amy", "c.txt", b"third")
+    assert pack_store.rebuild_index("amy") == 3
+    assert pack_store.get("amy", "c.txt") == b"third"
+
+
+def test_reused_pack_names_are_not_read_through_stale_maps():
+    pack_store.put("amy", "a.txt", b"first pack 000001")
+    assert pack_store.get("amy", "a.txt") == b"first pack 000001"
+    for pack in pack_store._packs("amy"):
+        os.remove(pack_store.pack_path("amy", pack))
+    db.execute(pack_store.DELETE_USER, ("amy",))
+
+    pack_store.put("amy", "b.txt", b"a new 000001 pack")
+    assert pack_store._packs("amy") == ["000001.pack"]
+    assert pack_store.get("amy", "b.txt") == b"a new 000001 pack"
@@ -0,0 +1,53 @@
+import threading
+
+import pytest
+
+import catalog
+import file_manager
+import quota
+
+
+def test_writes_past_the_quota_are_rejected():
+    quota.set_quota("amy", max_bytes=1000, max_files=3)
+    file_manager.create_file("amy", "a.txt", "x" * 600)
+
+    with pytest.raises(quota.QuotaExceededError):
+        file_manager.create_file("amy", "b.txt", "x" * 500)
+    with pytest.raises(quota.QuotaExceededError):
+        file_manager.edit_file("amy", "a.txt", "x" * 500)
+    assert file_manager.read_file("amy", "a.txt") == "x" * 600
+    assert catalog.usage("amy")[:2] == (1, 600)
+
+    # Shrinking is always allowed, and frees room for new files
+    file_manager.update_file("amy", "a.txt", "x" * 100)
+    file_manager.create_file("amy", "b.txt", "x" * 500)
+    file_manager.create_file("amy", "c.txt", "")
+    with pytest.raises(quota.QuotaExceededError):
+        file_manager.create_file("amy", "d.txt", "")
+
+
+def test_concurrent_writes_cannot_overshoot():
+    quota.set_quota("amy", max_bytes=1000)
+    rejected = []
+
+    def write(i):
+        try:
+            file_manager.create_file("amy", f"f{i}.txt", "x" * 300)
+        except quota.QuotaExceededError:
+            rejected.append(i)
+
+    threads = [threading.Thread(target=write, args=(i,)) for i in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    files, used, _ = catalog.usage("amy")
+    assert (files, used) == (3, 900)
+    assert len(rejected) == 7
+
+
+def test_lock_files_are_named_only_by_valid_usernames():
+    quota.set_quota("../amy", max_bytes=1000)
+    with pytest.raises(ValueError):
+        with quota.locked("../amy"):
+            pass
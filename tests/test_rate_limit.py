@@ -0,0 +1,48 @@
+import db
+import rate_limit
+
+
+def _saved_rows():
+    rate_limit._load()
+    return db.query_all("SELECT scope, key FROM login_buckets ORDER BY scope, key")
+
+
+def test_only_emptied_buckets_are_saved():
+    for i in range(50):  # One failure each for many names, from one client
+        rate_limit.check_login(f"guess{i}", "10.0.0.1")
+        rate_limit.record_failure(f"guess{i}", "10.0.0.1")
+    assert _saved_rows() == [("client", "10.0.0.1")]
+
+    for _ in range(rate_limit.USER_BURST + 1):
+        rate_limit.check_login("amy", "10.0.0.2")
+        rate_limit.record_failure("amy", "10.0.0.2")
+    assert ("user", "amy") in _saved_rows()
+    assert rate_limit.check_login("amy", "10.0.0.3") > 0
+
+
+def test_refilled_rows_are_pruned(monkeypatch):
+    for _ in range(rate_limit.USER_BURST + 1):
+        rate_limit.check_login("amy")
+        rate_limit.record_failure("amy")
+    assert ("user", "amy") in _saved_rows()
+
+    monkeypatch.setattr(rate_limit._limiters["user"], "rate", 1e6)  # Every bucket refills at once
+    monkeypatch.setitem(rate_limit._pruned, db.DB_NAME, 0)
+    rate_limit.check_login("bob")
+    rate_limit.record_failure("bob")  # Due for a sweep, so amy's row goes
+    assert _saved_rows() == []
+
+
+def test_refused_keys_stay_refused_after_a_restart(monkeypatch):
+    for _ in range(rate_limit.USER_BURST + 1):
+        rate_limit.check_login("amy")
+        rate_limit.record_failure("amy")
+
+    monkeypatch.setattr(rate_limit, "_loaded", set())  # A new process: memory is empty
+    monkeypatch.setattr(rate_limit, "_saved", set())
+    monkeypatch.setattr(rate_limit._limiters["user"], "_buckets", rate_limit.OrderedDict())
+    assert rate_limit.check_login("amy") > 0
+
+    rate_limit.record_success("amy")
+    assert _saved_rows() == []
+    assert rate_limit.check_login("amy") == 0
@@ -0,0 +1,38 @@
+import file_manager
+import search_index
+
+
+def test_words_prefixes_and_phrases():
+    file_manager.create_file("amy", "a.txt", "the quick brown fox jumps over the quick dog")
+    file_manager.create_file("amy", "b.txt", "brown quick fox, quickly")
+    file_manager.create_file("amy", "c.txt", "nothing to see")
+
+    assert search_index.search("amy", "quick") == [("a.txt", 2), ("b.txt", 1)]
+    assert search_index.search("amy", "quick*") == [("b.txt", 2), ("a.txt", 1)]
+    assert search_index.search("amy", '"quick brown"') == [("a.txt", 1)]
+    assert search_index.search("amy", '"brown quick" fox') == [("b.txt", 2)]
+
+
+def test_merges_forget_terms_of_deleted_files():
+    file_manager.create_file("amy", "keep.txt", "alpha beta")
+    file_manager.create_file("amy", "gone.txt", "gamma delta epsilon")
+    index = search_index._get_index("amy")
+    file_manager.delete_file("amy", "gone.txt")
+    with index.lock:
+        index.refresh()
+        index.merge()
+    assert sorted(index.term_ids) == ["alpha", "beta"]
+    assert search_index.search("amy", '"alpha beta"') == [("keep.txt", 1)]
+
+    search_index._indexes.clear()  # As another process would load it, from the new base
+    file_manager.create_file("amy", "new.txt", "beta gamma")
+    assert search_index.search("amy", "beta") == [("keep.txt", 1), ("new.txt", 1)]
+
+
+def test_segments_with_terms_in_order_still_load():
+    file_manager.create_file("amy", "a.txt", "placeholder")
+    search_index._indexes.clear()
+    search_index._write_segment("amy", {"docs": {"a.txt": {"v": [None, None], "t": "old format old"}}})
+    index = search_index.UserIndex("amy")
+    index.refresh()
+    assert index.search("old") == [("a.txt", 2)]
@@ -0,0 +1,72 @@
+import threading
+
+import pytest
+
+import file_manager
+import key_manager
+import pack_store
+import security
+
+
+def test_reencryption_does_not_undo_concurrent_edits():
+    file_manager.create_file("amy", "a.txt", "0" * 200000)
+    path = file_manager.stored_path("amy", "a.txt")
+    stop = threading.Event()
+    last = []
+
+    def edit():
+        i = 0
+        while not stop.is_set():
+            i += 1
+            file_manager.edit_file("amy", "a.txt", str(i % 10) * 10, 0)
+            last.append(str(i % 10) * 10)
+
+    editor = threading.Thread(target=edit)
+    editor.start()
+    try:
+        for _ in range(20):
+            security.upgrade_file(path, "amy", force=True)
+    finally:
+        stop.set()
+        editor.join()
+    assert security.read_range(path, 0, 10, owner="amy").decode() == last[-1]
+
+
+def test_files_are_refused_to_other_owners():
+    file_manager.create_file("amy", "a.txt", "private")
+    path = file_manager.stored_path("amy", "a.txt")
+    assert security.read_encrypted(path, owner="amy") == b"private"
+    with pytest.raises(ValueError, match="belongs to 'amy'"):
+        security.read_encrypted(path, owner="bob")
+
+
+def test_key_rotation_keeps_files_written_meanwhile_readable():
+    for i in range(5):
+        file_manager.create_file("amy", f"f{i}.txt", f"c{i}" * 100)
+    pack_store.put("amy", "p.txt", b"packed")
+    stop = threading.Event()
+    written = []
+
+    def write():
+        while not stop.is_set():
+            name = f"w{len(written)}.txt"
+            file_manager.create_file("amy", name, "new")
+            written.append(name)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    try:
+        for _ in range(3):
+            security.rotate_user_key("amy")
+    finally:
+        stop.set()
+        writer.join()
+    key_manager.clear_cache()
+    for name in [f"f{i}.txt" for i in range(5)] + written:
+        assert security.read_encrypted(file_manager.stored_path("amy", name), owner="amy")
+    assert pack_store.get("amy", "p.txt") == b"packed"
+
+
+def test_long_owner_names_are_rejected():
+    with pytest.raises(ValueError):
+        key_manager.check_owner("a" * 256)
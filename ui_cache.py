@@ -0,0 +1,100 @@
+import os
+import threading
+from collections import OrderedDict
+import catalog
+import file_manager
+import pack_store
+
+# Per-session cache for the Streamlit dashboard, which re-runs the whole
+# script on every widget interaction. Entries are keyed by what they were
+# read from plus that file's (mtime, size) on disk, so a file changed behind
+# the app's back is simply a miss; the dashboard also invalidates explicitly
+# after its own create/update/delete.
+MAX_CACHE_BYTES = 32 * 1024 * 1024  # per session
+MAX_ENTRY_BYTES = 4 * 1024 * 1024   # larger files are always read from disk
+
+
+class SessionCache:
+    """Memory-capped LRU of file listings and decrypted contents for one user session."""
+
+    def __init__(self, max_bytes=MAX_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (version, value, cost)
+        self._lock = threading.Lock()
+
+    def _get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def _put(self, key, version, value, cost):
+        if cost > min(self.max_bytes, MAX_ENTRY_BYTES):
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+            self._entries[key] = (version, value, cost)
+            self.size += cost
+            while self.size > self.max_bytes:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self.size -= evicted
+
+    def list_files(self, username):
+        """Return the user's file names, hitting the catalog only when the folder changed."""
+        key = ("list", username)
+        version = (_version(file_manager.get_user_folder(username)), pack_store.tail_version(username))
+        files = self._get(key, version)
+        if files is None:
+            files = catalog.list_names(username)
+            self._put(key, version, files, sum(len(name) for name in files) + 64)
+        return list(files)
+
+    def read_file(self, username, file_name):
+        """Return a file's decrypted content, decrypting only when it changed on disk."""
+        key = ("content", username, catalog.logical_name(file_name))
+        path = file_manager.stored_path(username, file_name)
+        if path and path.endswith(pack_store.PACK_SUFFIX):
+            # The pack changes with every put to it; the record's own version only with this file
+            packed = pack_store.locate(username, key[2])
+            version = packed[1:] if packed else None
+        else:
+            version = _version(path) if path else None
+        content = self._get(key, version) if version else None
+        if content is None:
+            content = file_manager.read_file(username, file_name)
+            if content is not None and version:
+                self._put(key, version, content, len(content))
+        return content
+
+    def invalidate(self, username, file_name=None):
+        """Drop the user's listing and, if given, one file's content."""
+        with self._lock:
+            keys = [("list", username)]
+            if file_name is not None:
+                keys.append(("content", username, catalog.logical_name(file_name)))
+            for key in keys:
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self.size -= entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+def _version(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
@@ -0,0 +1,142 @@
+import threading
+import time
+import db
+
+# Every query against the users table lives here, so auth never touches SQL
+# and the statements stay in each pooled connection's prepared-statement cache.
+CREATE_USERS = '''CREATE TABLE IF NOT EXISTS users (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    username TEXT UNIQUE,
+                    password_hash TEXT,
+                    role TEXT DEFAULT 'user',
+                    totp_secret TEXT,
+                    sessions_after REAL DEFAULT 0)'''
+# Databases created before sessions_after existed get the column on first use
+USER_COLUMNS = 'PRAGMA table_info(users)'
+ADD_SESSIONS_AFTER = 'ALTER TABLE users ADD COLUMN sessions_after REAL DEFAULT 0'
+INSERT_USER = 'INSERT INTO users (username, password_hash, role, totp_secret) VALUES (?, ?, ?, ?)'
+SELECT_CREDENTIALS = 'SELECT password_hash, role, totp_secret FROM users WHERE username = ?'
+SELECT_RECORD = 'SELECT role, totp_secret, sessions_after FROM users WHERE username = ?'
+SELECT_SESSIONS_AFTER = 'SELECT sessions_after FROM users WHERE username = ?'
+SELECT_USERS = 'SELECT username, role FROM users'
+UPDATE_SECRET = 'UPDATE users SET totp_secret = ? WHERE username = ?'
+UPDATE_PASSWORD = 'UPDATE users SET password_hash = ? WHERE username = ?'
+UPDATE_ROLE = 'UPDATE users SET role = ? WHERE username = ?'
+UPDATE_SESSIONS_AFTER = 'UPDATE users SET sessions_after = ? WHERE username = ?'
+
+# Role, TOTP secret and sessions_after are read on every dashboard rerun, so they are cached
+# per process. Writes through this module drop the cached record at once;
+# a change made by another process shows up within USER_CACHE_TTL.
+USER_CACHE_TTL = 300  # seconds
+
+_initialized = set()
+_lock = threading.Lock()
+_records = {}     # (database, username) -> (expires, (role, totp_secret, sessions_after))
+_generation = 0   # bumped by every invalidation, so a read racing one is not cached
+
+
+def initialize():
+    """Create the users table once per database per process."""
+    if db.DB_NAME in _initialized:
+        return
+    with _lock:
+        if db.DB_NAME not in _initialized:
+            with db.transaction() as conn:
+                conn.execute(CREATE_USERS)
+                if "sessions_after" not in [row[1] for row in conn.execute(USER_COLUMNS)]:
+                    conn.execute(ADD_SESSIONS_AFTER)
+            _initialized.add(db.DB_NAME)
+
+
+def invalidate(username=None):
+    """Drop one user's cached record, or every cached record."""
+    global _generation
+    with _lock:
+        _generation += 1
+        if username is None:
+            _records.clear()
+        else:
+            _records.pop((db.DB_NAME, username), None)
+
+
+def get_record(username):
+    """Return (role, totp_secret, sessions_after) for a user, or None, from the record cache."""
+    key = (db.DB_NAME, username)
+    cached = _records.get(key)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+    initialize()
+    generation = _generation
+    row = db.query_one(SELECT_RECORD, (username,))
+    if row is None:
+        return None  # Unknown names are not cached, so lookups cannot grow the cache
+    with _lock:
+        if generation == _generation:
+            _records[key] = (time.monotonic() + USER_CACHE_TTL, tuple(row))
+    return tuple(row)
+
+
+def create_user(username, password_hash, role, totp_secret):
+    """Insert a user. Raises sqlite3.IntegrityError if the username is taken."""
+    initialize()
+    db.execute(INSERT_USER, (username, password_hash, role, totp_secret))
+    invalidate(username)
+
+
+def get_credentials(username):
+    """Return (password_hash, role, totp_secret) for a user, or None."""
+    initialize()
+    return db.query_one(SELECT_CREDENTIALS, (username,))
+
+
+def get_role(username):
+    record = get_record(username)
+    return record[0] if record else None
+
+
+def get_totp_secret(username):
+    record = get_record(username)
+    return record[1] if record else None
+
+
+def set_totp_secret(username, secret):
+    initialize()
+    db.execute(UPDATE_SECRET, (secret, username))
+    invalidate(username)
+
+
+def set_role(username, role):
+    """Change a user's role; returns False if there is no such user."""
+    initialize()
+    changed = db.execute(UPDATE_ROLE, (role, username))
+    invalidate(username)
+    return changed > 0
+
+
+def get_sessions_after(username):
+    """Return the time before which a user's tokens are void, read from the database.
+
+    Uncached, so a logout made by another process counts at once; the
+    dashboard reads the cached value through get_record instead.
+    """
+    initialize()
+    row = db.query_one(SELECT_SESSIONS_AFTER, (username,))
+    return (row[0] or 0) if row else None
+
+
+def end_sessions(username, before):
+    """Void every token of a user issued before the given time."""
+    initialize()
+    db.execute(UPDATE_SESSIONS_AFTER, (before, username))
+    invalidate(username)
+
+
+def set_password_hash(username, password_hash):
+    initialize()
+    db.execute(UPDATE_PASSWORD, (password_hash, username))
+
+
+def list_users():
+    """Return [(username, role), ...] for every user."""
+    initialize()
+    return db.query_all(SELECT_USERS)